@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Client overhead of every public method, against the in-process fake clamd
+
+The fake server answers without scanning, so the numbers show the cost of
+the client and the socket round trips only: ops/s, p50 and p99 latency and,
+for methods sending content, MB/s per payload size.
+
+usage: python benchmarks/bench_client.py [--seconds 1] [--transport unix|tcp|both] [--sizes 1K,64K,1M,16M]
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from clamd.testing import FakeClamd  # noqa: E402
+
+_now = getattr(time, 'perf_counter', time.time)
+
+_UNITS = {'K': 1024, 'M': 1024 * 1024}
+
+
+def parse_size(text):
+    unit = _UNITS.get(text[-1:].upper(), 1)
+    return int(float(text.rstrip('kKmM')) * unit)
+
+
+def measure(operation, seconds):
+    """
+    run operation repeatedly for about seconds, return the sorted latencies
+    """
+    operation()
+    latencies = []
+    deadline = _now() + seconds
+    while True:
+        start = _now()
+        operation()
+        end = _now()
+        latencies.append(end - start)
+        if end >= deadline and len(latencies) >= 5:
+            return sorted(latencies)
+
+
+def percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+
+def report(transport, label, size, latencies):
+    total = sum(latencies)
+    line = '{0:<5} {1:<24} {2:>7} {3:>10.0f} ops/s {4:>9.1f} us p50 {5:>9.1f} us p99'.format(
+        transport, label, format_size(size) if size else '-', len(latencies) / total,
+        percentile(latencies, 0.5) * 1e6, percentile(latencies, 0.99) * 1e6)
+    if size:
+        line += ' {0:>9.1f} MB/s'.format(size * len(latencies) / total / 1024 / 1024)
+    print(line)
+
+
+def format_size(size):
+    for suffix, unit in (('M', _UNITS['M']), ('K', _UNITS['K'])):
+        if size >= unit and size % unit == 0:
+            return '{0}{1}'.format(size // unit, suffix)
+    return str(size)
+
+
+def cases(cd, transport, sizes, directory):
+    """
+    yield (label, payload size, operation) for every method and payload size
+    """
+    yield 'ping', 0, cd.ping
+    yield 'version', 0, cd.version
+    yield 'stats', 0, cd.stats
+
+    session = cd.session()
+    yield 'session ping', 0, session.ping
+
+    def pipelined_ping(batch=32):
+        ids = [session.submit_ping() for i in range(batch)]
+        for id in ids:
+            session.result(id)
+
+    yield 'session ping x32', 0, pipelined_ping
+
+    for size in sizes:
+        payload = os.urandom(size)
+        path = os.path.join(directory, 'payload-{0}'.format(size))
+        with open(path, 'wb') as f:
+            f.write(payload)
+
+        yield 'instream bytes', size, lambda payload=payload: cd.instream(payload)
+        yield 'instream BytesIO', size, lambda payload=payload: cd.instream(io.BytesIO(payload))
+        yield 'instream_path', size, lambda path=path: cd.instream_path(path)
+        yield 'session instream', size, lambda payload=payload: session.instream(payload)
+        batch = [payload, os.urandom(size)] * 5
+        yield 'scan_many 10 (2 unique)', size * 10, lambda batch=batch: cd.scan_many(batch)
+        yield 'scan', size, lambda path=path: cd.scan(path)
+        if transport == 'unix':
+            def fildes(path=path):
+                with open(path, 'rb') as f:
+                    cd.fildes(f)
+
+            yield 'fildes', size, fildes
+    session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=1, help='time spent on each case')
+    parser.add_argument('--transport', choices=('unix', 'tcp', 'both'), default='both')
+    parser.add_argument('--sizes', default='1K,64K,1M,16M', help='comma separated payload sizes')
+    args = parser.parse_args()
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    transports = ('unix', 'tcp') if args.transport == 'both' else (args.transport,)
+
+    directory = tempfile.mkdtemp(prefix='clamd-bench-')
+    try:
+        for transport in transports:
+            path = os.path.join(directory, 'clamd.ctl') if transport == 'unix' else None
+            server = FakeClamd(path, stream_max_length=max(sizes) + 1)
+            try:
+                for label, size, operation in cases(server.client(), transport, sizes, directory):
+                    report(transport, label, size, measure(operation, args.seconds))
+            finally:
+                server.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
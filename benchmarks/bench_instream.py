@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+INSTREAM upload throughput, before and after the scatter-gather rewrite
+
+Streams a payload into a local socketpair whose other end is drained by a
+thread, so the numbers measure the client side of INSTREAM only.
+
+usage: python benchmarks/bench_instream.py [size in MB]
+"""
+from __future__ import print_function, unicode_literals
+
+import io
+import mmap
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import clamd  # noqa: E402
+
+_now = getattr(time, 'perf_counter', time.time)
+
+
+def legacy_send_stream(clamd_socket, buff, chunk_size=1024):
+    """
+    the INSTREAM loop of clamd 1.0.2
+    """
+    chunk = buff.read(chunk_size)
+    while chunk:
+        size = struct.pack(b'!L', len(chunk))
+        clamd_socket.send(size + chunk)
+        chunk = buff.read(chunk_size)
+
+    clamd_socket.send(struct.pack(b'!L', 0))
+
+
+def drain(sock):
+    buf = bytearray(1024 * 1024)
+    while sock.recv_into(buf):
+        pass
+
+
+def measure(send, make_buff, size, repeat=3):
+    best = None
+    for i in range(repeat):
+        client, server = socket.socketpair()
+        reader = threading.Thread(target=drain, args=(server,))
+        reader.start()
+        buff = make_buff()
+        start = _now()
+        send(client, buff)
+        elapsed = _now() - start
+        client.close()
+        reader.join()
+        server.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return size / best / 1024 / 1024
+
+
+def main():
+    size = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 else 20 * 1024 * 1024
+    payload = os.urandom(size)
+
+    with tempfile.TemporaryFile() as f:
+        f.write(payload)
+        f.flush()
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        cases = [
+            ('before, BytesIO, 1 KB chunks', legacy_send_stream, lambda: io.BytesIO(payload)),
+        ]
+        for chunk_size in (64 * 1024, 1024 * 1024):
+            label = '{0} KB chunks'.format(chunk_size // 1024)
+
+            def send(sock, buff, chunk_size=chunk_size):
+                clamd._send_stream(sock, buff, chunk_size)
+
+            cases.extend([
+                ('after, BytesIO, ' + label, send, lambda: io.BytesIO(payload)),
+                ('after, bytes, ' + label, send, lambda: payload),
+                ('after, mmap, ' + label, send, lambda: mapped),
+            ])
+
+        print('INSTREAM upload of {0:.1f} MB'.format(size / 1024.0 / 1024))
+        for label, send, make_buff in cases:
+            print('{0:<32} {1:>10.1f} MB/s'.format(label, measure(send, make_buff, size)))
+
+        mapped.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+CONTSCAN/MULTISCAN reply parsing, regex and dict of tuples versus
+parse_scan_line() and ScanResults
+
+Parses a synthetic reply where 0.1% of the files are infected and 0.1% could
+not be scanned, and reports lines/s and the memory held by the results.
+
+usage: python benchmarks/bench_parse.py [number of lines]
+"""
+from __future__ import print_function, unicode_literals
+
+import gc
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import clamd  # noqa: E402
+
+_now = getattr(time, 'perf_counter', time.time)
+
+
+def synthetic_reply(lines):
+    out = io.BytesIO()
+    for i in range(lines):
+        path = '/srv/share/dir{0}/file{1}.doc'.format(i // 1000, i)
+        if i % 1000 == 1:
+            out.write('{0}: Win.Test.EICAR_HDB-1 FOUND\n'.format(path).encode('utf-8'))
+        elif i % 1000 == 2:
+            out.write('{0}: lstat() failed: Permission denied. ERROR\n'.format(path).encode('utf-8'))
+        else:
+            out.write('{0}: OK\n'.format(path).encode('utf-8'))
+    return out.getvalue()
+
+
+def regex_dict(reply):
+    dr = {}
+    for line in io.BytesIO(reply):
+        result = line.decode('utf-8').rstrip('\n')
+        filename, reason, status = clamd.scan_response.match(result).group("path", "virus", "status")
+        dr[filename] = (status, reason)
+    return dr
+
+
+def fast_dict(reply):
+    dr = {}
+    for line in io.BytesIO(reply):
+        filename, reason, status = clamd.parse_scan_line(line.decode('utf-8').rstrip('\n'))
+        dr[filename] = (status, reason)
+    return dr
+
+
+def fast_results(reply):
+    results = clamd.ScanResults()
+    add = results.add
+    for line in io.BytesIO(reply):
+        filename, reason, status = clamd.parse_scan_line(line.decode('utf-8').rstrip('\n'))
+        add(filename, status, reason)
+    return results
+
+
+def measure(parse, reply, lines):
+    gc.collect()
+    start = _now()
+    result = parse(reply)
+    elapsed = _now() - start
+    del result
+
+    gc.collect()
+    tracemalloc.start()
+    result = parse(reply)
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return lines / elapsed, retained
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 5000000
+    reply = synthetic_reply(lines)
+    print('parsing {0} lines ({1:.1f} MB)'.format(lines, len(reply) / 1024.0 / 1024))
+    for label, parse in [
+        ('regex, dict of tuples', regex_dict),
+        ('parse_scan_line, dict of tuples', fast_dict),
+        ('parse_scan_line, ScanResults', fast_results),
+    ]:
+        rate, retained = measure(parse, reply, lines)
+        print('{0:<34} {1:>12,.0f} lines/s {2:>10.1f} MB retained'.format(label, rate, retained / 1024.0 / 1024))
+
+
+if __name__ == '__main__':
+    main()
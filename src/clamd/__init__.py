@@ -10,12 +10,19 @@ except:
 # $Source$
 
 
+import os
 import socket
 import sys
 import struct
-import contextlib
 import re
 import base64
+import collections
+import threading
+import mmap
+import array
+import functools
+import time
+import hashlib
 
 scan_response = re.compile(r"^(?P<path>.*): ((?P<virus>.+) )?(?P<status>(FOUND|OK|ERROR))$")
 EICAR = base64.b64decode(
@@ -40,35 +47,432 @@ class ConnectionError(ClamdError):
     """Class for errors communication with clamd"""
 
 
+# canonical status strings, so parsed results share them instead of holding copies
+_STATUSES = {'OK': 'OK', 'FOUND': 'FOUND', 'ERROR': 'ERROR'}
+
+
+def parse_scan_line(line):
+    """
+    Parse one "path: OK", "path: virusname FOUND" or "path: reason ERROR" line,
+    a faster equivalent of matching scan_response
+
+    line (string) : reply line without its terminator
+
+    return:
+      - (tuple): (path, reason, status), reason is None for OK
+      - None: if the line is not a scan result
+    """
+    if line.endswith(': OK'):
+        return line[:-4], None, 'OK'
+    head, sep, status = line.rpartition(' ')
+    status = _STATUSES.get(status)
+    if status is None or not sep:
+        return None
+    if head.endswith(':'):
+        return head[:-1], None, status
+    path, sep, reason = head.rpartition(': ')
+    if sep and reason:
+        return path, reason, status
+    # unusual line, let the regex decide
+    match = scan_response.match(line)
+    if match is None:
+        return None
+    return match.group("path", "virus", "status")
+
+
+def parse_version(version):
+    """
+    Split a VERSION reply, e.g. "ClamAV 0.103.8/26700/Mon Oct 12 09:00:00 2026"
+
+    version (string) : reply of ClamdNetworkSocket.version()
+
+    return:
+      - (tuple): (engine version, signature database version, signature date),
+        the last two are None when clamd did not report them
+    """
+    parts = version.split('/', 2)
+    engine = parts[0]
+    if engine.startswith('ClamAV '):
+        engine = engine[len('ClamAV '):]
+    signatures = parts[1] if len(parts) > 1 else None
+    signatures_date = parts[2] if len(parts) > 2 else None
+    return engine, signatures, signatures_date
+
+
+class ScanResult(object):
+    """
+    Result of scanning one file
+    """
+    __slots__ = ('path', 'status', 'reason')
+
+    def __init__(self, path, status, reason=None):
+        """
+        class initialisation
+
+        path (string) : scanned file, 'stream' for INSTREAM
+        status (string) : 'OK', 'FOUND' or 'ERROR'
+        reason (string or None) : virus name or error message
+        """
+
+        self.path = path
+        self.status = status
+        self.reason = reason
+
+    @property
+    def infected(self):
+        return self.status == 'FOUND'
+
+    def __eq__(self, other):
+        if not isinstance(other, ScanResult):
+            return NotImplemented
+        return (self.path, self.status, self.reason) == (other.path, other.status, other.reason)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.path, self.status, self.reason))
+
+    def __repr__(self):
+        return 'ScanResult({0!r}, {1!r}, {2!r})'.format(self.path, self.status, self.reason)
+
+
+class ScanResults(object):
+    """
+    Collection of scan results with per-status counters
+
+    By default only FOUND and ERROR results are kept, clean files are only
+    counted, so collecting the results of a large scan uses memory in
+    proportion to the number of problems rather than the number of files.
+    """
+    def __init__(self, results=(), keep_ok=False):
+        """
+        class initialisation
+
+        results (iterable) : initial results, see update()
+        keep_ok (bool) : also keep OK results
+        """
+
+        self.keep_ok = keep_ok
+        self.counts = {'OK': 0, 'FOUND': 0, 'ERROR': 0}
+        self._results = []
+        self.update(results)
+
+    def add(self, path, status, reason=None):
+        self.counts[status] = self.counts.get(status, 0) + 1
+        if status != 'OK' or self.keep_ok:
+            self._results.append(ScanResult(path, status, reason))
+
+    def update(self, results):
+        """
+        Add results
+
+        results (iterable) : ScanResult objects, or (filename, (status, reason))
+                             pairs as yielded by iter_contscan()/iter_multiscan()
+                             or found in the dicts returned by the scan methods,
+                             or (filename, ((status, reason), ...)) pairs as
+                             yielded by iter_allmatchscan()
+        """
+        if isinstance(results, dict):
+            results = results.items()
+        add = self.add
+        for result in results:
+            if isinstance(result, ScanResult):
+                add(result.path, result.status, result.reason)
+                continue
+            path, verdict = result
+            if isinstance(verdict[0], tuple):
+                for status, reason in verdict:
+                    add(path, status, reason)
+            else:
+                status, reason = verdict
+                add(path, status, reason)
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    @property
+    def found(self):
+        return [result for result in self._results if result.status == 'FOUND']
+
+    @property
+    def errors(self):
+        return [result for result in self._results if result.status == 'ERROR']
+
+    def to_dict(self):
+        """
+        return: (dict) {filename1: ('FOUND', 'virusname'), ...} for the kept results
+        """
+        return dict((result.path, (result.status, result.reason)) for result in self._results)
+
+    def __iter__(self):
+        return iter(self._results)
+
+    def __len__(self):
+        return len(self._results)
+
+    def __repr__(self):
+        return '<ScanResults {0}>'.format(
+            ' '.join('{0}={1}'.format(status, count) for status, count in sorted(self.counts.items())))
+
+
+_clock = getattr(time, 'perf_counter', time.time)
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+class CallTrace(object):
+    """
+    Timings of one client call, passed to the client's tracer when it ends
+
+    Phases are in seconds: connect is spent opening the connection, send
+    writing the command and its payload, wait between the end of the
+    upload and the end of the reply (mostly clamd scanning) and parse
+    decoding the reply. error is the exception the call raised, if any.
+    """
+    __slots__ = ('command', 'endpoint', 'duration', 'connect', 'send', 'wait', 'parse', 'bytes_sent',
+                 'bytes_received', 'error')
+
+    def __init__(self, endpoint, command=None):
+        self.command = command
+        self.endpoint = endpoint
+        self.duration = 0.0
+        self.connect = 0.0
+        self.send = 0.0
+        self.wait = 0.0
+        self.parse = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.error = None
+
+    def phase(self, name, start, sent=0, received=0):
+        """
+        add the time since start to a phase
+        """
+        setattr(self, name, getattr(self, name) + _clock() - start)
+        self.bytes_sent += sent
+        self.bytes_received += received
+
+    def __repr__(self):
+        return ('<CallTrace {0} {1} {2:.6f}s connect={3:.6f} send={4:.6f} wait={5:.6f} parse={6:.6f} '
+                'sent={7} received={8}>').format(self.command, self.endpoint, self.duration, self.connect,
+                                                 self.send, self.wait, self.parse, self.bytes_sent,
+                                                 self.bytes_received)
+
+
+def _traced(method):
+    """
+    report the calls of a client method to the client's tracer, if it has one
+    """
+    @functools.wraps(method)
+    def traced(self, *args, **kwargs):
+        if self.tracer is None or getattr(self._local, 'trace', None) is not None:
+            return method(self, *args, **kwargs)
+        trace = self._local.trace = CallTrace(self._endpoint(), method.__name__.upper())
+        start = _clock()
+        try:
+            return method(self, *args, **kwargs)
+        except Exception:
+            trace.error = sys.exc_info()[1]
+            raise
+        finally:
+            trace.duration = _clock() - start
+            self._local.trace = None
+            self.tracer(trace)
+    return traced
+
+
 class ClamdNetworkSocket(object):
     """
     Class for using clamd with a network socket
+
+    Set `tracer` to a callable to have it called with a CallTrace after every
+    call, it is called from the thread that made the call.
     """
-    def __init__(self, host='127.0.0.1', port=3310, timeout=None):
+    # size of the INSTREAM chunks, MUST be < StreamMaxLength in /etc/clamav/clamd.conf
+    chunk_size = 64 * 1024
+    # called as tracer(CallTrace) after every call when set
+    tracer = None
+    # 'z' sends commands and receives replies delimited by NUL bytes, so file
+    # names may contain newlines, 'n' delimits them with newlines
+    command_mode = 'z'
+    # how content longer than stream_max_length is scanned instead of INSTREAM:
+    # 'fildes' (unix sockets only) and/or 'scan' (clamd must be able to read
+    # the file), it is rejected with BufferTooLongError when none applies
+    oversized_routes = ('fildes',)
+
+    def __init__(self, host='127.0.0.1', port=3310, timeout=None, connect_timeout=None, deadline=None,
+                 resolve_ttl=60, stream_max_length=None):
         """
         class initialisation
 
-        host (string) : hostname or ip address
+        host (string) : hostname, IPv4 or IPv6 address
         port (int) : TCP port
         timeout (float or None) : socket timeout
+        connect_timeout (float or None) : timeout for connecting to each
+                                          address, defaults to timeout
+        deadline (float or None) : maximum duration of a whole command,
+                                   including the INSTREAM upload and the reply
+        resolve_ttl (float) : seconds the addresses of host are cached for
+        stream_max_length (int or None) : StreamMaxLength of clamd in bytes,
+                                          learned from BufferTooLongError
+                                          when None, see _scan_stream()
         """
 
         self.host = host
         self.port = port
         self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.deadline = deadline
+        self.resolve_ttl = resolve_ttl
+        self.stream_max_length = stream_max_length
+        self.stream_routes = collections.Counter()
+        self._learned_max_length = None
+        self._accepted_length = 0
+        self._addresses = None
+        self._resolved_at = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def clamd_socket(self):
+        """
+        socket of the command in progress, kept per thread so one client can
+        be shared between threads
+        """
+        return getattr(self._local, 'clamd_socket', None)
+
+    @clamd_socket.setter
+    def clamd_socket(self, value):
+        self._local.clamd_socket = value
+        if value is not None:
+            self._response_reader().attach(value)
+
+    def _response_reader(self):
+        """
+        reader of the replies of this thread's connections, its buffer is reused from call to call
+        """
+        reader = getattr(self._local, 'reader', None)
+        if reader is None:
+            reader = self._local.reader = _ResponseReader(before_recv=self._arm_deadline)
+        return reader
 
     def _init_socket(self):
         """
         internal use only
         """
+        if self.deadline is not None:
+            self._local.deadline_at = _monotonic() + self.deadline
+        trace = self._current_trace()
+        if trace is None:
+            self.clamd_socket = self._connect()
+            return
+        start = _clock()
         try:
-            self.clamd_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.clamd_socket.connect((self.host, self.port))
-            self.clamd_socket.settimeout(self.timeout)
+            self.clamd_socket = self._connect()
+        finally:
+            trace.phase('connect', start)
+
+    def _current_trace(self):
+        """
+        return the CallTrace of the call in progress in this thread, None when not tracing
+        """
+        if self.tracer is None:
+            return None
+        return getattr(self._local, 'trace', None)
+
+    def _endpoint(self):
+        return '{0}:{1}'.format(self.host, self.port)
+
+    def _connect_timeout(self, deadline_at=None):
+        timeout = self.timeout if self.connect_timeout is None else self.connect_timeout
+        return self._bounded_timeout(timeout, deadline_at)
+
+    def _bounded_timeout(self, timeout, deadline_at=None):
+        """
+        timeout, shortened to what is left before deadline_at, by default the
+        deadline of this thread's command in progress
+
+        May raise:
+          - ConnectionError: if the deadline has passed
+        """
+        if deadline_at is None:
+            deadline_at = getattr(self._local, 'deadline_at', None)
+        if deadline_at is None:
+            return timeout
+        remaining = deadline_at - _monotonic()
+        if remaining <= 0:
+            raise ConnectionError("Deadline of {0}s exceeded".format(self.deadline))
+        if timeout is None or remaining < timeout:
+            return remaining
+        return timeout
+
+    def _arm_deadline(self):
+        """
+        bound the next blocking socket operation by the deadline
+        """
+        if self.deadline is not None and self.clamd_socket is not None:
+            self.clamd_socket.settimeout(self._bounded_timeout(self.timeout))
+
+    def _deadline_socket(self):
+        """
+        the socket to stream content to, bounding every write by the deadline
+        """
+        if self.deadline is None:
+            return self.clamd_socket
+        return _DeadlineSocket(self, self.clamd_socket)
+
+    def _connect(self, deadline_at=None):
+        """
+        internal use only
+
+        Tries every address of host in turn, each for at most connect_timeout
+        seconds, starting with the last one that worked.
 
+        deadline_at (float or None) : monotonic time the connection must be
+                                      made by, see _bounded_timeout()
+
+        return: a new socket connected to clamd
+        """
+        try:
+            addresses = self._resolve()
         except socket.error:
-            e = sys.exc_info()[1]
-            raise ConnectionError(self._error_message(e))
+            raise ConnectionError(self._error_message(sys.exc_info()[1]))
+
+        error = None
+        for address in addresses:
+            family, socktype, proto, canonname, sockaddr = address
+            timeout = self._connect_timeout(deadline_at)
+            clamd_socket = socket.socket(family, socktype, proto)
+            try:
+                clamd_socket.settimeout(timeout)
+                clamd_socket.connect(sockaddr)
+            except socket.error:
+                error = sys.exc_info()[1]
+                clamd_socket.close()
+                continue
+            # commands and INSTREAM chunks are small writes, do not let Nagle
+            # hold them back waiting for delayed ACKs
+            clamd_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            clamd_socket.settimeout(self.timeout)
+            if address is not addresses[0]:
+                self._addresses = [address] + [a for a in addresses if a is not address]
+            return clamd_socket
+
+        # the host may have moved, resolve it again next time
+        self._addresses = None
+        raise ConnectionError(self._error_message(error))
+
+    def _resolve(self):
+        """
+        return the addresses of host, from getaddrinfo() at most every resolve_ttl seconds
+        """
+        addresses = self._addresses
+        if addresses is None or _monotonic() - self._resolved_at >= self.resolve_ttl:
+            addresses = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+            self._addresses = addresses
+            self._resolved_at = _monotonic()
+        return addresses
 
     def _error_message(self, exception):
         # args for socket.error can either be (errno, "message")
@@ -87,15 +491,19 @@ class ClamdNetworkSocket(object):
                 msg=exception.args[1]
             )
 
+    @_traced
     def ping(self):
         return self._basic_command("PING")
 
+    @_traced
     def version(self):
         return self._basic_command("VERSION")
 
+    @_traced
     def reload(self):
         return self._basic_command("RELOAD")
 
+    @_traced
     def shutdown(self):
         """
         Force Clamd to shutdown and exit
@@ -112,15 +520,60 @@ class ClamdNetworkSocket(object):
         finally:
             self._close_socket()
 
+    def session(self, max_pending=32):
+        """
+        Open a persistent IDSESSION connection to clamd
+
+        max_pending (int) : maximum number of commands in flight before
+                            waiting for a reply
+
+        return: (ClamdSession) an open session, usable as a context manager
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        session = ClamdSession(self, max_pending=max_pending)
+        session.open()
+        return session
+
+    @_traced
     def scan(self, file):
         return self._file_system_scan('SCAN', file)
 
+    def scan_many(self, buffers, max_pending=32):
+        """
+        Scan many buffers over one session, see ClamdSession.scan_many()
+        """
+        with self.session(max_pending=max_pending) as session:
+            return session.scan_many(buffers)
+
+    @_traced
     def contscan(self, file):
         return self._file_system_scan('CONTSCAN', file)
 
+    @_traced
     def multiscan(self, file):
         return self._file_system_scan('MULTISCAN', file)
 
+    @_traced
+    def allmatchscan(self, file):
+        """
+        Scan a file or directory given by filename, reporting every signature
+        that matches instead of stopping at the first one
+
+        file (string): filename or directory (MUST BE ABSOLUTE PATH !)
+
+        return:
+          - (dict): {filename1: (('FOUND', 'virus1'), ('FOUND', 'virus2')), filename2: (('ERROR', 'reason'),)}
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        results = {}
+        for filename, matches in self.iter_allmatchscan(file):
+            results[filename] = results.get(filename, ()) + matches
+        return results
+
     def _basic_command(self, command):
         """
         Send a command to the clamav server, and return the reply.
@@ -151,26 +604,102 @@ class ClamdNetworkSocket(object):
           - ConnectionError: in case of communication problem
         """
 
-        try:
-            self._init_socket()
-            self._send_command(command, file)
+        return dict(self._iter_file_system_scan(command, file))
 
-            dr = {}
-            for result in self._recv_response_multiline().split('\n'):
-                if result:
-                    filename, reason, status = self._parse_response(result)
-                    dr[filename] = (status, reason)
+    def iter_contscan(self, file):
+        return self._iter_file_system_scan('CONTSCAN', file)
 
-            return dr
+    def iter_multiscan(self, file):
+        return self._iter_file_system_scan('MULTISCAN', file)
+
+    def iter_allmatchscan(self, file):
+        """
+        Generator variant of allmatchscan(), yielding the matches of each file
+        as soon as clamd has reported them all
+
+        return:
+          - (generator): (filename1, (('FOUND', 'virus1'), ('FOUND', 'virus2'))), (filename2, (('OK', None),)), ...
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        return _group_matches(self._iter_file_system_scan('ALLMATCHSCAN', file))
+
+    def _iter_file_system_scan(self, command, file):
+        """
+        Scan a file or directory given by filename, yielding results as clamd
+        reports them
+
+        The reply is parsed line by line as it arrives, so memory use does not
+        grow with the number of files and the first result is available before
+        the scan finishes. The generator owns its connection, which is closed
+        when it is exhausted or closed.
+
+        file (string): filename or directory (MUST BE ABSOLUTE PATH !)
+
+        return:
+          - (generator): (filename1, ('FOUND', 'virusname')), (filename2, ('ERROR', 'reason')), ...
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+
+        # the generator may be interleaved with other calls of this thread, so
+        # its deadline is kept here rather than in self._local
+        deadline_at = None if self.deadline is None else _monotonic() + self.deadline
+
+        def arm_deadline():
+            clamd_socket.settimeout(self._bounded_timeout(self.timeout, deadline_at))
+
+        trace = self._current_trace()
+        if trace is not None:
+            start = _clock()
+        clamd_socket = self._connect(deadline_at)
+        try:
+            try:
+                if trace is not None:
+                    trace.phase('connect', start)
+                    trace.command = command
+                    start = _clock()
+                data = _encode_command(self.command_mode, command, file)
+                if deadline_at is not None:
+                    arm_deadline()
+                clamd_socket.sendall(data)
+                if trace is not None:
+                    trace.phase('send', start, sent=len(data))
+            except socket.error:
+                e = sys.exc_info()[1]
+                raise ConnectionError("Error while writing to socket: {0}".format(e.args))
+
+            reader = _ResponseReader(clamd_socket, before_recv=arm_deadline if deadline_at is not None else None)
+            terminator = self._terminator()
+            while True:
+                if trace is not None:
+                    start = _clock()
+                    received = reader.received
+                line = reader.readline(terminator)
+                if trace is not None:
+                    trace.phase('wait', start, received=reader.received - received)
+                if line is None:
+                    break
+                if line:
+                    filename, reason, status = self._parse_scan_reply(_decode(line))
+                    if isinstance(file, bytes):
+                        filename = _encode_path(filename)
+                    yield filename, (status, reason)
 
         finally:
-            self._close_socket()
+            clamd_socket.close()
 
-    def instream(self, buff):
+    @_traced
+    def instream(self, buff, chunk_size=None):
         """
         Scan a buffer
 
-        buff  filelikeobj: buffer to scan
+        buff  filelikeobj or bytes-like: buffer to scan, bytes, bytearray,
+              memoryview and mmap objects are sent without being copied
+        chunk_size (int or None) : size of the chunks sent to clamd, defaults
+                                   to self.chunk_size
 
         return:
           - (dict): {filename1: ("virusname", "status")}
@@ -179,20 +708,179 @@ class ClamdNetworkSocket(object):
           - BufferTooLongError: if the buffer size exceeds clamd limits
           - ConnectionError: in case of communication problem
         """
+        chunk_size = chunk_size or self.chunk_size
+        return self._scan_stream(lambda: self._instream(_send_stream, buff, chunk_size), buff)
+
+    @_traced
+    def instream_path(self, path, chunk_size=None):
+        """
+        Scan a local file over INSTREAM, for clamd instances that cannot see
+        the file (e.g. on another host)
+
+        The file content is handed to the kernel with os.sendfile() where
+        available, or memory-mapped otherwise, so it is never read into Python.
 
+        path (string) : file to scan
+        chunk_size (int or None) : size of the chunks sent to clamd, defaults
+                                   to self.chunk_size
+
+        return:
+          - (dict): {'stream': ("status", "virusname")}
+
+        May raise :
+          - BufferTooLongError: if the file size exceeds clamd limits
+          - ConnectionError: in case of communication problem
+          - IOError: if the file cannot be read
+        """
+        chunk_size = chunk_size or self.chunk_size
+        with open(path, 'rb') as f:
+            return self._scan_stream(lambda: self._instream(_send_file_stream, f, chunk_size), f, path)
+
+    def metrics(self):
+        """
+        return: (dict) counters of how content was scanned, see clamd.stats.StatsPoller
+        """
+        with self._lock:
+            return {
+                'stream_max_length_bytes': self.stream_max_length or 0,
+                'stream_instream_total': self.stream_routes['instream'],
+                'stream_fildes_total': self.stream_routes['fildes'],
+                'stream_scan_total': self.stream_routes['scan'],
+                'stream_rejected_total': self.stream_routes['rejected'],
+                'stream_too_long_total': self.stream_routes['too_long'],
+            }
+
+    def _scan_stream(self, instream, buff, path=None):
+        """
+        Scan buff with instream() unless it is known to exceed
+        stream_max_length, in which case it is scanned with one of
+        oversized_routes or rejected without sending anything
+
+        A limit learned from BufferTooLongError is only an upper bound: clamd
+        refused that many bytes, its StreamMaxLength may be anywhere between
+        the largest content it accepted and that. Content of a size in between
+        goes to one of oversized_routes when one applies rather than being
+        uploaded, possibly for nothing, and is sent over INSTREAM otherwise.
+
+        instream (callable) : sends buff over INSTREAM and returns the result
+        buff : content to scan, as passed to instream()
+        path (string or None) : file buff was read from
+
+        return:
+          - (dict): {'stream': ("status", "virusname")}
+
+        May raise :
+          - BufferTooLongError: if the content exceeds clamd limits
+        """
+        size = _payload_size(buff)
+        limit = self.stream_max_length
+        if size is not None and limit is not None and size > limit:
+            return self._route_oversized(buff, size, limit, path)
+        learned = limit is not None and limit == self._learned_max_length
+        if learned and size is not None and size > self._accepted_length:
+            # between what clamd accepted and what it refused
+            route = self._oversized_route(buff, path)
+            if route is not None:
+                return route()
+
+        self._count('instream')
         try:
-            self._init_socket()
-            self._send_command('INSTREAM')
+            result = instream()
+        except BufferTooLongError:
+            self._count('too_long')
+            if size is not None:
+                # clamd refused size bytes, so the limit is below that
+                with self._lock:
+                    if self.stream_max_length is None or size - 1 < self.stream_max_length:
+                        self.stream_max_length = self._learned_max_length = size - 1
+            raise
+        if size is not None and size > self._accepted_length:
+            with self._lock:
+                self._accepted_length = max(self._accepted_length, size)
+        return result
+
+    def _route_oversized(self, buff, size, limit, path=None):
+        """
+        Scan buff, known to exceed stream_max_length, with one of
+        oversized_routes, or reject it
 
-            max_chunk_size = 1024  # MUST be < StreamMaxLength in /etc/clamav/clamd.conf
+        return:
+          - (dict): {'stream': ("status", "virusname")}
+
+        May raise :
+          - BufferTooLongError: if no route applies
+        """
+        route = self._oversized_route(buff, path)
+        if route is not None:
+            return route()
+        self._count('rejected')
+        raise BufferTooLongError("{0} bytes exceed StreamMaxLength ({1} bytes)".format(size, limit))
+
+    def _oversized_route(self, buff, path=None):
+        """
+        return: (callable or None) scans buff with the first of
+                oversized_routes that applies, None if none does
+        """
+        if path is None and _tell(buff) == 0:
+            # buff.name only holds what buff would send when nothing was read from buff yet
+            path = getattr(buff, 'name', None)
+            if not isinstance(path, (bytes, type(''))) or not os.path.isabs(path):
+                path = None
+        if 'fildes' in self.oversized_routes and hasattr(self, 'fildes') and _FILDES_SUPPORTED:
+            if _has_fileno(buff) and _tell(buff) == 0:
+                return functools.partial(self._routed, 'fildes', self.fildes, buff)
+            if path is not None:
+                return functools.partial(self._routed, 'fildes', self._fildes_path, path)
+        if 'scan' in self.oversized_routes and path is not None:
+            return functools.partial(self._routed, 'scan', self.scan, path)
+        return None
+
+    def _routed(self, route, scan, arg):
+        self._count(route)
+        return {'stream': _single_result(scan(arg))}
+
+    def _fildes_path(self, path):
+        with open(path, 'rb') as f:
+            return self.fildes(f)
+
+    def _count(self, route):
+        with self._lock:
+            self.stream_routes[route] += 1
+
+    def instream_writer(self, tee=None, chunk_size=None):
+        """
+        Open an INSTREAM connection and return a file like object to write
+        the content to scan to, see InstreamWriter
 
-            chunk = buff.read(max_chunk_size)
-            while chunk:
-                size = struct.pack(b'!L', len(chunk))
-                self.clamd_socket.send(size + chunk)
-                chunk = buff.read(max_chunk_size)
+        tee (file like object or None) : also write the content to this object
+        chunk_size (int or None) : writes are coalesced into chunks of this
+                                   size, defaults to self.chunk_size
 
-            self.clamd_socket.send(struct.pack(b'!L', 0))
+        return: (InstreamWriter) call its close() to get the verdict
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        return InstreamWriter(self, tee=tee, chunk_size=chunk_size or self.chunk_size)
+
+    def _instream(self, send, buff, chunk_size):
+        """
+        Send an INSTREAM command, stream buff with send(socket, buff, chunk_size)
+        and return the parsed reply
+        """
+
+        try:
+            self._init_socket()
+            self._send_command('INSTREAM')
+            trace = self._current_trace()
+            if trace is not None:
+                start = _clock()
+            try:
+                sent = send(self._deadline_socket(), buff, chunk_size)
+            except (socket.error, _SourceError):
+                raise _stream_error(sys.exc_info()[1], self._recv_response)
+            if trace is not None:
+                trace.phase('send', start, sent=sent)
 
             result = self._recv_response()
 
@@ -200,11 +888,12 @@ class ClamdNetworkSocket(object):
                 if result == 'INSTREAM size limit exceeded. ERROR':
                     raise BufferTooLongError(result)
 
-                filename, reason, status = self._parse_response(result)
+                filename, reason, status = self._parse_scan_reply(result)
                 return {filename: (status, reason)}
         finally:
             self._close_socket()
 
+    @_traced
     def stats(self):
         """
         Get Clamscan stats
@@ -223,82 +912,1114 @@ class ClamdNetworkSocket(object):
 
     def _send_command(self, cmd, *args):
         """
-        `man clamd` recommends to prefix commands with z, but we will use \n
-        terminated strings, as python<->clamd has some problems with \0x00
+        send a command in self.command_mode, file name arguments may be bytes
         """
-        concat_args = ''
-        if args:
-            concat_args = ' ' + ' '.join(args)
-
-        cmd = 'n{cmd}{args}\n'.format(cmd=cmd, args=concat_args).encode('utf-8')
-        self.clamd_socket.send(cmd)
+        data = _encode_command(self.command_mode, cmd, *args)
+        self._arm_deadline()
+        trace = self._current_trace()
+        if trace is None:
+            self.clamd_socket.sendall(data)
+            return
+        trace.command = cmd
+        start = _clock()
+        self.clamd_socket.sendall(data)
+        trace.phase('send', start, sent=len(data))
+
+    def _terminator(self):
+        """
+        delimiter of the replies to commands sent in self.command_mode
+        """
+        return b'\0' if self.command_mode == 'z' else b'\n'
 
     def _recv_response(self):
         """
         receive line from clamd
         """
-        try:
-            with contextlib.closing(self.clamd_socket.makefile('rb')) as f:
-                return f.readline().decode('utf-8').strip()
-        except (socket.error, socket.timeout):
-            e = sys.exc_info()[1]
-            raise ConnectionError("Error while reading from socket: {0}".format(e.args))
+        reader = self._response_reader()
+        trace = self._current_trace()
+        if trace is not None:
+            start = _clock()
+            received = reader.received
+        line = reader.readline(self._terminator())
+        if trace is not None:
+            trace.phase('wait', start, received=reader.received - received)
+        if line is None:
+            return ''
+        return _decode(line).strip()
 
     def _recv_response_multiline(self):
         """
         receive multiple line response from clamd and strip all whitespace characters
         """
-        try:
-            with contextlib.closing(self.clamd_socket.makefile('rb')) as f:
-                return f.read().decode('utf-8')
-        except (socket.error, socket.timeout):
-            e = sys.exc_info()[1]
-            raise ConnectionError("Error while reading from socket: {0}".format(e.args))
+        reader = self._response_reader()
+        trace = self._current_trace()
+        if trace is not None:
+            start = _clock()
+            received = reader.received
+        lines = []
+        terminator = self._terminator()
+        while True:
+            line = reader.readline(terminator)
+            if line is None:
+                break
+            lines.append(_decode(line) + '\n')
+        if trace is not None:
+            trace.phase('wait', start, received=reader.received - received)
+        return ''.join(lines)
 
     def _close_socket(self):
         """
         close clamd socket
         """
-        self.clamd_socket.close()
-        return
+        if self.clamd_socket is not None:
+            self.clamd_socket.close()
+            self.clamd_socket = None
+        self._local.deadline_at = None
 
     def _parse_response(self, msg):
         """
         parses responses for SCAN, CONTSCAN, MULTISCAN and STREAM commands.
         """
-        try:
-            return scan_response.match(msg).group("path", "virus", "status")
-        except AttributeError:
+        result = parse_scan_line(msg)
+        if result is None:
             raise ResponseError(msg.rsplit("ERROR", 1)[0])
+        return result
+
+    def _parse_scan_reply(self, msg):
+        """
+        _parse_response(), timed when tracing
+        """
+        trace = self._current_trace()
+        if trace is None:
+            return self._parse_response(msg)
+        start = _clock()
+        try:
+            return self._parse_response(msg)
+        finally:
+            trace.phase('parse', start)
+
+
+# file names are sent and received as bytes, names that are not valid UTF-8
+# go through surrogate escapes like os.fsencode() and os.fsdecode() do
+_PATH_ERRORS = 'surrogateescape' if sys.version_info[0] >= 3 else 'strict'
+
+
+def _group_matches(results):
+    """
+    group consecutive (filename, (status, reason)) results of the same file
+    into (filename, ((status, reason), ...))
+    """
+    current = None
+    matches = ()
+    for filename, result in results:
+        if matches and filename != current:
+            yield current, matches
+            matches = ()
+        current = filename
+        matches += (result,)
+    if matches:
+        yield current, matches
+
+
+def _encode_path(path):
+    if isinstance(path, bytes):
+        return path
+    return path.encode('utf-8', _PATH_ERRORS)
+
+
+def _decode(data):
+    return data.decode('utf-8', _PATH_ERRORS)
+
+
+def _encode_command(mode, cmd, *args):
+    """
+    command as sent by ClamdNetworkSocket._send_command, NUL terminated in
+    'z' mode and newline terminated in 'n' mode
+
+    May raise:
+      - ValueError: if an argument contains the terminator
+    """
+    terminator = b'\0' if mode == 'z' else b'\n'
+    data = b' '.join([cmd.encode('ascii')] + [_encode_path(arg) for arg in args])
+    if terminator in data:
+        raise ValueError("{0!r} cannot be sent in '{1}' command mode".format(data, mode))
+    return mode.encode('ascii') + data + terminator
+
+
+_END_OF_STREAM = struct.pack(b'!L', 0)
+
+# hint that a length prefix will be followed by its chunk, saves a packet per chunk on TCP
+_MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+
+# FILDES passes the descriptor with sendmsg(), missing on python 2
+_FILDES_SUPPORTED = hasattr(socket.socket, 'sendmsg') and hasattr(socket, 'SCM_RIGHTS')
+
+
+def _byte_view(data):
+    """
+    flat unsigned byte memoryview over any object supporting the buffer protocol
+    """
+    view = memoryview(data)
+    if view.format != 'B' or view.ndim != 1:
+        view = view.cast('B')
+    return view
+
+
+if hasattr(socket.socket, 'sendmsg'):
+    def _send_buffers(clamd_socket, buffers):
+        """
+        send all buffers with scatter-gather writes, resuming after partial sends
+        """
+        buffers = [_byte_view(b) for b in buffers]
+        while buffers:
+            sent = clamd_socket.sendmsg(buffers)
+            while sent:
+                size = len(buffers[0])
+                if sent < size:
+                    buffers[0] = buffers[0][sent:]
+                    break
+                sent -= size
+                del buffers[0]
+            while buffers and not len(buffers[0]):
+                del buffers[0]
+else:
+    def _send_buffers(clamd_socket, buffers):
+        for b in buffers:
+            clamd_socket.sendall(b)
+
+
+def _read_chunks(buff, chunk_size):
+    """
+    yield the content of a file like object as memoryviews of at most
+    chunk_size bytes, read into a single reused buffer when the object has
+    readinto(), so a chunk is only valid until the next one is requested
+    """
+    readinto = getattr(buff, 'readinto', None)
+    if readinto is None:
+        chunk = _read_source(buff.read, chunk_size)
+        while chunk:
+            yield _byte_view(chunk)
+            chunk = _read_source(buff.read, chunk_size)
+        return
+
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    size = _read_source(readinto, buf)
+    while size:
+        yield view[:size]
+        size = _read_source(readinto, buf)
+
+
+def _read_source(read, *args):
+    """
+    call read(*args) on the content being streamed, raising _SourceError if
+    it fails so that it is not taken for a socket error
+    """
+    try:
+        return read(*args)
+    except (IOError, OSError):
+        raise _SourceError(sys.exc_info()[1])
+
+
+def _send_stream(clamd_socket, buff, chunk_size):
+    """
+    send the content of a file like or bytes-like object as INSTREAM chunks,
+    followed by the zero length terminator
+
+    bytes-like objects (bytes, bytearray, memoryview, mmap) are sliced without
+    copying, and each length prefix goes out in the same scatter-gather write
+    as its chunk
+
+    return the number of bytes sent, length prefixes included
+    """
+    if isinstance(buff, (bytes, bytearray, memoryview, mmap.mmap)):
+        view = _byte_view(buff)
+        try:
+            size = len(view)
+            for start in range(0, size, chunk_size):
+                chunk = view[start:start + chunk_size]
+                buffers = [struct.pack(b'!L', len(chunk)), chunk]
+                if start + chunk_size >= size:
+                    buffers.append(_END_OF_STREAM)
+                _send_buffers(clamd_socket, buffers)
+                _release(chunk)
+            if not size:
+                clamd_socket.sendall(_END_OF_STREAM)
+        finally:
+            _release(view)
+        return _stream_size(size, chunk_size)
+
+    sent = len(_END_OF_STREAM)
+    for chunk in _read_chunks(buff, chunk_size):
+        _send_buffers(clamd_socket, [struct.pack(b'!L', len(chunk)), chunk])
+        sent += 4 + len(chunk)
+    clamd_socket.sendall(_END_OF_STREAM)
+    return sent
+
+
+def _release(view):
+    """
+    release a memoryview now rather than when it is collected, where
+    memoryview.release() exists (python 3.2+)
+    """
+    release = getattr(view, 'release', None)
+    if release is not None:
+        release()
+
+
+def _stream_size(size, chunk_size):
+    """
+    bytes on the wire for size bytes of content sent in chunk_size chunks
+    """
+    chunks = (size + chunk_size - 1) // chunk_size
+    return size + 4 * chunks + len(_END_OF_STREAM)
+
+
+def _send_file_stream(clamd_socket, f, chunk_size):
+    """
+    send the content of a regular file as INSTREAM chunks, followed by the zero
+    length terminator
+
+    the chunks are copied by the kernel with sendfile() where available,
+    otherwise the file is memory-mapped and sent by _send_stream, or read in
+    chunks where an mmap cannot be viewed as a memoryview (python 2)
+
+    return the number of bytes sent, length prefixes included
+    """
+    size = _read_source(os.fstat, f.fileno()).st_size
+    if not size:
+        clamd_socket.sendall(_END_OF_STREAM)
+        return len(_END_OF_STREAM)
+
+    if not (hasattr(os, 'sendfile') and hasattr(clamd_socket, 'sendfile')):
+        mapped = _read_source(mmap.mmap, f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            try:
+                memoryview(mapped)
+            except TypeError:
+                return _send_stream(clamd_socket, f, chunk_size)
+            return _send_stream(clamd_socket, mapped, chunk_size)
+        finally:
+            mapped.close()
+
+    for offset in range(0, size, chunk_size):
+        count = min(chunk_size, size - offset)
+        clamd_socket.sendall(struct.pack(b'!L', count), _MSG_MORE)
+        if clamd_socket.sendfile(f, offset, count) != count:
+            # the length prefix is already on the wire and clamd waits for the
+            # rest of the chunk: the connection has to be dropped
+            raise _SourceError(IOError("File truncated while streaming"))
+    clamd_socket.sendall(_END_OF_STREAM)
+    return _stream_size(size, chunk_size)
+
+
+class _ResponseReader(object):
+    """
+    Buffered reader of the replies of one clamd connection
+
+    Receives with recv_into() into a bytearray kept between replies, and
+    cut lines on \\n or \\0 in place, so nothing read past the current reply
+    is lost and no buffer is allocated per reply. Lines longer than max_line
+    are refused, to protect against a server that never terminates them.
+    """
+    def __init__(self, clamd_socket=None, size=4096, max_line=64 * 1024, before_recv=None):
+        """
+        class initialisation
+
+        clamd_socket (socket or None) : connection to read, see attach()
+        size (int) : initial buffer size, grown up to max_line as needed
+        max_line (int) : longest reply line accepted, in bytes
+        before_recv (callable or None) : called before every recv, to arm a deadline
+        """
+
+        self.clamd_socket = clamd_socket
+        self.max_line = max_line
+        self.before_recv = before_recv
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self.received = 0
+
+    def attach(self, clamd_socket):
+        """
+        Read a new connection, reusing the buffer
+        """
+        self.clamd_socket = clamd_socket
+        self._start = self._end = 0
+        self.received = 0
+
+    def readline(self, terminator=None):
+        """
+        terminator (bytes or None) : b'\\0' or b'\\n', None for either
+
+        return: (bytes or None) next line without its terminator, None once
+                the connection is closed
+
+        May raise:
+          - ConnectionError: in case of communication problem
+          - ResponseError: if the line is longer than max_line
+        """
+        scanned = self._start
+        while True:
+            buffer, end = self._buffer, self._end
+            if terminator is None:
+                newline = buffer.find(b'\n', scanned, end)
+                nul = buffer.find(b'\0', scanned, newline if newline >= 0 else end)
+                i = nul if nul >= 0 else newline
+            else:
+                i = buffer.find(terminator, scanned, end)
+            if i >= 0:
+                line = self._view[self._start:i].tobytes()
+                self._start = i + 1
+                return line
+            scanned = end - self._start
+            if not self._fill():
+                if self._start == self._end:
+                    return None
+                # last line not terminated
+                line = self._view[self._start:self._end].tobytes()
+                self._start = self._end
+                return line
+            scanned += self._start
+
+    def _fill(self):
+        """
+        receive more bytes after the unread ones, return False at end of stream
+        """
+        pending = self._end - self._start
+        if self._start and (self._end == len(self._buffer) or not pending):
+            # move the unread bytes to the front
+            self._view[:pending] = self._view[self._start:self._end]
+            self._start, self._end = 0, pending
+        if self._end == len(self._buffer):
+            if len(self._buffer) >= self.max_line:
+                raise ResponseError("Reply line longer than {0} bytes".format(self.max_line))
+            buffer = bytearray(min(2 * len(self._buffer), self.max_line))
+            buffer[:self._end] = self._view[:self._end]
+            self._buffer, self._view = buffer, memoryview(buffer)
+        if self.before_recv is not None:
+            self.before_recv()
+        try:
+            received = self.clamd_socket.recv_into(self._view[self._end:])
+        except (socket.error, socket.timeout):
+            e = sys.exc_info()[1]
+            raise ConnectionError("Error while reading from socket: {0}".format(e.args))
+        self._end += received
+        self.received += received
+        return received > 0
+
+
+class _DeadlineSocket(object):
+    """
+    socket wrapper bounding every write by the deadline of the client's
+    command in progress, so a slow upload cannot outlive it
+    """
+    def __init__(self, client, clamd_socket):
+        self.client = client
+        self.clamd_socket = clamd_socket
+
+    def __getattr__(self, name):
+        return getattr(self.clamd_socket, name)
+
+    def _arm(self):
+        self.clamd_socket.settimeout(self.client._bounded_timeout(self.client.timeout))
+
+    def send(self, *args):
+        self._arm()
+        return self.clamd_socket.send(*args)
+
+    def sendall(self, *args):
+        self._arm()
+        return self.clamd_socket.sendall(*args)
+
+    def sendmsg(self, *args):
+        self._arm()
+        return self.clamd_socket.sendmsg(*args)
+
+    def sendfile(self, *args):
+        self._arm()
+        return self.clamd_socket.sendfile(*args)
+
+
+class _SourceError(Exception):
+    """
+    reading the content sent over INSTREAM failed with self.error, as
+    opposed to the socket
+    """
+    def __init__(self, error):
+        Exception.__init__(self, error)
+        self.error = error
+
+
+def _stream_error(e, read_reply):
+    """
+    return the exception to raise when sending INSTREAM content failed with e
+
+    clamd drops the connection once StreamMaxLength is exceeded, the reason
+    can still be read from the socket with read_reply(). When the content
+    could not be read (_SourceError), clamd still waits for the rest of the
+    stream and sends nothing: the original error is returned without
+    reading, the connection has to be closed.
+    """
+    if isinstance(e, _SourceError):
+        return e.error
+    try:
+        reply = read_reply()
+    except ClamdError:
+        reply = None
+    if reply == 'INSTREAM size limit exceeded. ERROR':
+        return BufferTooLongError(reply)
+    if isinstance(e, ClamdError):
+        return e
+    return ConnectionError("Error while writing to socket: {0}".format(e.args))
+
+
+def _check_fildes():
+    """
+    May raise:
+      - ClamdError: if this python cannot pass file descriptors
+    """
+    if not _FILDES_SUPPORTED:
+        raise ClamdError("FILDES is not supported: socket.sendmsg() is not available")
+
+
+def _send_fd(clamd_socket, fd):
+    """
+    pass a file descriptor to clamd in the ancillary data of a one byte message,
+    as expected after a FILDES command
+    """
+    fds = array.array('i', [fd])
+    fds = fds.tobytes() if hasattr(fds, 'tobytes') else fds.tostring()
+    clamd_socket.sendmsg([b'\0'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+
+
+def _payload_size(buff):
+    """
+    return the number of bytes INSTREAM would send from buff, None when it
+    cannot be known without reading it
+    """
+    if isinstance(buff, mmap.mmap) or not hasattr(buff, 'read'):
+        try:
+            return len(_byte_view(buff))
+        except TypeError:
+            return None
+    try:
+        if not buff.seekable():
+            return None
+        position = buff.tell()
+        end = buff.seek(0, os.SEEK_END)
+        buff.seek(position)
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    return max(0, end - position)
+
+
+def _has_fileno(f):
+    try:
+        f.fileno()
+    except (AttributeError, IOError, OSError, ValueError):
+        return False
+    return True
+
+
+def _tell(f):
+    try:
+        return f.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+
+def _single_result(result):
+    """
+    (status, reason) of a one file result dict
+    """
+    return list(result.values())[0]
+
+
+def _fileno(fileobj_or_fd):
+    if hasattr(fileobj_or_fd, 'fileno'):
+        return fileobj_or_fd.fileno()
+    return fileobj_or_fd
+
+
+class ClamdSession(object):
+    """
+    Class for sending many commands to clamd over a single connection
+
+    Uses the IDSESSION/END protocol: commands can be pipelined without waiting
+    for the previous reply, and clamd prefixes every reply with the id of the
+    request it answers (the order of the command in the session, starting
+    from 1).
+
+    Only PING, VERSION, STATS, SCAN, INSTREAM and FILDES are allowed inside a
+    session.
+    """
+    def __init__(self, client, max_pending=32):
+        """
+        class initialisation
+
+        client (ClamdNetworkSocket) : client used to connect to clamd
+        max_pending (int) : maximum number of commands in flight before
+                            waiting for a reply
+        """
+
+        self.client = client
+        self.max_pending = max_pending
+        self.clamd_socket = None
+        self._reader = None
+        self._last_id = 0
+        self._pending = collections.OrderedDict()
+        self._replies = {}
+
+    def __enter__(self):
+        if self.clamd_socket is None:
+            self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """
+        Connect to clamd and start the session
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        self.clamd_socket = self.client._connect()
+        self._reader = _ResponseReader(self.clamd_socket)
+        self._last_id = 0
+        self._pending.clear()
+        self._replies.clear()
+        self._send_command('IDSESSION')
+
+    def close(self):
+        """
+        End the session and close the connection. Replies that have not been
+        read yet are discarded.
+        """
+        if self.clamd_socket is None:
+            return
+        try:
+            self._send_command('END')
+        except ConnectionError:
+            pass
+        finally:
+            self._disconnect()
+
+    def _disconnect(self):
+        """
+        close the connection without ending the session
+        """
+        if self.clamd_socket is not None:
+            self.clamd_socket.close()
+            self.clamd_socket = None
+            self._reader = None
+
+    @property
+    def closed(self):
+        return self.clamd_socket is None
+
+    @property
+    def pending(self):
+        """
+        number of submitted commands whose result has not been read yet
+        """
+        return len(self._pending) + len(self._replies)
+
+    def ping(self):
+        return self.result(self.submit_ping())
+
+    def version(self):
+        return self.result(self.submit_version())
+
+    def stats(self):
+        return self.result(self.submit_stats())
+
+    def scan(self, file):
+        return self.result(self.submit_scan(file))
+
+    def instream(self, buff):
+        # content over the client's stream_max_length is routed or rejected, see ClamdNetworkSocket._scan_stream()
+        return self.client._scan_stream(lambda: self.result(self.submit_instream(buff)), buff)
+
+    def instream_path(self, path):
+        with open(path, 'rb') as f:
+            return self.client._scan_stream(lambda: self.result(self._submit_stream(_send_file_stream, f)), f, path)
+
+    def fildes(self, fileobj_or_fd):
+        return self.result(self.submit_fildes(fileobj_or_fd))
+
+    def scan_many(self, buffers):
+        """
+        Scan many buffers, sending identical content only once
+
+        Buffers are hashed, and only the first buffer with a given content is
+        streamed to clamd; the INSTREAM commands are pipelined. Meant for
+        batches of small buffers such as email parts: file like objects are
+        read into memory.
+
+        buffers (iterable) : bytes-like or file like objects
+
+        Buffers known to exceed the client's stream_max_length are not sent
+        over the session, they are scanned with one of its oversized_routes
+        or rejected, see ClamdNetworkSocket._scan_stream().
+
+        return:
+          - (list): one result per buffer, in order, {'stream': (status,
+            reason)} as returned by instream(), or the ResponseError clamd
+            replied with, BufferTooLongError for a rejected buffer
+
+        May raise:
+          - BufferTooLongError: if a buffer exceeds clamd limits while
+                                stream_max_length is unknown, clamd then
+                                closes the session
+          - ConnectionError: in case of communication problem
+        """
+        digests = []
+        request_ids = collections.OrderedDict()
+        routed = {}
+        limit = self.client.stream_max_length
+        for index, buff in enumerate(buffers):
+            size = _payload_size(buff)
+            if size is not None and limit is not None and size > limit:
+                try:
+                    routed[index] = self.client._route_oversized(buff, size, limit)
+                except BufferTooLongError:
+                    routed[index] = sys.exc_info()[1]
+                digests.append(None)
+                continue
+            if hasattr(buff, 'read') and not isinstance(buff, mmap.mmap):
+                buff = buff.read()
+            digest = hashlib.sha256(buff).digest()
+            if digest not in request_ids:
+                request_ids[digest] = self.submit_instream(buff)
+            digests.append(digest)
+
+        results = {}
+        for digest, request_id in request_ids.items():
+            try:
+                results[digest] = self.result(request_id)
+            except BufferTooLongError:
+                raise
+            except ResponseError:
+                results[digest] = sys.exc_info()[1]
+        results = [routed[index] if digest is None else results[digest] for index, digest in enumerate(digests)]
+        return [dict(result) if isinstance(result, dict) else result for result in results]
+
+    def submit_ping(self):
+        return self._submit('basic', 'PING')
+
+    def submit_version(self):
+        return self._submit('basic', 'VERSION')
+
+    def submit_stats(self):
+        return self._submit('stats', 'STATS')
+
+    def submit_scan(self, file):
+        """
+        Send a SCAN command without waiting for the reply
+
+        file (string): filename or directory (MUST BE ABSOLUTE PATH !)
+
+        return: (int) request id, to be passed to result()
+        """
+        return self._submit('bytes_scan' if isinstance(file, bytes) else 'scan', 'SCAN', file)
+
+    def submit_instream(self, buff):
+        """
+        Send an INSTREAM command and the buffer content without waiting for
+        the reply
+
+        buff  filelikeobj: buffer to scan
+
+        return: (int) request id, to be passed to result()
+        """
+        return self._submit_stream(_send_stream, buff)
+
+    def submit_instream_path(self, path):
+        """
+        Send an INSTREAM command and the content of a local file without
+        waiting for the reply, see ClamdNetworkSocket.instream_path()
+
+        path (string) : file to scan
+
+        return: (int) request id, to be passed to result()
+        """
+        with open(path, 'rb') as f:
+            return self._submit_stream(_send_file_stream, f)
+
+    def submit_fildes(self, fileobj_or_fd):
+        """
+        Pass an open file descriptor to clamd without waiting for the reply,
+        see ClamdUnixSocket.fildes()
+
+        fileobj_or_fd (file like object or int) : open file to scan
+
+        return: (int) request id, to be passed to result()
+        """
+        if self.clamd_socket is not None and self.clamd_socket.family != getattr(socket, 'AF_UNIX', None):
+            raise ClamdError("FILDES is only supported over unix sockets")
+        _check_fildes()
+        request_id = self._submit('scan', 'FILDES')
+        try:
+            _send_fd(self.clamd_socket, _fileno(fileobj_or_fd))
+        except socket.error:
+            e = sys.exc_info()[1]
+            raise ConnectionError("Error while writing to socket: {0}".format(e.args))
+        return request_id
+
+    def _submit_stream(self, send, buff):
+        request_id = self._submit('instream', 'INSTREAM')
+
+        def read_reply():
+            while request_id not in self._replies:
+                self._read_reply()
+            return self._replies.pop(request_id)[1]
+
+        try:
+            send(self.clamd_socket, buff, self.client.chunk_size)
+        except (socket.error, _SourceError):
+            e = sys.exc_info()[1]
+            if isinstance(e, _SourceError):
+                # clamd waits for the rest of the stream, the session cannot go on
+                self._disconnect()
+            raise _stream_error(e, read_reply)
+        return request_id
+
+    def result(self, request_id):
+        """
+        Wait for the reply to a submitted command
+
+        request_id (int) : id returned by one of the submit_* methods
+
+        return: the same value as the corresponding ClamdNetworkSocket method
+
+        May raise:
+          - ResponseError: if clamd replied with an error
+          - BufferTooLongError: if an INSTREAM buffer exceeded clamd limits
+          - ConnectionError: in case of communication problem
+        """
+        while request_id not in self._replies:
+            if request_id not in self._pending:
+                raise KeyError(request_id)
+            self._read_reply()
+        kind, reply = self._replies.pop(request_id)
+        return self._parse_reply(kind, reply)
+
+    def results(self):
+        """
+        Wait for the replies to every submitted command
+
+        return: (list) [(request_id, result or exception), ...] in submission order
+        """
+        results = []
+        for request_id in sorted(set(self._pending) | set(self._replies)):
+            try:
+                results.append((request_id, self.result(request_id)))
+            except ResponseError:
+                results.append((request_id, sys.exc_info()[1]))
+        return results
+
+    def _submit(self, kind, command, *args):
+        if self.clamd_socket is None:
+            raise ConnectionError("Session is closed")
+        while len(self._pending) >= self.max_pending:
+            self._read_reply()
+        self._send_command(command, *args)
+        self._last_id += 1
+        self._pending[self._last_id] = kind
+        return self._last_id
+
+    def _send_command(self, cmd, *args):
+        try:
+            self.clamd_socket.sendall(_encode_command(self.client.command_mode, cmd, *args))
+        except socket.error:
+            e = sys.exc_info()[1]
+            raise ConnectionError("Error while writing to socket: {0}".format(e.args))
+
+    def _readline(self):
+        line = self._reader.readline(self.client._terminator())
+        if line is None:
+            raise ConnectionError("Connection closed by clamd")
+        return line
+
+    def _read_reply(self):
+        """
+        read one reply from clamd and store it under its request id
+        """
+        line = self._readline()
+        request_id, sep, reply = line.partition(b': ')
+        try:
+            request_id = int(request_id)
+        except ValueError:
+            # replies without an id are fatal session errors, clamd closes
+            # the connection after sending them
+            self.close()
+            raise ResponseError(_decode(line).rsplit("ERROR", 1)[0].strip())
+        kind = self._pending.pop(request_id, None)
+        reply = _decode(reply)
+        if kind == 'stats':
+            # one record in 'z' mode, one line at a time in 'n' mode
+            lines = [reply]
+            while lines[-1].rsplit('\n', 1)[-1] != 'END':
+                lines.append(_decode(self._readline()))
+            reply = '\n'.join(lines) + '\n'
+        self._replies[request_id] = (kind, reply)
+
+    def _parse_reply(self, kind, reply):
+        if kind == 'stats':
+            return reply
+        if kind == 'basic':
+            response = reply.rsplit("ERROR", 1)
+            if len(response) > 1:
+                raise ResponseError(response[0])
+            return response[0]
+        if kind == 'instream' and reply == 'INSTREAM size limit exceeded. ERROR':
+            raise BufferTooLongError(reply)
+        filename, reason, status = self.client._parse_response(reply)
+        if kind == 'bytes_scan':
+            filename = _encode_path(filename)
+        return {filename: (status, reason)}
+
+
+class InstreamWriter(object):
+    """
+    Writable stream scanned by clamd as it is written
+
+    The INSTREAM connection is opened up front and the content is forwarded
+    to clamd while the application writes it, optionally copied to a second
+    file like object, so scanning overlaps with receiving an upload instead
+    of following it. close() ends the stream and returns the verdict.
+
+        with cd.instream_writer(tee=open('upload', 'wb')) as sink:
+            for chunk in request_body:
+                sink.write(chunk)
+        sink.result  # {'stream': ('OK', None)}
+    """
+    def __init__(self, client, tee=None, chunk_size=64 * 1024):
+        """
+        class initialisation, connects to clamd
+
+        client (ClamdNetworkSocket) : client used to connect to clamd
+        tee (file like object or None) : also write the content to this object
+        chunk_size (int) : writes are coalesced into chunks of this size
+        """
+
+        self.client = client
+        self.tee = tee
+        self.chunk_size = chunk_size
+        self.bytes_written = 0
+        self.result = None
+        self._buffer = bytearray()
+        self.clamd_socket = client._connect()
+        try:
+            self._sendall(_encode_command(client.command_mode, 'INSTREAM'))
+        except:
+            self.abort()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    @property
+    def closed(self):
+        return self.clamd_socket is None
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        """
+        Send data to clamd, small writes are buffered up to chunk_size
+
+        return: (int) number of bytes written
+
+        May raise:
+          - BufferTooLongError: if the content exceeds clamd limits
+          - ConnectionError: in case of communication problem
+        """
+        if self.clamd_socket is None:
+            raise ValueError("write to closed InstreamWriter")
+        if self.tee is not None:
+            self.tee.write(data)
+        size = len(data)
+        self.bytes_written += size
+        if self._buffer or size < self.chunk_size:
+            self._buffer += data
+            if len(self._buffer) >= self.chunk_size:
+                self._send(self._buffer)
+                self._buffer = bytearray()
+        else:
+            self._send(data)
+        return size
+
+    def flush(self):
+        """
+        Send the buffered data to clamd
+        """
+        if self._buffer and self.clamd_socket is not None:
+            self._send(self._buffer)
+            self._buffer = bytearray()
+        if self.tee is not None and hasattr(self.tee, 'flush'):
+            self.tee.flush()
+
+    def close(self):
+        """
+        End the stream and wait for the verdict
+
+        return:
+          - (dict): {'stream': ('FOUND', 'virusname')}, also kept in self.result
+
+        May raise:
+          - BufferTooLongError: if the content exceeds clamd limits
+          - ResponseError: if clamd cannot scan the content
+          - ConnectionError: in case of communication problem
+        """
+        if self.clamd_socket is None:
+            return self.result
+        try:
+            self.flush()
+            self._sendall(_END_OF_STREAM)
+            reply = self._recv_reply()
+            if reply == 'INSTREAM size limit exceeded. ERROR':
+                raise BufferTooLongError(reply)
+            filename, reason, status = self.client._parse_response(reply)
+            self.result = {filename: (status, reason)}
+            return self.result
+        finally:
+            self.abort()
+
+    def abort(self):
+        """
+        Close the connection without waiting for a verdict
+        """
+        if self.clamd_socket is not None:
+            self.clamd_socket.close()
+            self.clamd_socket = None
+
+    def _send(self, data):
+        view = _byte_view(data)
+        for start in range(0, len(view), self.chunk_size):
+            chunk = view[start:start + self.chunk_size]
+            try:
+                _send_buffers(self.clamd_socket, [struct.pack(b'!L', len(chunk)), chunk])
+            except socket.error:
+                self._send_failed(sys.exc_info()[1])
+
+    def _sendall(self, data):
+        try:
+            self.clamd_socket.sendall(data)
+        except socket.error:
+            self._send_failed(sys.exc_info()[1])
+
+    def _send_failed(self, e):
+        error = _stream_error(e, self._recv_reply)
+        self.abort()
+        raise error
+
+    def _recv_reply(self):
+        line = _ResponseReader(self.clamd_socket).readline(self.client._terminator())
+        return '' if line is None else _decode(line).strip()
 
 
 class ClamdUnixSocket(ClamdNetworkSocket):
     """
     Class for using clamd with an unix socket
     """
-    def __init__(self, path="/var/run/clamav/clamd.ctl", timeout=None):
+    def __init__(self, path="/var/run/clamav/clamd.ctl", timeout=None, connect_timeout=None, deadline=None,
+                 stream_max_length=None):
         """
         class initialisation
 
         path (string) : unix socket path
         timeout (float or None) : socket timeout
+        connect_timeout (float or None) : timeout for connecting, defaults to timeout
+        deadline (float or None) : maximum duration of a whole command,
+                                   including the FILDES or INSTREAM upload and the reply
+        stream_max_length (int or None) : StreamMaxLength of clamd in bytes,
+                                          learned from BufferTooLongError
+                                          when None, see _scan_stream()
         """
 
         self.unix_socket = path
         self.timeout = timeout
-
-    def _init_socket(self):
+        self.connect_timeout = connect_timeout
+        self.deadline = deadline
+        self.stream_max_length = stream_max_length
+        self.stream_routes = collections.Counter()
+        self._learned_max_length = None
+        self._accepted_length = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _connect(self, deadline_at=None):
         """
         internal use only
+
+        return: a new socket connected to clamd
         """
+        timeout = self._connect_timeout(deadline_at)
+        clamd_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         try:
-            self.clamd_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-            self.clamd_socket.connect(self.unix_socket)
-            self.clamd_socket.settimeout(self.timeout)
+            clamd_socket.settimeout(timeout)
+            clamd_socket.connect(self.unix_socket)
+            clamd_socket.settimeout(self.timeout)
+            return clamd_socket
         except socket.error:
             e = sys.exc_info()[1]
+            clamd_socket.close()
             raise ConnectionError(self._error_message(e))
 
+    def _endpoint(self):
+        return 'unix:{0}'.format(self.unix_socket)
+
+    @_traced
+    def fildes(self, fileobj_or_fd):
+        """
+        Scan an open file by passing its descriptor to clamd (FILDES)
+
+        clamd reads the file directly, so it does not need permission to open
+        the path and no data is copied through the socket. The caller keeps
+        ownership of the file.
+
+        fileobj_or_fd (file like object or int) : open file to scan
+
+        return:
+          - (dict): {'fd[N]': ('FOUND', 'virusname')}
+
+        May raise:
+          - ClamdError: if this python cannot pass file descriptors (python 2)
+          - ResponseError: if clamd cannot scan the descriptor
+          - ConnectionError: in case of communication problem
+        """
+        _check_fildes()
+        try:
+            self._init_socket()
+            self._send_command('FILDES')
+            trace = self._current_trace()
+            if trace is not None:
+                start = _clock()
+            try:
+                _send_fd(self._deadline_socket(), _fileno(fileobj_or_fd))
+            except socket.error:
+                e = sys.exc_info()[1]
+                raise ConnectionError("Error while writing to socket: {0}".format(e.args))
+            if trace is not None:
+                trace.phase('send', start, sent=1)
+
+            filename, reason, status = self._parse_scan_reply(self._recv_response())
+            return {filename: (status, reason)}
+        finally:
+            self._close_socket()
+
     def _error_message(self, exception):
         # args for socket.error can either be (errno, "message")
         # or just "message"
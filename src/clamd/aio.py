@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+asyncio clients for clamd, python 3.6+ only
+"""
+
+import asyncio
+import mmap
+import socket
+import struct
+
+import clamd
+from clamd import ResponseError, BufferTooLongError, ConnectionError
+
+
+class AsyncClamdNetworkSocket(object):
+    """
+    Class for using clamd with a network socket from asyncio code
+
+    Every method is a coroutine and opens its own connection, so one instance
+    can be shared by any number of concurrent tasks.
+    """
+    chunk_size = clamd.ClamdNetworkSocket.chunk_size
+    command_mode = clamd.ClamdNetworkSocket.command_mode
+
+    def __init__(self, host='127.0.0.1', port=3310, timeout=None):
+        """
+        class initialisation
+
+        host (string) : hostname or ip address
+        port (int) : TCP port
+        timeout (float or None) : timeout for connecting and for each read
+        """
+
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    _error_message = clamd.ClamdNetworkSocket._error_message
+    _parse_response = clamd.ClamdNetworkSocket._parse_response
+    _terminator = clamd.ClamdNetworkSocket._terminator
+
+    def _open_connection(self):
+        return asyncio.open_connection(self.host, self.port)
+
+    async def _connect(self):
+        """
+        internal use only
+
+        return: (reader, writer) streams connected to clamd
+        """
+        try:
+            return await asyncio.wait_for(self._open_connection(), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            if not e.args:
+                e = OSError("timed out")
+            raise ConnectionError(self._error_message(e))
+
+    async def ping(self):
+        return await self._basic_command("PING")
+
+    async def version(self):
+        return await self._basic_command("VERSION")
+
+    async def reload(self):
+        return await self._basic_command("RELOAD")
+
+    async def shutdown(self):
+        """
+        Force Clamd to shutdown and exit
+
+        return: nothing
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        reader, writer = await self._connect()
+        try:
+            await self._send_command(writer, 'SHUTDOWN')
+        finally:
+            writer.close()
+
+    async def scan(self, file):
+        return await self._file_system_scan('SCAN', file)
+
+    async def contscan(self, file):
+        return await self._file_system_scan('CONTSCAN', file)
+
+    async def multiscan(self, file):
+        return await self._file_system_scan('MULTISCAN', file)
+
+    async def allmatchscan(self, file):
+        """
+        Scan a file or directory given by filename, reporting every signature
+        that matches, see clamd.ClamdNetworkSocket.allmatchscan()
+
+        return:
+          - (dict): {filename1: (('FOUND', 'virus1'), ('FOUND', 'virus2')), filename2: (('ERROR', 'reason'),)}
+        """
+        results = {}
+        for filename, matches in clamd._group_matches(await self._scan_replies('ALLMATCHSCAN', file)):
+            results[filename] = results.get(filename, ()) + matches
+        return results
+
+    async def _basic_command(self, command):
+        """
+        Send a command to the clamav server, and return the reply.
+        """
+        reader, writer = await self._connect()
+        try:
+            await self._send_command(writer, command)
+            response = (await self._recv_response(reader)).rsplit("ERROR", 1)
+            if len(response) > 1:
+                raise ResponseError(response[0])
+            else:
+                return response[0]
+        finally:
+            writer.close()
+
+    async def _file_system_scan(self, command, file):
+        """
+        Scan a file or directory given by filename
+
+        file (string): filename or directory (MUST BE ABSOLUTE PATH !)
+
+        return:
+          - (dict): {filename1: ('FOUND', 'virusname'), filename2: ('ERROR', 'reason')}
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        return dict(await self._scan_replies(command, file))
+
+    async def _scan_replies(self, command, file):
+        """
+        return: (list) the (filename, (status, reason)) results of a scan command, in order
+        """
+        reader, writer = await self._connect()
+        try:
+            await self._send_command(writer, command, file)
+
+            results = []
+            terminator = self._terminator()
+            while True:
+                result = await self._recv(_readuntil(reader, terminator))
+                if not result:
+                    if reader.at_eof():
+                        return results
+                    continue
+                filename, reason, status = self._parse_response(clamd._decode(result))
+                if isinstance(file, bytes):
+                    filename = clamd._encode_path(filename)
+                results.append((filename, (status, reason)))
+        finally:
+            writer.close()
+
+    async def instream(self, buff, chunk_size=None):
+        """
+        Scan a buffer
+
+        buff : data to scan, one of
+          - bytes, bytearray, memoryview or mmap
+          - a file like object, with a plain or a coroutine read() method
+            (e.g. asyncio.StreamReader)
+          - an iterable or async iterable of bytes chunks
+        chunk_size (int or None) : size of the chunks sent to clamd, defaults
+                                   to self.chunk_size
+
+        return:
+          - (dict): {filename1: ("virusname", "status")}
+
+        May raise :
+          - BufferTooLongError: if the buffer size exceeds clamd limits
+          - ConnectionError: in case of communication problem
+        """
+        reader, writer = await self._connect()
+        try:
+            await self._send_command(writer, 'INSTREAM')
+
+            max_chunk_size = chunk_size or self.chunk_size
+
+            # clamd drops the connection once StreamMaxLength is exceeded,
+            # asyncio then closes the socket before its reply is read: keep a
+            # duplicate descriptor to read it from
+            raw = writer.get_extra_info('socket')
+            spare = socket.fromfd(raw.fileno(), raw.family, raw.type) if raw is not None else None
+            try:
+                async for chunk in _iter_chunks(buff, max_chunk_size):
+                    chunk = clamd._byte_view(chunk)
+                    for start in range(0, len(chunk), max_chunk_size):
+                        part = chunk[start:start + max_chunk_size]
+                        writer.write(struct.pack(b'!L', len(part)))
+                        writer.write(part)
+                        # at most one chunk waits in the transport
+                        await self._drain(writer)
+
+                writer.write(struct.pack(b'!L', 0))
+                await self._drain(writer)
+            except ConnectionError as e:
+                raise clamd._stream_error(e, lambda: _recv_leftover(spare))
+            finally:
+                if spare is not None:
+                    spare.close()
+
+            result = await self._recv_response(reader)
+
+            if len(result) > 0:
+                if result == 'INSTREAM size limit exceeded. ERROR':
+                    raise BufferTooLongError(result)
+
+                filename, reason, status = self._parse_response(result)
+                return {filename: (status, reason)}
+        finally:
+            writer.close()
+
+    async def stats(self):
+        """
+        Get Clamscan stats
+
+        return: (string) clamscan stats
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        reader, writer = await self._connect()
+        try:
+            await self._send_command(writer, 'STATS')
+            return await self._recv_response_multiline(reader)
+        finally:
+            writer.close()
+
+    async def _send_command(self, writer, cmd, *args):
+        writer.write(clamd._encode_command(self.command_mode, cmd, *args))
+        await self._drain(writer)
+
+    async def _drain(self, writer):
+        try:
+            await asyncio.wait_for(writer.drain(), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise ConnectionError("Error while writing to socket: {0}".format(e.args))
+
+    async def _recv_response(self, reader):
+        """
+        receive line from clamd
+        """
+        line = await self._recv(_readuntil(reader, self._terminator()))
+        return clamd._decode(line).strip()
+
+    async def _recv_response_multiline(self, reader):
+        """
+        receive multiple line response from clamd
+        """
+        data = await self._recv(reader.read())
+        return clamd._decode(data).replace('\0', '\n')
+
+    async def _recv(self, read):
+        try:
+            return await asyncio.wait_for(read, self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise ConnectionError("Error while reading from socket: {0}".format(e.args))
+
+
+class AsyncClamdUnixSocket(AsyncClamdNetworkSocket):
+    """
+    Class for using clamd with an unix socket from asyncio code
+    """
+    def __init__(self, path="/var/run/clamav/clamd.ctl", timeout=None):
+        """
+        class initialisation
+
+        path (string) : unix socket path
+        timeout (float or None) : timeout for connecting and for each read
+        """
+
+        self.unix_socket = path
+        self.timeout = timeout
+
+    _error_message = clamd.ClamdUnixSocket._error_message
+
+    def _open_connection(self):
+        return asyncio.open_unix_connection(self.unix_socket)
+
+
+async def _iter_chunks(buff, chunk_size):
+    """
+    yield the content of any supported INSTREAM source as bytes like chunks
+    """
+    if isinstance(buff, (bytes, bytearray, memoryview, mmap.mmap)):
+        yield buff
+    elif hasattr(buff, 'read'):
+        while True:
+            chunk = buff.read(chunk_size)
+            if asyncio.iscoroutine(chunk) or isinstance(chunk, asyncio.Future):
+                chunk = await chunk
+            if not chunk:
+                break
+            yield chunk
+    elif hasattr(buff, '__aiter__'):
+        async for chunk in buff:
+            yield chunk
+    else:
+        for chunk in buff:
+            yield chunk
+
+
+def _recv_leftover(sock):
+    """
+    return the first line left unread on a socket, '' if there is none
+    """
+    if sock is None:
+        return ''
+    try:
+        sock.setblocking(False)
+        data = sock.recv(4096)
+    except OSError:
+        return ''
+    return data.replace(b'\0', b'\n').split(b'\n', 1)[0].decode('utf-8', 'replace').strip()
+
+
+async def _readuntil(reader, terminator):
+    """
+    read up to terminator, or to the end of the stream, without the terminator
+
+    May raise:
+      - ResponseError: if the line does not fit in the reader's buffer limit
+    """
+    try:
+        return (await reader.readuntil(terminator))[:-1]
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+    except asyncio.LimitOverrunError:
+        raise ResponseError("Reply line longer than the stream reader limit")
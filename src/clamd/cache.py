@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import collections
+import hashlib
+import mmap
+import os
+import threading
+import time
+
+import clamd
+from clamd import BufferTooLongError, ClamdUnixSocket, parse_version
+
+_now = getattr(time, 'monotonic', time.time)
+
+# rough memory held by one entry besides its reason string: key, tuple,
+# OrderedDict node
+_ENTRY_OVERHEAD = 200
+
+
+class ScanCache(object):
+    """
+    Thread-safe LRU cache of scan verdicts keyed by content digest
+
+    Entries belong to one signature database version; setting a different
+    version empties the cache.
+    """
+    def __init__(self, max_entries=100000, max_bytes=32 * 1024 * 1024):
+        """
+        class initialisation
+
+        max_entries (int) : maximum number of cached verdicts
+        max_bytes (int) : maximum estimated memory used by the cached verdicts
+        """
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        """
+        estimated memory used by the cached verdicts, in bytes
+        """
+        return self._bytes
+
+    def get(self, digest):
+        """
+        return: ((status, reason) or None) the cached verdict for digest
+        """
+        with self._lock:
+            verdict = self._entries.get(digest)
+            if verdict is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return verdict
+
+    def set(self, digest, verdict, version=None):
+        """
+        Cache a verdict
+
+        digest (bytes) : content digest
+        verdict (tuple) : (status, reason)
+        version (string or None) : signature version the verdict was obtained
+                                   with, if it is no longer the current one
+                                   the verdict is not cached
+        """
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            if digest in self._entries:
+                self._bytes -= self._entry_size(digest, self._entries.pop(digest))
+            self._entries[digest] = verdict
+            self._bytes += self._entry_size(digest, verdict)
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                old_digest, old_verdict = self._entries.popitem(last=False)
+                self._bytes -= self._entry_size(old_digest, old_verdict)
+
+    def set_version(self, version):
+        """
+        Record the current signature version, emptying the cache if it changed
+
+        return: (bool) True if the cache was emptied
+        """
+        with self._lock:
+            if version == self.version:
+                return False
+            self.version = version
+            self._entries.clear()
+            self._bytes = 0
+            return True
+
+    def metrics(self):
+        """
+        return: (dict) cache counters, see clamd.stats.StatsPoller
+        """
+        return {
+            'cache_entries': len(self._entries),
+            'cache_bytes': self._bytes,
+            'cache_hits_total': self.hits,
+            'cache_misses_total': self.misses,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _entry_size(self, digest, verdict):
+        return _ENTRY_OVERHEAD + len(digest) + len(verdict[1] or '')
+
+
+class CachingClamd(object):
+    """
+    Serve repeated scans of identical content from a ScanCache
+
+    Wraps a client (ClamdNetworkSocket, ClamdUnixSocket, ClamdPool, ...):
+    instream(), instream_path(), scan() and fildes() hash the content first
+    and only ask clamd about content they have not seen with the current
+    signature database. A verdict is only cached under the digest of the
+    exact bytes clamd scanned: files are hashed and sent from the same open
+    descriptor or mapping, streams are hashed again as they are sent. The
+    database version from VERSION is checked at most
+    every version_check_interval seconds, and the cache is emptied when it
+    changes. Other methods are passed to the client unchanged.
+    """
+    def __init__(self, client, cache=None, version_check_interval=60, cache_errors=False, hash_name='sha256'):
+        """
+        class initialisation
+
+        client : client used for cache misses
+        cache (ScanCache or None) : cache to use, a new one by default
+        version_check_interval (float) : seconds between VERSION checks
+        cache_errors (bool) : also cache ERROR verdicts
+        hash_name (string) : hashlib algorithm used to key the content
+        """
+
+        self.client = client
+        self.cache = ScanCache() if cache is None else cache
+        self.version_check_interval = version_check_interval
+        self.cache_errors = cache_errors
+        self.hash_name = hash_name
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def check_version(self, force=False):
+        """
+        Ask clamd for its signature version if the last check is older than
+        version_check_interval, and empty the cache if it changed
+
+        return: (string) current signature version
+        """
+        with self._lock:
+            now = _now()
+            if force or self._checked_at is None or now - self._checked_at >= self.version_check_interval:
+                engine, signatures, signatures_date = parse_version(self.client.version())
+                self.cache.set_version('{0}/{1}'.format(signatures, signatures_date))
+                self._checked_at = now
+            return self.cache.version
+
+    def instream(self, buff):
+        """
+        Scan a buffer, see ClamdNetworkSocket.instream()
+
+        bytes-like objects are hashed in place, other file like objects are
+        read into memory. Seekable file like objects are hashed then rewound
+        to look the verdict up; on a miss the content is hashed again while it
+        is streamed to clamd, and the verdict is cached under that digest, in
+        case the file changed in between.
+        """
+        if hasattr(buff, 'read') and not isinstance(buff, mmap.mmap):
+            if _seekable(buff):
+                start = buff.tell()
+                digest = self._hash_file(buff)
+                buff.seek(start)
+                return self._cached_stream(digest, buff)
+            else:
+                buff = buff.read()
+                digest = self._hash_bytes(buff)
+        else:
+            digest = self._hash_bytes(buff)
+        return self._cached('stream', digest, self.client.instream, buff)
+
+    def instream_path(self, path):
+        with open(path, 'rb') as f:
+            with _mapped(f) as data:
+                return self._cached('stream', self._hash_bytes(data), self.client.instream, data)
+
+    def scan(self, file):
+        """
+        Scan a file, see ClamdNetworkSocket.scan()
+
+        Only clamd reached over a unix socket sees the same file as this
+        process: the file is then hashed and, on a cache miss, passed to clamd
+        with FILDES or INSTREAM from the same descriptor. Remote clamd,
+        directories, files the client cannot open and files over
+        StreamMaxLength are scanned with SCAN, uncached.
+        """
+        if os.path.isdir(file) or not _local(self.client):
+            return self.client.scan(file)
+        try:
+            f = open(file, 'rb')
+        except (IOError, OSError):
+            return self.client.scan(file)
+        with f:
+            if _supports_fildes(self.client):
+                digest = self._hash_mapped(f)
+                return self._cached(file, digest, _renamed, file, self.client.fildes, f)
+            with _mapped(f) as data:
+                try:
+                    return self._cached(file, self._hash_bytes(data), _renamed, file, self.client.instream, data)
+                except BufferTooLongError:
+                    return self.client.scan(file)
+
+    def fildes(self, fileobj_or_fd):
+        fd = fileobj_or_fd.fileno() if hasattr(fileobj_or_fd, 'fileno') else fileobj_or_fd
+        with os.fdopen(os.dup(fd), 'rb') as f:
+            digest = self._hash_mapped(f)
+        return self._cached('fd[{0}]'.format(fd), digest, self.client.fildes, fileobj_or_fd)
+
+    def _cached(self, filename, digest, scan, *args):
+        """
+        return the cached verdict for digest as a scan result, or run scan(*args)
+        """
+        version = self.check_version()
+        verdict = self.cache.get(digest)
+        if verdict is not None:
+            return {filename: verdict}
+
+        result = scan(*args)
+        self._store(digest, result, version)
+        return result
+
+    def _cached_stream(self, digest, f):
+        """
+        return the cached verdict for digest, or scan f with instream() and
+        cache the verdict under the digest of what was sent
+        """
+        version = self.check_version()
+        verdict = self.cache.get(digest)
+        if verdict is not None:
+            return {'stream': verdict}
+
+        reader = _HashingReader(f, self.hash_name)
+        result = self.client.instream(reader)
+        self._store(reader.digest(), result, version)
+        return result
+
+    def _store(self, digest, result, version):
+        verdict = list(result.values())[0]
+        if verdict[0] != 'ERROR' or self.cache_errors:
+            self.cache.set(digest, verdict, version)
+
+    def _hash_bytes(self, data):
+        return hashlib.new(self.hash_name, data).digest()
+
+    def _hash_file(self, f):
+        h = hashlib.new(self.hash_name)
+        chunk = f.read(1024 * 1024)
+        while chunk:
+            h.update(chunk)
+            chunk = f.read(1024 * 1024)
+        return h.digest()
+
+    def _hash_mapped(self, f):
+        """
+        hash a regular file through mmap, without reading it into Python
+        """
+        if not os.fstat(f.fileno()).st_size:
+            return self._hash_bytes(b'')
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return self._hash_bytes(mapped)
+        finally:
+            mapped.close()
+
+
+class _HashingReader(object):
+    """
+    file like object hashing what is read from f
+    """
+    def __init__(self, f, hash_name):
+        self.f = f
+        self.hash = hashlib.new(hash_name)
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.hash.update(data)
+        return data
+
+    def digest(self):
+        return self.hash.digest()
+
+
+class _mapped(object):
+    """
+    read-only mapping of an open regular file, b'' for an empty one
+    """
+    def __init__(self, f):
+        self.f = f
+        self.mapped = None
+
+    def __enter__(self):
+        if not os.fstat(self.f.fileno()).st_size:
+            return b''
+        self.mapped = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mapped
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.mapped is not None:
+            self.mapped.close()
+
+
+def _supports_fildes(client):
+    """
+    True if client reaches clamd over a unix socket and this python can pass file descriptors
+    """
+    return clamd._FILDES_SUPPORTED and _local(client)
+
+
+def _local(client):
+    """
+    True if client reaches clamd over a unix socket, directly or through a pool or cluster
+    """
+    nodes = getattr(client, 'nodes', None)
+    if nodes is not None:
+        return all(isinstance(node.client, ClamdUnixSocket) for node in nodes)
+    return isinstance(getattr(client, 'client', client), ClamdUnixSocket)
+
+
+def _renamed(filename, scan, *args):
+    """
+    result of scan(*args), reported under filename
+    """
+    result = scan(*args)
+    return {filename: list(result.values())[0]}
+
+
+def _seekable(f):
+    try:
+        return f.seekable()
+    except AttributeError:
+        return hasattr(f, 'seek') and hasattr(f, 'tell')
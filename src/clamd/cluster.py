@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import mmap
+import random
+import sys
+import threading
+import time
+
+from clamd import ClamdError, ClamdNetworkSocket, ClamdUnixSocket, ConnectionError
+from clamd.pool import ClamdPool
+
+_now = getattr(time, 'monotonic', time.time)
+
+
+class ClamdNode(object):
+    """
+    One clamd daemon of a ClamdCluster
+    """
+    def __init__(self, client, pool_size=10):
+        """
+        class initialisation
+
+        client (ClamdNetworkSocket or ClamdUnixSocket) : client of the daemon
+        pool_size (int) : maximum number of open connections to the daemon
+        """
+
+        self.client = client
+        self.pool = ClamdPool(client, maxsize=pool_size)
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.up = True
+        self.reloading = False
+        self.retry_at = None
+
+    def __repr__(self):
+        if isinstance(self.client, ClamdUnixSocket):
+            return '<ClamdNode unix:{0}>'.format(self.client.unix_socket)
+        return '<ClamdNode {0}:{1}>'.format(self.client.host, self.client.port)
+
+
+class ClamdCluster(object):
+    """
+    Spread scans over several clamd daemons
+
+    Every scan goes to the node with the fewest outstanding requests, or to
+    the better of two random nodes with strategy='power_of_two'. A node that
+    is busy (during a RELOAD for instance) accumulates outstanding requests
+    and so receives less work until it catches up.
+
+    A node is taken out on ConnectionError or a failed PING, and PINGed again
+    after down_interval seconds before it gets scans again. That PING is sent
+    by check(), from the health thread when start() was called or else from a
+    short lived thread, never from the thread of a scan. Idempotent
+    commands that fail with ConnectionError are retried on other nodes, up to
+    `retries` times. When every node is down, all of them are tried anyway.
+    """
+    def __init__(self, endpoints, strategy='least_outstanding', retries=2, down_interval=5, pool_size=10,
+                 timeout=None):
+        """
+        class initialisation
+
+        endpoints (list) : clients, or endpoint strings as accepted by endpoint_client()
+        strategy (string) : 'least_outstanding' or 'power_of_two'
+        retries (int) : number of other nodes an idempotent command is retried on
+        down_interval (float) : seconds before a node that went down is checked again
+        pool_size (int) : maximum number of open connections per node
+        timeout (float or None) : socket timeout of the clients created from strings
+        """
+
+        if strategy not in ('least_outstanding', 'power_of_two'):
+            raise ValueError("Unknown strategy: {0}".format(strategy))
+        self.nodes = [ClamdNode(endpoint_client(endpoint, timeout), pool_size) for endpoint in endpoints]
+        if not self.nodes:
+            raise ValueError("No clamd endpoint")
+        self.strategy = strategy
+        self.retries = retries
+        self.down_interval = down_interval
+        self.failovers = 0
+        self._turn = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.stop()
+        for node in self.nodes:
+            node.pool.close()
+
+    def check(self):
+        """
+        PING every node, taking out the ones that do not answer and bringing
+        back the ones that do
+
+        return: (int) number of nodes up
+        """
+        for node in self.nodes:
+            self._probe(node)
+        return sum(node.up for node in self.nodes)
+
+    def start(self, interval=5):
+        """
+        Run check() every interval seconds in a daemon thread
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name='clamd-cluster-health')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            self.check()
+
+    def metrics(self):
+        """
+        return: (dict) cluster counters, see clamd.stats.StatsPoller
+        """
+        return {
+            'cluster_nodes': len(self.nodes),
+            'cluster_nodes_up': sum(node.up for node in self.nodes),
+            'cluster_outstanding': sum(node.outstanding for node in self.nodes),
+            'cluster_requests_total': sum(node.requests for node in self.nodes),
+            'cluster_node_failures_total': sum(node.failures for node in self.nodes),
+            'cluster_failovers_total': self.failovers,
+        }
+
+    def ping(self):
+        return self._call('ping', (), self.retries)
+
+    def version(self):
+        return self._call('version', (), self.retries)
+
+    def stats(self):
+        return self._call('stats', (), self.retries)
+
+    def reload(self, timeout=300, interval=1):
+        """
+        Ask the nodes to reload their signature database, one at a time
+
+        A node gets no scans from the moment it is asked to reload until it
+        answers PING again, then the next node is reloaded, so that the other
+        nodes keep serving. A node that does not answer within timeout
+        seconds is taken out. Nodes that cannot be reached are skipped.
+
+        timeout (float) : seconds to wait for each node to answer PING again
+        interval (float) : seconds between two PINGs of a reloading node
+
+        May raise:
+          - ConnectionError: if no node could be reached
+        """
+        error = None
+        reloaded = 0
+        for node in self.nodes:
+            with self._lock:
+                node.reloading = True
+            try:
+                self._call_node(node, 'reload', ())
+                reloaded += 1
+                self._wait_ready(node, timeout, interval)
+            except ConnectionError:
+                error = sys.exc_info()[1]
+            finally:
+                with self._lock:
+                    node.reloading = False
+        if not reloaded:
+            raise error
+
+    def _wait_ready(self, node, timeout, interval):
+        """
+        PING a node until it answers, taking it out after timeout seconds
+        """
+        deadline = _now() + timeout
+        while True:
+            try:
+                node.pool.ping()
+                return
+            except ClamdError:
+                if _now() >= deadline:
+                    self._mark_down(node)
+                    return
+            time.sleep(interval)
+
+    def scan(self, file):
+        return self._call('scan', (file,), self.retries)
+
+    def contscan(self, file):
+        return self._call('contscan', (file,), self.retries)
+
+    def multiscan(self, file):
+        return self._call('multiscan', (file,), self.retries)
+
+    def allmatchscan(self, file):
+        return self._call('allmatchscan', (file,), self.retries)
+
+    def instream(self, buff):
+        """
+        Scan a buffer, see ClamdNetworkSocket.instream()
+
+        The scan is only retried on another node if buff can be sent again:
+        bytes-like objects and seekable file like objects.
+        """
+        start = _stream_start(buff)
+        if start is None:
+            return self._call('instream', (buff,), 0)
+
+        def rewind():
+            if start is not True:
+                buff.seek(start)
+
+        return self._call('instream', (buff,), self.retries, rewind)
+
+    def instream_path(self, path):
+        return self._call('instream_path', (path,), self.retries)
+
+    def fildes(self, fileobj_or_fd):
+        """
+        Pass an open file descriptor to a node reached over a unix socket, see
+        ClamdUnixSocket.fildes()
+
+        May raise:
+          - ClamdError: if no node is reached over a unix socket
+        """
+        nodes = [node for node in self.nodes if isinstance(node.client, ClamdUnixSocket)]
+        if not nodes:
+            raise ClamdError("FILDES needs a clamd node reached over a unix socket")
+        return self._call('fildes', (fileobj_or_fd,), self.retries, nodes=nodes)
+
+    def _call(self, method, args, retries, rewind=None, nodes=None):
+        """
+        run method on the chosen node, failing over to other nodes on ConnectionError
+        """
+        tried = []
+        while True:
+            node = self._pick(nodes or self.nodes, tried)
+            try:
+                return self._call_node(node, method, args)
+            except ConnectionError:
+                tried.append(node)
+                if len(tried) > retries or len(tried) == len(nodes or self.nodes):
+                    raise
+                with self._lock:
+                    self.failovers += 1
+                if rewind is not None:
+                    rewind()
+
+    def _call_node(self, node, method, args):
+        with self._lock:
+            node.outstanding += 1
+            node.requests += 1
+        try:
+            return getattr(node.pool, method)(*args)
+        except ConnectionError:
+            self._mark_down(node)
+            raise
+        finally:
+            with self._lock:
+                node.outstanding -= 1
+
+    def _pick(self, nodes, tried):
+        """
+        choose the node for the next command among nodes that were not tried yet
+        """
+        now = _now()
+        probe = None
+        with self._lock:
+            candidates = [node for node in nodes if node not in tried]
+            up = [node for node in candidates if node.up]
+            ready = [node for node in up if not node.reloading]
+            for node in candidates:
+                if not node.up and node.retry_at <= now:
+                    # one probe per node and per down_interval
+                    node.retry_at = now + self.down_interval
+                    probe = node
+                    break
+        if probe is not None and self._thread is None:
+            # the caller does not wait for a node that may not answer
+            thread = threading.Thread(target=self._probe, args=(probe,), name='clamd-cluster-probe')
+            thread.daemon = True
+            thread.start()
+        # every node is down or reloading: try them all rather than fail
+        up = ready or up or candidates
+        if self.strategy == 'power_of_two' and len(up) > 2:
+            up = random.sample(up, 2)
+        else:
+            # rotate so that ties are broken round-robin
+            self._turn = (self._turn + 1) % len(up)
+            up = up[self._turn:] + up[:self._turn]
+        return min(up, key=lambda node: node.outstanding)
+
+    def _probe(self, node):
+        """
+        PING a node and record whether it is up
+
+        return: (bool) True if the node answered
+        """
+        try:
+            node.pool.ping()
+        except ClamdError:
+            self._mark_down(node)
+            return False
+        with self._lock:
+            node.up = True
+        return True
+
+    def _mark_down(self, node):
+        with self._lock:
+            node.failures += 1
+            node.up = False
+            node.retry_at = _now() + self.down_interval
+
+
+def endpoint_client(endpoint, timeout=None):
+    """
+    Build a client from an endpoint description
+
+    endpoint : a client object, returned as is, or one of
+      - 'unix:/path/to/clamd.ctl' or '/path/to/clamd.ctl' : unix socket
+      - 'host:port', '[ipv6]:port' or 'host' : TCP, port 3310 by default
+      - (host, port) : TCP
+    timeout (float or None) : socket timeout
+
+    return: (ClamdNetworkSocket or ClamdUnixSocket)
+    """
+    if isinstance(endpoint, ClamdNetworkSocket):
+        return endpoint
+    if isinstance(endpoint, tuple):
+        return ClamdNetworkSocket(endpoint[0], int(endpoint[1]), timeout=timeout)
+    if endpoint.startswith('unix:'):
+        return ClamdUnixSocket(endpoint[len('unix:'):], timeout=timeout)
+    if endpoint.startswith('/'):
+        return ClamdUnixSocket(endpoint, timeout=timeout)
+    host, port = endpoint, 3310
+    if endpoint.startswith('['):
+        host, _, rest = endpoint[1:].partition(']')
+        if rest.startswith(':'):
+            port = rest[1:]
+    elif endpoint.count(':') == 1:
+        host, _, port = endpoint.partition(':')
+    try:
+        return ClamdNetworkSocket(host, int(port), timeout=timeout)
+    except ValueError:
+        raise ValueError("Invalid clamd endpoint {0!r}: {1}".format(endpoint, sys.exc_info()[1]))
+
+
+def _stream_start(buff):
+    """
+    return True for bytes-like objects, the current position of seekable file
+    like objects, None if buff cannot be sent twice
+    """
+    if isinstance(buff, mmap.mmap) or not hasattr(buff, 'read'):
+        return True
+    try:
+        if buff.seekable():
+            return buff.tell()
+    except AttributeError:
+        pass
+    return None
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+persistent incremental scan index, python 3.6+ only
+"""
+
+import os
+import sqlite3
+import time
+
+from clamd import parse_version
+from clamd.tree import scan_files, walk_files
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path BLOB PRIMARY KEY,
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ctime_ns INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    reason TEXT,
+    signatures TEXT NOT NULL,
+    scanned_at REAL NOT NULL
+)
+"""
+
+
+class ScanIndex(object):
+    """
+    On-disk record of the last verdict of every scanned file, in SQLite
+
+    A file is only scanned again when its device, inode, size, mtime or ctime
+    changed, when its last scan was made with another signature database, or
+    when its last scan ended with an ERROR.
+    """
+    def __init__(self, path, commit_every=1000):
+        """
+        class initialisation
+
+        path (string) : SQLite database file, created if missing
+        commit_every (int) : number of recorded verdicts per transaction
+        """
+
+        self.path = path
+        self.commit_every = commit_every
+        self.scanned = 0
+        self.cached = 0
+        self._uncommitted = 0
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(_SCHEMA)
+        self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._db.execute("SELECT count(*) FROM files").fetchone()[0]
+
+    def close(self):
+        self.commit()
+        self._db.close()
+
+    def commit(self):
+        self._db.commit()
+        self._uncommitted = 0
+
+    def lookup(self, path, st, signatures):
+        """
+        return: ((status, reason) or None) the recorded verdict of path, None
+                if the file changed or was scanned with other signatures
+        """
+        row = self._db.execute(
+            "SELECT dev, ino, size, mtime_ns, ctime_ns, status, reason, signatures FROM files WHERE path = ?",
+            (os.fsencode(path),)).fetchone()
+        if row is None or row[5] == 'ERROR' or row[7] != signatures:
+            return None
+        if row[:5] != (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns):
+            return None
+        return row[5], row[6]
+
+    def record(self, path, st, verdict, signatures):
+        """
+        Store the verdict of a scanned file
+
+        path (string) : scanned file
+        st (os.stat_result) : stat of the file taken before it was scanned
+        verdict (tuple) : (status, reason)
+        signatures (string) : signature version the file was scanned with
+        """
+        self._db.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (os.fsencode(path), st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns,
+             verdict[0], verdict[1], signatures, time.time()))
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self.commit()
+
+    def prune(self, top=None):
+        """
+        Forget files that no longer exist
+
+        top (string or None) : only check files below this directory
+
+        return: (int) number of forgotten files
+        """
+        query = "SELECT path FROM files"
+        args = ()
+        if top is not None:
+            prefix = os.fsencode(os.path.join(top, ''))
+            query += " WHERE substr(path, 1, ?) = ?"
+            args = (len(prefix), prefix)
+        gone = [(path,) for (path,) in self._db.execute(query, args) if not os.path.lexists(path)]
+        self._db.executemany("DELETE FROM files WHERE path = ?", gone)
+        self.commit()
+        return len(gone)
+
+    def scan(self, client, top, max_workers=8, method=None, progress=None, **filters):
+        """
+        Scan a directory tree, only submitting new and changed files to clamd
+
+        Takes the same arguments as clamd.tree.scan_tree(). Every file of the
+        tree is reported, unchanged ones with their recorded verdict. When the
+        signature database changed since the last scan, everything is scanned
+        again. After the scan, self.scanned and self.cached hold the number
+        of files scanned and served from the index.
+
+        return:
+          - (generator): (filename, (status, reason))
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        engine, signatures, signatures_date = parse_version(client.version())
+        signatures = '{0}/{1}'.format(signatures, signatures_date)
+        self.scanned = self.cached = 0
+
+        def lookup(path, st):
+            verdict = self.lookup(path, st, signatures)
+            if verdict is not None:
+                self.cached += 1
+            return verdict
+
+        def on_result(path, st, verdict):
+            self.scanned += 1
+            self.record(path, st, verdict, signatures)
+
+        try:
+            for result in scan_files(client, walk_files(top, **filters), max_workers=max_workers, method=method,
+                                     progress=progress, lookup=lookup, on_result=on_result):
+                yield result
+        finally:
+            self.commit()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+WSGI and ASGI middleware scanning request bodies, python 3.6+ only
+"""
+
+import tempfile
+
+from clamd import BufferTooLongError, ClamdError
+from clamd.cluster import ClamdCluster
+from clamd.pool import ClamdPool
+
+# bytes of request body kept in memory for the application, beyond that the
+# body is spooled to a temporary file
+MAX_MEMORY = 1024 * 1024
+
+
+class ClamdWSGIMiddleware(object):
+    """
+    Scan request bodies with clamd before handing them to a WSGI application
+
+    The body is streamed to clamd chunk by chunk as it is read from the
+    client, and copied to a buffer that is replayed to the application as
+    wsgi.input, kept in memory up to max_memory bytes and spooled to disk
+    beyond that. Requests are rejected with 403 when the body is infected,
+    413 when it exceeds clamd's StreamMaxLength and 503 when clamd cannot be
+    reached (unless fail_open is set). The verdict is available to the
+    application as environ['clamd.result'].
+    """
+    def __init__(self, app, client, max_memory=MAX_MEMORY, fail_open=False, chunk_size=64 * 1024):
+        """
+        class initialisation
+
+        app : WSGI application
+        client (ClamdNetworkSocket, ClamdUnixSocket, ClamdPool or ClamdCluster) :
+            clamd to use, plain clients are wrapped in a ClamdPool
+        max_memory (int) : bytes of body kept in memory per request
+        fail_open (bool) : pass requests to the application unscanned when
+                           clamd cannot be reached
+        chunk_size (int) : size of the reads from the client
+        """
+
+        if not isinstance(client, (ClamdPool, ClamdCluster)):
+            client = ClamdPool(client)
+        self.app = app
+        self.client = client
+        self.max_memory = max_memory
+        self.fail_open = fail_open
+        self.chunk_size = chunk_size
+
+    def __call__(self, environ, start_response):
+        length = _content_length(environ)
+        if not length and not _chunked(environ):
+            return self.app(environ, start_response)
+
+        body = tempfile.SpooledTemporaryFile(max_size=self.max_memory)
+        # chunked bodies have no length and are read to the end
+        reader = _TeeReader(environ['wsgi.input'], body, length or None, self.chunk_size)
+        try:
+            result = self.client.instream(reader)
+        except BufferTooLongError:
+            body.close()
+            return _reject(start_response, '413 Payload Too Large', "Request body too large to be scanned")
+        except ClamdError:
+            if not self.fail_open:
+                body.close()
+                return _reject(start_response, '503 Service Unavailable', "Request body could not be scanned")
+            reader.drain()
+            result = None
+        except:
+            body.close()
+            raise
+
+        status, reason = list(result.values())[0] if result else (None, None)
+        if status == 'FOUND':
+            body.close()
+            return _reject(start_response, '403 Forbidden', "Virus found: {0}".format(reason))
+        if status == 'ERROR' and not self.fail_open:
+            body.close()
+            return _reject(start_response, '503 Service Unavailable', "Request body could not be scanned")
+
+        body.seek(0)
+        environ['wsgi.input'] = body
+        environ['CONTENT_LENGTH'] = str(reader.size)
+        environ['clamd.result'] = result
+        try:
+            response = self.app(environ, start_response)
+        except:
+            body.close()
+            raise
+        return _ClosingIterable(response, body)
+
+
+class ClamdASGIMiddleware(object):
+    """
+    Scan HTTP request bodies with clamd before handing them to an ASGI
+    application
+
+    Works as ClamdWSGIMiddleware: the body messages are streamed to clamd
+    with an asyncio client as they are received and replayed to the
+    application from a bounded buffer. Requests without a body (no
+    content-length and no chunked transfer-encoding) are passed through
+    unscanned. The verdict is available to the application as
+    scope['extensions']['clamd']['result'].
+
+    Unlike the WSGI middleware, connections are not pooled: the asyncio
+    clients open a connection per scan, as they have no IDSESSION support.
+    """
+    def __init__(self, app, client, max_memory=MAX_MEMORY, fail_open=False, chunk_size=64 * 1024):
+        """
+        class initialisation
+
+        app : ASGI application
+        client (AsyncClamdNetworkSocket or AsyncClamdUnixSocket) : clamd to use
+        max_memory (int) : bytes of body kept in memory per request
+        fail_open (bool) : pass requests to the application unscanned when
+                           clamd cannot be reached
+        chunk_size (int) : size of the body messages replayed to the application
+        """
+
+        self.app = app
+        self.client = client
+        self.max_memory = max_memory
+        self.fail_open = fail_open
+        self.chunk_size = chunk_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not _asgi_has_body(scope):
+            await self.app(scope, receive, send)
+            return
+
+        body = tempfile.SpooledTemporaryFile(max_size=self.max_memory)
+        try:
+            await self._handle(scope, receive, send, body)
+        finally:
+            body.close()
+
+    async def _handle(self, scope, receive, send, body):
+        size = 0
+        more_body = True
+        disconnected = False
+
+        async def chunks():
+            nonlocal size, more_body, disconnected
+            while more_body:
+                message = await receive()
+                if message['type'] != 'http.request':
+                    more_body = False
+                    disconnected = True
+                    break
+                chunk = message.get('body', b'')
+                if chunk:
+                    body.write(chunk)
+                    size += len(chunk)
+                    yield chunk
+                more_body = message.get('more_body', False)
+
+        try:
+            result = await self.client.instream(chunks())
+        except BufferTooLongError:
+            await _asgi_reject(send, 413, "Request body too large to be scanned")
+            return
+        except ClamdError:
+            if not self.fail_open:
+                await _asgi_reject(send, 503, "Request body could not be scanned")
+                return
+            async for chunk in chunks():
+                pass
+            result = None
+        if disconnected:
+            return
+
+        status, reason = list(result.values())[0] if result else (None, None)
+        if status == 'FOUND':
+            await _asgi_reject(send, 403, "Virus found: {0}".format(reason))
+            return
+        if status == 'ERROR' and not self.fail_open:
+            await _asgi_reject(send, 503, "Request body could not be scanned")
+            return
+
+        body.seek(0)
+        replayed = False
+
+        async def replay():
+            nonlocal replayed
+            if replayed:
+                return await receive()
+            chunk = body.read(self.chunk_size)
+            replayed = body.tell() >= size
+            return {'type': 'http.request', 'body': chunk, 'more_body': not replayed}
+
+        scope = dict(scope)
+        extensions = dict(scope.get('extensions') or {})
+        extensions['clamd'] = {'result': result}
+        scope['extensions'] = extensions
+        await self.app(scope, replay, send)
+
+
+class _TeeReader(object):
+    """
+    file like object reading at most length bytes (all if None) from source
+    and copying them to sink
+    """
+    def __init__(self, source, sink, length, chunk_size):
+        self.source = source
+        self.sink = sink
+        self.remaining = length
+        self.chunk_size = chunk_size
+        self.size = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.chunk_size
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+        if not size:
+            return b''
+        chunk = self.source.read(size)
+        if chunk:
+            self.sink.write(chunk)
+            self.size += len(chunk)
+            if self.remaining is not None:
+                self.remaining -= len(chunk)
+        return chunk
+
+    def drain(self):
+        """
+        read what clamd did not
+        """
+        while self.read(self.chunk_size):
+            pass
+
+
+class _ClosingIterable(object):
+    """
+    application response that also closes the replayed body once sent
+    """
+    def __init__(self, response, body):
+        self.response = response
+        self.body = body
+
+    def __iter__(self):
+        return iter(self.response)
+
+    def close(self):
+        try:
+            if hasattr(self.response, 'close'):
+                self.response.close()
+        finally:
+            self.body.close()
+
+
+def _content_length(environ):
+    try:
+        return int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return 0
+
+
+def _chunked(environ):
+    return environ.get('HTTP_TRANSFER_ENCODING', '').lower() == 'chunked' and environ.get('wsgi.input_terminated')
+
+
+def _asgi_has_body(scope):
+    for name, value in scope.get('headers') or ():
+        name = name.lower()
+        if name == b'content-length':
+            try:
+                return int(value) > 0
+            except ValueError:
+                return False
+        if name == b'transfer-encoding' and b'chunked' in value.lower():
+            return True
+    return False
+
+
+def _reject(start_response, status, message):
+    body = (message + '\n').encode('utf-8')
+    start_response(status, [('Content-Type', 'text/plain; charset=utf-8'), ('Content-Length', str(len(body)))])
+    return [body]
+
+
+async def _asgi_reject(send, status, message):
+    body = (message + '\n').encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'text/plain; charset=utf-8'), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import collections
+import contextlib
+import threading
+import time
+
+from clamd import ClamdError, ConnectionError, BufferTooLongError
+
+_now = getattr(time, 'monotonic', time.time)
+
+
+class PoolTimeoutError(ClamdError):
+    """Class for errors when no connection became available in time"""
+
+
+class ClamdPool(object):
+    """
+    Thread-safe pool of persistent clamd connections
+
+    Keeps up to `maxsize` IDSESSION connections (see ClamdSession) open and
+    hands them out to one thread at a time. Idle connections are closed
+    before clamd's own IdleTimeout would drop them, and connections that have
+    been idle for a while are checked with PING before being reused.
+    """
+    def __init__(self, client, maxsize=10, idle_timeout=20, health_check_after=1, checkout_timeout=None):
+        """
+        class initialisation
+
+        client (ClamdNetworkSocket or ClamdUnixSocket) : client used to open connections
+        maxsize (int) : maximum number of open connections
+        idle_timeout (float) : seconds after which an unused connection is closed,
+                               keep it below IdleTimeout in /etc/clamav/clamd.conf
+        health_check_after (float) : connections idle for longer than this many
+                                     seconds are PINGed before reuse, 0 to always PING
+        checkout_timeout (float or None) : seconds to wait for a free connection,
+                                           None to wait forever
+        """
+
+        self.client = client
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        self.checkout_timeout = checkout_timeout
+        self.opened = 0
+        self.health_check_failures = 0
+        self._idle = collections.deque()
+        self._in_use = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Check out a connection for the duration of a with block
+
+        Connections that failed, were closed by a fatal session error or still
+        have unread replies are closed instead of being returned to the pool.
+
+        May raise:
+          - PoolTimeoutError: if no connection became available within checkout_timeout
+          - ConnectionError: in case of communication problem
+        """
+        session = self.checkout()
+        discard = False
+        try:
+            yield session
+        except (ConnectionError, BufferTooLongError):
+            discard = True
+            raise
+        finally:
+            self.checkin(session, discard=discard)
+
+    def checkout(self):
+        """
+        Take a connection out of the pool, opening a new one if none is idle
+
+        return: (ClamdSession) an open session, to be given back with checkin()
+
+        May raise:
+          - PoolTimeoutError: if no connection became available within checkout_timeout
+          - ConnectionError: in case of communication problem
+        """
+        session, last_used = self._reserve()
+        try:
+            if session is not None:
+                session = self._check(session, last_used)
+            if session is None:
+                session = self.client.session()
+                with self._cond:
+                    self.opened += 1
+        except:
+            self._release()
+            raise
+        return session
+
+    def checkin(self, session, discard=False):
+        """
+        Give a connection back to the pool
+
+        session (ClamdSession) : session returned by checkout()
+        discard (bool) : close the connection instead of keeping it
+        """
+        if discard or self._closed or session.closed or session.pending:
+            session.close()
+            self._release()
+            return
+        with self._cond:
+            self._idle.append((session, _now()))
+            self._in_use -= 1
+            self._cond.notify()
+        self.evict_idle()
+
+    def evict_idle(self):
+        """
+        Close connections that have been idle for longer than idle_timeout
+        """
+        expired = []
+        limit = _now() - self.idle_timeout
+        with self._cond:
+            while self._idle and self._idle[0][1] < limit:
+                expired.append(self._idle.popleft()[0])
+        for session in expired:
+            session.close()
+
+    def close(self):
+        """
+        Close every idle connection. Connections in use are closed when they
+        are checked in.
+        """
+        with self._cond:
+            self._closed = True
+            idle = [session for session, last_used in self._idle]
+            self._idle.clear()
+            self._cond.notify_all()
+        for session in idle:
+            session.close()
+
+    def metrics(self):
+        """
+        return: (dict) connection counters, see clamd.stats.StatsPoller
+        """
+        return {
+            'pool_connections_idle': len(self._idle),
+            'pool_connections_in_use': self._in_use,
+            'pool_connections_max': self.maxsize,
+            'pool_connections_opened_total': self.opened,
+            'pool_health_check_failures_total': self.health_check_failures,
+        }
+
+    def _reserve(self):
+        """
+        wait for an idle connection or a free slot to open a new one
+        """
+        deadline = None
+        if self.checkout_timeout is not None:
+            deadline = _now() + self.checkout_timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise ClamdError("Pool is closed")
+                if self._idle:
+                    session, last_used = self._idle.pop()
+                    break
+                if self._in_use + len(self._idle) < self.maxsize:
+                    session, last_used = None, None
+                    break
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - _now()
+                    if remaining <= 0:
+                        raise PoolTimeoutError("No clamd connection available after {0}s".format(
+                            self.checkout_timeout))
+                    self._cond.wait(remaining)
+            self._in_use += 1
+        return session, last_used
+
+    def _release(self):
+        with self._cond:
+            self._in_use -= 1
+            self._cond.notify()
+
+    def _check(self, session, last_used):
+        """
+        return the session if it is still usable, None otherwise
+        """
+        idle_for = _now() - last_used
+        if idle_for >= self.idle_timeout:
+            session.close()
+            return None
+        if idle_for >= self.health_check_after:
+            try:
+                session.ping()
+            except ClamdError:
+                with self._cond:
+                    self.health_check_failures += 1
+                session.close()
+                return None
+        return session
+
+    def ping(self):
+        with self.connection() as session:
+            return session.ping()
+
+    def version(self):
+        with self.connection() as session:
+            return session.version()
+
+    def stats(self):
+        with self.connection() as session:
+            return session.stats()
+
+    def scan(self, file):
+        with self.connection() as session:
+            return session.scan(file)
+
+    def instream(self, buff):
+        with self.connection() as session:
+            return session.instream(buff)
+
+    def instream_path(self, path):
+        with self.connection() as session:
+            return session.instream_path(path)
+
+    def fildes(self, fileobj_or_fd):
+        with self.connection() as session:
+            return session.fildes(fileobj_or_fd)
+
+    def scan_many(self, buffers):
+        with self.connection() as session:
+            return session.scan_many(buffers)
+
+    def reload(self):
+        # not allowed inside IDSESSION, uses a dedicated connection
+        return self.client.reload()
+
+    def contscan(self, file):
+        # not allowed inside IDSESSION, uses a dedicated connection
+        return self.client.contscan(file)
+
+    def multiscan(self, file):
+        # not allowed inside IDSESSION, uses a dedicated connection
+        return self.client.multiscan(file)
+
+    def allmatchscan(self, file):
+        # not allowed inside IDSESSION, uses a dedicated connection
+        return self.client.allmatchscan(file)
@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import functools
+import socket
+import threading
+import time
+
+from clamd import ClamdError, ConnectionError
+from clamd.stats import StatsPoller
+
+_now = getattr(time, 'monotonic', time.time)
+
+
+class RejectedError(ClamdError):
+    """Class for scans refused by the client because too many are already waiting"""
+
+
+class AdaptiveScheduler(object):
+    """
+    Limit the number of scans in flight, adapting the limit to clamd's load
+
+    The limit follows AIMD (additive increase, multiplicative decrease):
+      - every scan that completes while the limit is in use raises it by
+        1/limit, i.e. by about one per round trip
+      - it is multiplied by `backoff` when a scan fails with a connection
+        error or timeout, takes longer than `latency_limit`, or when STATS
+        shows clamd queueing more than `clamd_queue_limit` commands, at most
+        once per smoothed round trip
+      - it never exceeds clamd's thread count plus `clamd_queue_limit`, as
+        reported by STATS
+
+    Scans over the limit wait in a local queue of at most `max_queue` scans
+    and are rejected with RejectedError beyond that or after `queue_timeout`,
+    so excess work is refused quickly on the client instead of piling up
+    inside clamd.
+
+    STATS is only polled once start() is called, close() stops it.
+    """
+    def __init__(self, client, initial_limit=4, min_limit=1, max_limit=64, backoff=0.7, latency_limit=None,
+                 clamd_queue_limit=0, max_queue=1000, queue_timeout=None, stats_interval=1):
+        """
+        class initialisation
+
+        client : client used for the scans (ClamdNetworkSocket, ClamdPool, ...)
+        initial_limit (int) : scans in flight allowed at start
+        min_limit (int) : lower bound of the limit
+        max_limit (int) : upper bound of the limit
+        backoff (float) : factor applied to the limit on overload
+        latency_limit (float or None) : round trip, in seconds, above which a
+                                        scan counts as overload
+        clamd_queue_limit (int) : commands queued inside clamd above which
+                                  STATS counts as overload
+        max_queue (int) : scans allowed to wait for a slot before rejecting
+        queue_timeout (float or None) : seconds a scan may wait for a slot
+        stats_interval (float or None) : seconds between STATS polls once
+                                         start() is called, None to adapt on
+                                         latency and errors only
+        """
+
+        self.client = client
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_limit = latency_limit
+        self.clamd_queue_limit = clamd_queue_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.completed = 0
+        self.rtt = None
+        self._clamd_max = None
+        self._last_decrease = None
+        self._cond = threading.Condition()
+        self.poller = None
+        if stats_interval is not None:
+            self.poller = StatsPoller(client, interval=stats_interval, callback=self.update_from_stats)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        """
+        Start polling STATS every stats_interval seconds in a daemon thread
+        """
+        if self.poller is not None:
+            self.poller.start()
+        return self
+
+    def close(self):
+        if self.poller is not None:
+            self.poller.stop()
+
+    def call(self, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) once a slot is free, and adapt the limit to
+        how it went
+
+        May raise:
+          - RejectedError: if the local queue is full or queue_timeout expired
+          - whatever func raises
+        """
+        self.acquire()
+        start = _now()
+        overloaded = False
+        try:
+            return func(*args, **kwargs)
+        except ConnectionError:
+            overloaded = True
+            raise
+        except socket.timeout:
+            overloaded = True
+            raise
+        finally:
+            self.release(_now() - start, overloaded)
+
+    def acquire(self):
+        """
+        Wait for a slot
+
+        May raise:
+          - RejectedError: if the local queue is full or queue_timeout expired
+        """
+        with self._cond:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise RejectedError("{0} scans already waiting for clamd".format(self.waiting))
+            deadline = None if self.queue_timeout is None else _now() + self.queue_timeout
+            self.waiting += 1
+            try:
+                while self.in_flight >= int(self.limit):
+                    remaining = None if deadline is None else deadline - _now()
+                    if remaining is not None and remaining <= 0:
+                        self.rejected += 1
+                        raise RejectedError("No slot free after {0}s".format(self.queue_timeout))
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+
+    def release(self, rtt, overloaded=False):
+        """
+        Free a slot
+
+        rtt (float) : seconds the scan took
+        overloaded (bool) : the scan failed in a way that suggests overload
+        """
+        with self._cond:
+            busy = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            self.completed += 1
+            self.rtt = rtt if self.rtt is None else 0.8 * self.rtt + 0.2 * rtt
+            if overloaded or (self.latency_limit is not None and rtt > self.latency_limit):
+                self._decrease()
+            elif busy:
+                self._set_limit(self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def update_from_stats(self, stats):
+        """
+        Adapt the limit to a clamd.stats.ClamdStats, called by the STATS poller
+        """
+        with self._cond:
+            self._clamd_max = stats.threads_max + self.clamd_queue_limit
+            if stats.queue_items > self.clamd_queue_limit:
+                self._decrease()
+            else:
+                self._set_limit(self.limit)
+            self._cond.notify_all()
+
+    def _decrease(self):
+        now = _now()
+        if self._last_decrease is not None and now - self._last_decrease < (self.rtt or 0):
+            return
+        self._last_decrease = now
+        self._set_limit(self.limit * self.backoff)
+
+    def _set_limit(self, limit):
+        upper = self.max_limit if self._clamd_max is None else min(self.max_limit, self._clamd_max)
+        self.limit = float(max(self.min_limit, min(upper, limit)))
+
+    def metrics(self):
+        """
+        return: (dict) scheduler counters, see clamd.stats.StatsPoller
+        """
+        return {
+            'scheduler_limit': int(self.limit),
+            'scheduler_in_flight': self.in_flight,
+            'scheduler_waiting': self.waiting,
+            'scheduler_rejected_total': self.rejected,
+            'scheduler_completed_total': self.completed,
+            'scheduler_rtt_seconds': self.rtt or 0,
+        }
+
+    def ping(self):
+        return self.call(self.client.ping)
+
+    def scan(self, file):
+        return self.call(self.client.scan, file)
+
+    def instream(self, buff):
+        return self.call(self.client.instream, buff)
+
+    def instream_path(self, path):
+        return self.call(self.client.instream_path, path)
+
+    def fildes(self, fileobj_or_fd):
+        return self.call(self.client.fildes, fileobj_or_fd)
+
+
+class Lane(object):
+    """
+    One priority class of a PriorityDispatcher
+    """
+    def __init__(self, name, limit, reserved=0, max_queue=1000, queue_timeout=None):
+        """
+        class initialisation
+
+        name (string) : name given as priority to the dispatcher methods
+        limit (int) : scans of this lane in flight at most
+        reserved (int) : slots kept free for this lane and the ones above it
+        max_queue (int) : scans of this lane allowed to wait before rejecting
+        queue_timeout (float or None) : seconds a scan may wait for a slot
+        """
+
+        self.name = name
+        self.limit = limit
+        self.reserved = reserved
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self.preempted = 0
+
+    def __repr__(self):
+        return '<Lane {0} {1}/{2}>'.format(self.name, self.in_flight, self.limit)
+
+
+class PriorityDispatcher(object):
+    """
+    Share clamd between priority classes, e.g. interactive uploads and bulk
+    archive sweeps
+
+    Lanes are listed from the highest priority to the lowest. A scan starts
+    when its lane is under its own limit, fewer than `capacity` scans are in
+    flight overall, and starting it leaves free the slots reserved for the
+    lanes above. With `preempt`, a lane also waits while a lane above it has
+    scans waiting that could start, so latency sensitive scans never queue
+    behind batch work.
+
+    clamd cannot interrupt a command, so a CONTSCAN/MULTISCAN holds its slot
+    until the whole tree is scanned. iter_sweep() instead walks the tree on
+    the client and scans it file by file, each file taking a slot of the
+    lane, so higher lanes get the next free slot between files. With
+    `sweep_trees`, contscan() and multiscan() in any lane but the first are
+    run that way; this needs the tree to be readable by the client.
+
+    The scan methods take the lane name as `priority`, the first lane by
+    default, except iter_sweep() which defaults to the last.
+    """
+    def __init__(self, client, lanes=None, capacity=None, preempt=True, sweep_trees=False):
+        """
+        class initialisation
+
+        client : client used for the scans (ClamdNetworkSocket, ClamdPool, ...)
+        lanes (list or None) : Lane objects, highest priority first, by
+                               default 'interactive' (limit 8, 2 reserved)
+                               and 'bulk' (limit 6)
+        capacity (int or None) : scans in flight at most over all lanes,
+                                 defaults to the largest lane limit
+        preempt (bool) : lower lanes give way to waiting higher ones
+        sweep_trees (bool) : run contscan() and multiscan() below the first
+                             lane with iter_sweep()
+        """
+
+        if lanes is None:
+            lanes = [Lane('interactive', 8, reserved=2), Lane('bulk', 6)]
+        if not lanes:
+            raise ValueError("No lane")
+        self.client = client
+        self.lanes = list(lanes)
+        self.capacity = capacity or max(lane.limit for lane in self.lanes)
+        self.preempt = preempt
+        self.sweep_trees = sweep_trees
+        self.in_flight = 0
+        self._index = dict((lane.name, i) for i, lane in enumerate(self.lanes))
+        self._cond = threading.Condition()
+
+    def lane(self, priority):
+        """
+        return: (Lane) the lane named priority
+
+        May raise:
+          - ValueError: if there is no such lane
+        """
+        try:
+            return self.lanes[self._index[priority]]
+        except KeyError:
+            raise ValueError("Unknown priority: {0}".format(priority))
+
+    def call(self, priority, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) once a slot of the lane is free
+
+        May raise:
+          - RejectedError: if the lane queue is full or its queue_timeout expired
+          - whatever func raises
+        """
+        self.acquire(priority)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.release(priority)
+
+    def acquire(self, priority):
+        """
+        Wait for a slot in a lane
+
+        May raise:
+          - RejectedError: if the lane queue is full or its queue_timeout expired
+        """
+        lane = self.lane(priority)
+        index = self._index[priority]
+        with self._cond:
+            blocked = self._blocked(index)
+            if blocked is None:
+                self._start(lane)
+                return
+            if lane.waiting >= lane.max_queue:
+                lane.rejected += 1
+                raise RejectedError("{0} {1} scans already waiting for clamd".format(lane.waiting, lane.name))
+            if blocked == 'preempted':
+                lane.preempted += 1
+            deadline = None if lane.queue_timeout is None else _now() + lane.queue_timeout
+            lane.waiting += 1
+            try:
+                while self._blocked(index) is not None:
+                    remaining = None if deadline is None else deadline - _now()
+                    if remaining is not None and remaining <= 0:
+                        lane.rejected += 1
+                        raise RejectedError("No {0} slot free after {1}s".format(lane.name, lane.queue_timeout))
+                    self._cond.wait(remaining)
+            finally:
+                lane.waiting -= 1
+            self._start(lane)
+
+    def release(self, priority):
+        """
+        Free a slot of a lane
+        """
+        lane = self.lane(priority)
+        with self._cond:
+            lane.in_flight -= 1
+            lane.completed += 1
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def _start(self, lane):
+        lane.in_flight += 1
+        self.in_flight += 1
+        # a lower lane may have been held back by this scan waiting
+        self._cond.notify_all()
+
+    def _blocked(self, index):
+        """
+        return None if a scan of the lane at index can start now, else why not
+        """
+        lane = self.lanes[index]
+        if lane.in_flight >= lane.limit:
+            return 'busy'
+        free = self.capacity - self.in_flight
+        for higher in self.lanes[:index]:
+            free -= max(0, higher.reserved - higher.in_flight)
+            if self.preempt and higher.waiting and higher.in_flight < higher.limit:
+                return 'preempted'
+        if free <= 0:
+            return 'busy'
+        return None
+
+    def metrics(self):
+        """
+        return: (dict) per lane counters, see clamd.stats.StatsPoller
+        """
+        with self._cond:
+            values = {'dispatcher_in_flight': self.in_flight}
+            for lane in self.lanes:
+                prefix = 'dispatcher_{0}_'.format(lane.name)
+                values[prefix + 'in_flight'] = lane.in_flight
+                values[prefix + 'waiting'] = lane.waiting
+                values[prefix + 'completed_total'] = lane.completed
+                values[prefix + 'rejected_total'] = lane.rejected
+                values[prefix + 'preempted_total'] = lane.preempted
+            return values
+
+    def ping(self, priority=None):
+        return self.call(priority or self.lanes[0].name, self.client.ping)
+
+    def scan(self, file, priority=None):
+        return self.call(priority or self.lanes[0].name, self.client.scan, file)
+
+    def instream(self, buff, priority=None):
+        return self.call(priority or self.lanes[0].name, self.client.instream, buff)
+
+    def instream_path(self, path, priority=None):
+        return self.call(priority or self.lanes[0].name, self.client.instream_path, path)
+
+    def fildes(self, fileobj_or_fd, priority=None):
+        return self.call(priority or self.lanes[0].name, self.client.fildes, fileobj_or_fd)
+
+    def contscan(self, file, priority=None):
+        return self._tree_scan('contscan', file, priority)
+
+    def multiscan(self, file, priority=None):
+        return self._tree_scan('multiscan', file, priority)
+
+    def _tree_scan(self, method, file, priority):
+        """
+        run CONTSCAN or MULTISCAN as one command, or as a sweep giving way to
+        higher lanes between files
+        """
+        priority = self.lane(priority or self.lanes[0].name).name
+        if not self.sweep_trees or self._index[priority] == 0:
+            return self.call(priority, getattr(self.client, method), file)
+        results = dict((path, result) for path, result in self.iter_sweep(file, priority) if result[0] != 'OK')
+        return results or {file: ('OK', None)}
+
+    def iter_sweep(self, top, priority=None, method=None, **filters):
+        """
+        Scan a directory tree file by file with clamd.tree.scan_files(), up to
+        the lane limit at once, each file taking a slot of the lane, so higher
+        lanes get the next free slot between two files
+
+        top (string) : directory or file to scan
+        priority (string or None) : lane of the sweep, defaults to the lowest
+        method (string or None) : 'scan', 'fildes' or 'instream', see
+                                  clamd.tree.scan_tree(), by default 'fildes'
+                                  over unix sockets and 'instream' otherwise
+        filters : max_size, include, exclude and follow_symlinks, see
+                  clamd.tree.walk_files()
+
+        return:
+          - (generator): (filename, (status, reason)) for every file, in
+            completion order
+
+        May raise:
+          - ConnectionError: in case of communication problem
+          - RejectedError: if the lane queue is full or its queue_timeout expired
+        """
+        # clamd.tree is python 3 only
+        from clamd.tree import scan_files, walk_files
+
+        lane = self.lane(priority or self.lanes[-1].name)
+        return scan_files(self.client, walk_files(top, **filters), max_workers=lane.limit, method=method,
+                          gate=functools.partial(self.call, lane.name))
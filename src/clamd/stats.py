@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import sys
+import threading
+import time
+
+from clamd import ClamdError, ResponseError
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+_now = getattr(time, 'monotonic', time.time)
+
+_log = logging.getLogger(__name__)
+
+_MEMSTATS = ('heap', 'mmap', 'used', 'free', 'releasable', 'pools_used', 'pools_total')
+
+
+class PoolStats(object):
+    """
+    State of one clamd thread pool, as reported by STATS
+    """
+    __slots__ = ('state', 'threads_live', 'threads_idle', 'threads_max', 'idle_timeout', 'queue_items', 'queue')
+
+    def __init__(self):
+        self.state = None
+        self.threads_live = 0
+        self.threads_idle = 0
+        self.threads_max = 0
+        self.idle_timeout = 0
+        self.queue_items = 0
+        # [(command, seconds), ...] for the queued and running commands
+        self.queue = []
+
+    @property
+    def threads_busy(self):
+        return self.threads_live - self.threads_idle
+
+
+class ClamdStats(object):
+    """
+    Parsed STATS reply
+
+    Thread and queue counters are summed over all pools, memory values are in
+    bytes and None when clamd reports N/A.
+    """
+    __slots__ = ('pools', 'heap', 'mmap', 'used', 'free', 'releasable', 'pools_used', 'pools_total')
+
+    def __init__(self):
+        self.pools = []
+        for name in _MEMSTATS:
+            setattr(self, name, None)
+
+    @property
+    def threads_live(self):
+        return sum(pool.threads_live for pool in self.pools)
+
+    @property
+    def threads_idle(self):
+        return sum(pool.threads_idle for pool in self.pools)
+
+    @property
+    def threads_max(self):
+        return sum(pool.threads_max for pool in self.pools)
+
+    @property
+    def threads_busy(self):
+        return self.threads_live - self.threads_idle
+
+    @property
+    def queue_items(self):
+        return sum(pool.queue_items for pool in self.pools)
+
+    def metrics(self):
+        """
+        return: (dict) {metric name: value} for the numeric values
+        """
+        values = {
+            'pools': len(self.pools),
+            'threads_live': self.threads_live,
+            'threads_idle': self.threads_idle,
+            'threads_max': self.threads_max,
+            'queue_items': self.queue_items,
+        }
+        for name in _MEMSTATS:
+            if getattr(self, name) is not None:
+                values['memory_{0}_bytes'.format(name)] = getattr(self, name)
+        return values
+
+
+def parse_stats(text):
+    """
+    Parse the reply of ClamdNetworkSocket.stats()
+
+    text (string) : STATS reply
+
+    return: (ClamdStats)
+
+    May raise:
+      - ResponseError: if the reply cannot be parsed
+    """
+    stats = ClamdStats()
+    pool = None
+    try:
+        for line in text.splitlines():
+            if line.startswith('\t'):
+                fields = line.split()
+                if pool is not None and len(fields) >= 2:
+                    pool.queue.append((fields[0], float(fields[1])))
+                continue
+            key, _, value = line.partition(':')
+            fields = value.split()
+            if key == 'STATE':
+                pool = PoolStats()
+                pool.state = value.strip()
+                stats.pools.append(pool)
+            elif key == 'THREADS':
+                values = _pairs(fields)
+                pool.threads_live = int(values.get('live', 0))
+                pool.threads_idle = int(values.get('idle', 0))
+                pool.threads_max = int(values.get('max', 0))
+                pool.idle_timeout = int(values.get('idle-timeout', 0))
+            elif key == 'QUEUE':
+                pool.queue_items = int(fields[0])
+            elif key == 'MEMSTATS':
+                values = _pairs(fields)
+                for name in _MEMSTATS:
+                    setattr(stats, name, _megabytes(values.get(name)))
+    except (ValueError, IndexError, AttributeError):
+        raise ResponseError("Cannot parse STATS reply: {0}".format(sys.exc_info()[1]))
+    return stats
+
+
+def _pairs(fields):
+    """
+    ['live', '1', 'idle', '0'] -> {'live': '1', 'idle': '0'}
+    """
+    return dict(zip(fields[::2], fields[1::2]))
+
+
+def _megabytes(value):
+    if value is None or value == 'N/A':
+        return None
+    return int(float(value.rstrip('M')) * 1024 * 1024)
+
+
+def format_metrics(values, prefix='clamd_'):
+    """
+    Render metrics in the Prometheus text exposition format
+
+    values (dict) : {metric name: number}
+
+    return: (string)
+    """
+    lines = []
+    for name in sorted(values):
+        lines.append('{0}{1} {2}'.format(prefix, name, values[name]))
+    return '\n'.join(lines) + '\n'
+
+
+class StatsPoller(object):
+    """
+    Poll clamd STATS in a background thread
+
+    The latest parsed stats are kept in self.stats, passed to an optional
+    callback, and exported together with client-side counters by metrics().
+    Client-side counters come from `sources`: objects with a metrics() method
+    returning {name: number}, such as ClamdPool and ScanCache. In the polling
+    thread, errors raised by the callback are logged and polling goes on.
+    """
+    def __init__(self, client, interval=10, callback=None, sources=()):
+        """
+        class initialisation
+
+        client : client used to send STATS
+        interval (float) : seconds between polls
+        callback (callable or None) : called as callback(stats) after every
+                                      successful poll
+        sources (iterable) : objects whose metrics() are exported with clamd's
+        """
+
+        self.client = client
+        self.interval = interval
+        self.callback = callback
+        self.sources = list(sources)
+        self.stats = None
+        self.up = False
+        self.polls = 0
+        self.poll_errors = 0
+        self.poll_seconds = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def poll(self):
+        """
+        Poll clamd once
+
+        return: (ClamdStats or None) the stats, None if clamd could not be reached
+        """
+        start = _now()
+        self.polls += 1
+        try:
+            stats = parse_stats(self.client.stats())
+        except ClamdError:
+            self.poll_errors += 1
+            self.up = False
+            return None
+        self.poll_seconds = _now() - start
+        self.stats = stats
+        self.up = True
+        if self.callback is not None:
+            self.callback(stats)
+        return stats
+
+    def start(self):
+        """
+        Start polling every interval seconds in a daemon thread
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='clamd-stats-poller')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception:
+                # the thread has no caller to raise to, keep polling
+                _log.exception("clamd STATS poll failed")
+            self._stop.wait(self.interval)
+
+    def metrics(self):
+        """
+        return: (dict) {metric name: value} for clamd, the poller and the sources
+        """
+        values = {
+            'up': int(self.up),
+            'stats_polls_total': self.polls,
+            'stats_poll_errors_total': self.poll_errors,
+        }
+        if self.poll_seconds is not None:
+            values['stats_poll_seconds'] = self.poll_seconds
+        if self.stats is not None and self.up:
+            values.update(self.stats.metrics())
+        for source in self.sources:
+            for name, value in source.metrics().items():
+                values['client_' + name] = value
+        return values
+
+    def serve(self, port=9810, host=''):
+        """
+        Serve metrics() in the Prometheus text format over HTTP from a daemon
+        thread, on any path
+
+        return: (HTTPServer) the server, call shutdown() to stop it
+        """
+        poller = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = format_metrics(poller.metrics()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer((host, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, name='clamd-metrics')
+        thread.daemon = True
+        thread.start()
+        return server
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+in-process fake clamd server for tests and benchmarks, python 3.3+ only
+"""
+
+import array
+import collections
+import os
+import socket
+import struct
+import threading
+import time
+
+_SCANS = ('SCAN', 'CONTSCAN', 'MULTISCAN', 'ALLMATCHSCAN', 'INSTREAM', 'FILDES')
+_SESSION_INVALID = ('RELOAD', 'CONTSCAN', 'MULTISCAN', 'ALLMATCHSCAN')
+
+STATS = """POOLS: 1
+
+STATE: VALID PRIMARY
+THREADS: live {live}  idle {idle} max {max} idle-timeout 30
+QUEUE: 0 items
+\tSTATS 0.000042
+
+MEMSTATS: heap N/A mmap N/A used N/A free N/A releasable N/A pools 1 pools_used 1306.837M pools_total 1306.882M
+END"""
+
+
+class FakeClamd(object):
+    """
+    Small clamd look-alike serving one thread per connection
+
+    Speaks the n (newline) and z (NUL) command forms, IDSESSION/END, PING,
+    VERSION, RELOAD, SHUTDOWN, STATS, SCAN, CONTSCAN, MULTISCAN,
+    ALLMATCHSCAN, INSTREAM and, over unix sockets, FILDES. Content is FOUND
+    when it contains one of the `verdicts` markers (ALLMATCHSCAN reports
+    every marker found, in sorted order), scans sleep `latency`
+    seconds before replying, so the client side can be tested and measured
+    without ClamAV.
+
+        >>> with FakeClamd() as server:
+        ...     server.client().ping()
+        'PONG'
+    """
+    def __init__(self, path=None, host='127.0.0.1', port=0, latency=0, verdicts=None,
+                 stream_max_length=25 * 1024 * 1024, max_threads=12,
+                 version='ClamAV 0.103.8/26700/Mon Oct 12 09:00:00 2026'):
+        """
+        class initialisation, the server listens and serves once created
+
+        path (string or None) : unix socket to listen on, TCP if None
+        host (string) : TCP address to listen on
+        port (int) : TCP port, 0 for a free one, see self.port
+        latency (float) : seconds every scan takes
+        verdicts (dict or None) : {content marker (bytes): signature name},
+                                  EICAR by default
+        stream_max_length (int) : INSTREAM size limit in bytes
+        max_threads (int) : MaxThreads reported by STATS
+        version (string) : VERSION reply
+        """
+
+        if verdicts is None:
+            verdicts = {b'EICAR-STANDARD-ANTIVIRUS-TEST-FILE': 'Eicar-Test-Signature'}
+        self.path = path
+        self.latency = latency
+        self.verdicts = verdicts
+        self.stream_max_length = stream_max_length
+        self.max_threads = max_threads
+        self.version = version
+        self.commands = collections.Counter()
+        self.active = 0
+        self._lock = threading.Lock()
+        if path is not None:
+            if os.path.exists(path):
+                os.unlink(path)
+            self.sock = socket.socket(socket.AF_UNIX)
+            self.sock.bind(path)
+        else:
+            self.sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind((host, port))
+        self.host, self.port = (None, None) if path is not None else self.sock.getsockname()[:2]
+        self.sock.listen(1024)
+        self._thread = threading.Thread(target=self._serve, name='fake-clamd')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def client(self, timeout=None):
+        """
+        return: (ClamdUnixSocket or ClamdNetworkSocket) a client of this server
+        """
+        import clamd
+        if self.path is not None:
+            return clamd.ClamdUnixSocket(self.path, timeout=timeout)
+        return clamd.ClamdNetworkSocket(self.host, self.port, timeout=timeout)
+
+    def close(self):
+        """
+        Stop accepting connections, open ones are served until they end
+        """
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self._thread.join()
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def verdict(self, data):
+        """
+        return: (string) the reply for scanned content, without the file name
+        """
+        for signature in self.matches(data):
+            return '{0} FOUND'.format(signature)
+        return 'OK'
+
+    def matches(self, data):
+        """
+        return: (list) sorted names of the signatures found in the content
+        """
+        return sorted(signature for marker, signature in self.verdicts.items() if marker in data)
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            if self.path is None:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            thread = threading.Thread(target=self._handle, args=(conn,), name='fake-clamd-connection')
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, conn):
+        with self._lock:
+            self.active += 1
+        try:
+            _Connection(self, conn).run()
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+            with self._lock:
+                self.active -= 1
+
+
+class _Connection(object):
+    """
+    one client connection of a FakeClamd
+    """
+    def __init__(self, server, conn):
+        self.server = server
+        self.conn = conn
+        self.buf = bytearray()
+        self.fds = []
+        self.session_id = None
+
+    def run(self):
+        while True:
+            command, end = self.read_command()
+            name, _, arg = command.partition(' ')
+            with self.server._lock:
+                self.server.commands[name] += 1
+            if name == 'IDSESSION':
+                self.session_id = 0
+                continue
+            if name == 'END' or name == 'SHUTDOWN':
+                return
+            if self.session_id is not None and name in _SESSION_INVALID:
+                # a fatal session error, sent without a request id
+                self.conn.sendall(b'Command invalid inside IDSESSION. ERROR' + end)
+                return
+            if self.session_id is not None:
+                self.session_id += 1
+            if name in _SCANS and self.server.latency:
+                time.sleep(self.server.latency)
+            if not self.dispatch(name, arg, end):
+                return
+            if self.session_id is None:
+                return
+
+    def dispatch(self, name, arg, end):
+        """
+        reply to one command, return False to close the connection
+        """
+        if name == 'PING':
+            self.reply('PONG', end)
+        elif name == 'VERSION':
+            self.reply(self.server.version, end)
+        elif name == 'RELOAD':
+            self.reply('RELOADING', end)
+        elif name == 'STATS':
+            busy = min(self.server.active, self.server.max_threads)
+            self.reply(STATS.format(live=busy, idle=0, max=self.server.max_threads), end)
+        elif name == 'INSTREAM':
+            data = self.read_stream()
+            if data is None:
+                self.reply('INSTREAM size limit exceeded. ERROR', end)
+                return False
+            self.reply('stream: ' + self.server.verdict(data), end)
+        elif name == 'FILDES':
+            fd = self.read_fd()
+            try:
+                data = os.pread(fd, os.fstat(fd).st_size, 0)
+            finally:
+                os.close(fd)
+            self.reply('fd[{0}]: {1}'.format(fd, self.server.verdict(data)), end)
+        elif name in ('SCAN', 'CONTSCAN', 'MULTISCAN', 'ALLMATCHSCAN'):
+            self.scan(name, arg, end)
+        else:
+            self.reply('UNKNOWN COMMAND', end)
+        return True
+
+    def scan(self, name, path, end):
+        if os.path.isdir(path):
+            paths = []
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                paths.extend(os.path.join(root, f) for f in sorted(files))
+        else:
+            paths = [path]
+        found = False
+        for p in paths:
+            try:
+                with open(p, 'rb') as f:
+                    signatures = self.server.matches(f.read())
+            except (IOError, OSError) as e:
+                self.reply('{0}: {1} ERROR'.format(p, e.strerror), end)
+                continue
+            if not signatures:
+                continue
+            found = True
+            if name != 'ALLMATCHSCAN':
+                signatures = signatures[:1]
+            for signature in signatures:
+                self.reply('{0}: {1} FOUND'.format(p, signature), end)
+            if name == 'SCAN':
+                break
+        if not found:
+            self.reply('{0}: OK'.format(path), end)
+
+    def reply(self, text, end):
+        if self.session_id is not None:
+            text = '{0}: {1}'.format(self.session_id, text)
+        self.conn.sendall(text.encode('utf-8', 'surrogateescape') + end)
+
+    def fill(self):
+        """
+        receive more bytes, collecting descriptors passed with SCM_RIGHTS
+        """
+        msg, ancdata, flags, addr = self.conn.recvmsg(256 * 1024, socket.CMSG_SPACE(16 * 4))
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds = array.array('i')
+                fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+                self.fds.extend(fds)
+        if not msg:
+            raise EOFError
+        self.buf.extend(msg)
+
+    def read_command(self):
+        """
+        return: (command, terminator) for the next n or z command
+        """
+        while True:
+            # FILDES sends its descriptor with a single NUL byte
+            while self.buf[:1] == b'\0':
+                del self.buf[:1]
+            if self.buf:
+                end = b'\n' if self.buf[:1] == b'n' else b'\0'
+                i = self.buf.find(end)
+                if i >= 0:
+                    command = bytes(self.buf[1:i])
+                    del self.buf[:i + 1]
+                    return command.decode('utf-8', 'surrogateescape'), end
+            self.fill()
+
+    def read_exact(self, size):
+        if len(self.buf) >= size:
+            data = bytes(self.buf[:size])
+            del self.buf[:size]
+            return data
+        # large chunks are received in place, without going through self.buf
+        data = bytearray(size)
+        view = memoryview(data)
+        have = len(self.buf)
+        view[:have] = self.buf
+        del self.buf[:]
+        while have < size:
+            received = self.conn.recv_into(view[have:])
+            if not received:
+                raise EOFError
+            have += received
+        return data
+
+    def read_stream(self):
+        """
+        return: (bytes or None) the INSTREAM content, None over the size limit
+        """
+        chunks = []
+        total = 0
+        while True:
+            size, = struct.unpack('!L', self.read_exact(4))
+            if not size:
+                return b''.join(chunks)
+            total += size
+            if total > self.server.stream_max_length:
+                return None
+            chunks.append(self.read_exact(size))
+
+    def read_fd(self):
+        while not self.fds:
+            self.fill()
+        while self.buf[:1] == b'\0':
+            del self.buf[:1]
+        return self.fds.pop(0)
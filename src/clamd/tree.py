@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+client-side parallel directory scanning, python 3.6+ only
+"""
+
+import concurrent.futures
+import fnmatch
+import os
+import stat
+
+from clamd import ClamdUnixSocket, ResponseError
+from clamd.cluster import ClamdCluster
+from clamd.pool import ClamdPool
+
+
+def walk_files(top, max_size=None, include=None, exclude=None, follow_symlinks=False):
+    """
+    Walk a directory tree with os.scandir and yield the regular files to scan
+
+    top (string) : directory or file
+    max_size (int or None) : skip files larger than this many bytes
+    include (list or None) : glob patterns, only file names matching one are scanned
+    exclude (list or None) : glob patterns, matching file and directory names are skipped
+    follow_symlinks (bool) : follow symbolic links to files and directories,
+                             each directory is entered once, so links to an
+                             ancestor do not make the walk loop
+
+    return:
+      - (generator): (path, os.stat_result) for every file to scan, special
+        files (fifos, sockets, devices) are always skipped
+    """
+    if not os.path.isdir(top):
+        st = os.stat(top) if follow_symlinks else os.lstat(top)
+        if stat.S_ISREG(st.st_mode) and (max_size is None or st.st_size <= max_size):
+            yield top, st
+        return
+
+    stack = [top]
+    # (st_dev, st_ino) of the directories entered, only links can make cycles
+    visited = set()
+    if follow_symlinks:
+        st = os.stat(top)
+        visited.add((st.st_dev, st.st_ino))
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if exclude and any(fnmatch.fnmatch(entry.name, pattern) for pattern in exclude):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=follow_symlinks):
+                        if follow_symlinks:
+                            st = entry.stat()
+                            if (st.st_dev, st.st_ino) in visited:
+                                continue
+                            visited.add((st.st_dev, st.st_ino))
+                        stack.append(entry.path)
+                        continue
+                    if not entry.is_file(follow_symlinks=follow_symlinks):
+                        continue
+                    st = entry.stat(follow_symlinks=follow_symlinks)
+                except OSError:
+                    continue
+                if include and not any(fnmatch.fnmatch(entry.name, pattern) for pattern in include):
+                    continue
+                if max_size is not None and st.st_size > max_size:
+                    continue
+                yield entry.path, st
+
+
+def scan_tree(client, top, max_workers=8, method=None, progress=None, **filters):
+    """
+    Scan a directory tree file by file over several connections at once
+
+    Unlike MULTISCAN, the directory is walked by the client, so it works with
+    a remote clamd, and the number of files in flight is bounded by
+    max_workers, which keeps that many clamd threads busy.
+
+    client (ClamdNetworkSocket, ClamdUnixSocket, ClamdPool or ClamdCluster) :
+        clamd to use, plain clients are wrapped in a ClamdPool of max_workers
+        connections
+    top (string) : directory or file to scan
+    max_workers (int) : number of files scanned concurrently
+    method (string or None) : how files are sent to clamd
+        - 'scan': SCAN the path, clamd must be able to read it
+        - 'fildes': pass an open descriptor, unix sockets only
+        - 'instream': stream the content, works with a remote clamd
+        - None: 'fildes' over unix sockets, 'instream' otherwise
+    progress (callable or None) : called as progress(path, result, files_done,
+        bytes_done) after every file
+    filters : max_size, include, exclude and follow_symlinks, see walk_files()
+
+    return:
+      - (generator): (filename, (status, reason)) in completion order, files
+        that cannot be opened or scanned are reported as ERROR
+
+    May raise:
+      - ConnectionError: in case of communication problem
+    """
+    return scan_files(client, walk_files(top, **filters), max_workers=max_workers, method=method,
+                      progress=progress)
+
+
+def scan_files(client, files, max_workers=8, method=None, progress=None, lookup=None, on_result=None, gate=None):
+    """
+    Scan files concurrently, see scan_tree()
+
+    files (iterable) : (path, os.stat_result) pairs, as yielded by walk_files()
+    lookup (callable or None) : called as lookup(path, stat_result) before a
+        file is submitted, a (status, reason) return value is reported as the
+        result of the file instead of scanning it
+    on_result (callable or None) : called as on_result(path, stat_result,
+        (status, reason)) for every file that was actually scanned
+    gate (callable or None) : every scan runs as gate(scan, *args), e.g. to
+        take a slot of a clamd.scheduler.PriorityDispatcher lane per file
+
+    return:
+      - (generator): (filename, (status, reason)) in completion order
+    """
+    if isinstance(client, (ClamdPool, ClamdCluster)):
+        pool, own_pool = client, False
+    else:
+        pool, own_pool = ClamdPool(client, maxsize=max_workers), True
+    if method is None:
+        clients = [node.client for node in pool.nodes] if isinstance(pool, ClamdCluster) else [pool.client]
+        method = 'fildes' if all(isinstance(c, ClamdUnixSocket) for c in clients) else 'instream'
+    scan_file = _SCAN_METHODS[method]
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+    in_flight = {}
+    files_done = bytes_done = 0
+
+    def finish(path, st, result):
+        nonlocal files_done, bytes_done
+        files_done += 1
+        bytes_done += st.st_size
+        if progress is not None:
+            progress(path, result, files_done, bytes_done)
+        return path, result
+
+    def wait_first():
+        done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            path, st = in_flight.pop(future)
+            result = future.result()
+            if on_result is not None:
+                on_result(path, st, result)
+            yield finish(path, st, result)
+
+    try:
+        for path, st in files:
+            if lookup is not None:
+                result = lookup(path, st)
+                if result is not None:
+                    yield finish(path, st, result)
+                    continue
+            if len(in_flight) >= max_workers * 2:
+                for item in wait_first():
+                    yield item
+            if gate is None:
+                future = executor.submit(scan_file, pool, path)
+            else:
+                future = executor.submit(gate, scan_file, pool, path)
+            in_flight[future] = (path, st)
+
+        while in_flight:
+            for item in wait_first():
+                yield item
+    finally:
+        for future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=True)
+        if own_pool:
+            pool.close()
+
+
+def _scan(pool, path):
+    return _verdict(pool.scan, path)
+
+
+def _fildes(pool, path):
+    try:
+        f = open(path, 'rb')
+    except (IOError, OSError) as e:
+        return 'ERROR', e.strerror
+    with f:
+        return _verdict(pool.fildes, f)
+
+
+def _instream(pool, path):
+    return _verdict(pool.instream_path, path)
+
+
+def _verdict(scan, *args):
+    """
+    run one scan and return its (status, reason), whatever name clamd gave the file
+    """
+    try:
+        result = scan(*args)
+    except ResponseError as e:
+        return 'ERROR', str(e)
+    except (IOError, OSError) as e:
+        return 'ERROR', e.strerror
+    return list(result.values())[0]
+
+
+_SCAN_METHODS = {
+    'scan': _scan,
+    'fildes': _fildes,
+    'instream': _instream,
+}
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+import clamd
+from clamd.aio import AsyncClamdUnixSocket
+from clamd.testing import FakeClamd
+from io import BytesIO
+import os
+import shutil
+import tempfile
+
+import pytest
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class TestAsyncUnixSocket(object):
+
+    def setup_method(self):
+        self.cd = AsyncClamdUnixSocket()
+
+    def test_ping(self):
+        assert run(self.cd.ping()) == 'PONG'
+
+    def test_version(self):
+        assert run(self.cd.version()).startswith("ClamAV")
+
+    def test_instream(self):
+        expected = {'stream': ('FOUND', 'Eicar-Test-Signature')}
+        assert run(self.cd.instream(BytesIO(clamd.EICAR))) == expected
+        assert run(self.cd.instream(clamd.EICAR)) == expected
+
+    def test_instream_async_iterator(self):
+        async def chunks():
+            yield clamd.EICAR[:10]
+            yield clamd.EICAR[10:]
+
+        expected = {'stream': ('FOUND', 'Eicar-Test-Signature')}
+        assert run(self.cd.instream(chunks())) == expected
+
+    def test_concurrent_instream(self):
+        async def scan_all():
+            return await asyncio.gather(*[self.cd.instream(b"foo") for i in range(50)])
+
+        assert run(scan_all()) == [{'stream': ('OK', None)}] * 50
+
+
+def test_cannot_connect():
+    with pytest.raises(clamd.ConnectionError):
+        run(AsyncClamdUnixSocket(path="/tmp/404").ping())
+
+
+def test_z_mode_file_names():
+    directory = tempfile.mkdtemp()
+    try:
+        with FakeClamd(os.path.join(directory, 'clamd.ctl')) as server:
+            name = os.path.join(directory, 'new\nline')
+            with open(name, 'wb') as f:
+                f.write(clamd.EICAR)
+            cd = AsyncClamdUnixSocket(server.path)
+            assert run(cd.scan(name)) == {name: ('FOUND', 'Eicar-Test-Signature')}
+            assert run(cd.scan(os.fsencode(name))) == {os.fsencode(name): ('FOUND', 'Eicar-Test-Signature')}
+            assert run(cd.stats()).rstrip().endswith('END')
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_allmatchscan():
+    directory = tempfile.mkdtemp()
+    try:
+        verdicts = {b'AAA': 'Sig.A', b'BBB': 'Sig.B'}
+        with FakeClamd(os.path.join(directory, 'clamd.ctl'), verdicts=verdicts) as server:
+            name = os.path.join(directory, 'both')
+            with open(name, 'wb') as f:
+                f.write(b'AAA BBB')
+            cd = AsyncClamdUnixSocket(server.path)
+            assert run(cd.allmatchscan(name)) == {name: (('FOUND', 'Sig.A'), ('FOUND', 'Sig.B'))}
+            assert run(cd.contscan(name)) == {name: ('FOUND', 'Sig.A')}
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_instream_drains_each_chunk(monkeypatch):
+    drained = []
+    drain = AsyncClamdUnixSocket._drain
+
+    async def counting_drain(self, writer):
+        drained.append(writer.transport.get_write_buffer_size())
+        await drain(self, writer)
+
+    monkeypatch.setattr(AsyncClamdUnixSocket, '_drain', counting_drain)
+    cd = AsyncClamdUnixSocket()
+    assert run(cd.instream(b"x" * 10 * 1024, chunk_size=1024)) == {'stream': ('OK', None)}
+    # the command, ten chunks and the terminator, one chunk at most queued at a time
+    assert len(drained) == 12
+    assert max(drained) <= 4 + 1024
+
+
+def test_reply_line_too_long():
+    async def read():
+        reader = asyncio.StreamReader(limit=16)
+        reader.feed_data(b"x" * 100 + b"\n")
+        return await clamd.aio._readuntil(reader, b"\n")
+
+    with pytest.raises(clamd.ResponseError):
+        run(read())
@@ -2,12 +2,17 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 import clamd
+from clamd.testing import FakeClamd
 from io import BytesIO
+import contextlib
 from contextlib import contextmanager
 import tempfile
 import shutil
 import os
 import stat
+import mmap
+import socket
+import time
 
 import pytest
 
@@ -70,6 +75,34 @@ class TestUnixSocket(object):
 
             assert self.cd.multiscan(d) == expected
 
+    def test_iter_multiscan(self):
+        expected = {}
+        with mkdtemp(prefix="python-clamd") as d:
+            for i in range(10):
+                with open(os.path.join(d, "file" + str(i)), 'wb') as f:
+                    f.write(clamd.EICAR)
+                    os.fchmod(f.fileno(), (mine | other))
+                    expected[f.name] = ('FOUND', 'Eicar-Test-Signature')
+            os.chmod(d, (mine | other | execute))
+
+            results = self.cd.iter_multiscan(d)
+            first = next(results)
+            assert first[0] in expected
+            assert dict([first] + list(results)) == expected
+
+    def test_iter_contscan_close(self):
+        with mkdtemp(prefix="python-clamd") as d:
+            for i in range(3):
+                with open(os.path.join(d, "file" + str(i)), 'wb') as f:
+                    f.write(clamd.EICAR)
+                    os.fchmod(f.fileno(), (mine | other))
+            os.chmod(d, (mine | other | execute))
+
+            results = self.cd.iter_contscan(d)
+            assert next(results)[1] == ('FOUND', 'Eicar-Test-Signature')
+            results.close()
+            assert self.cd.ping() == 'PONG'
+
     def test_instream(self):
         expected = {'stream': ('FOUND', 'Eicar-Test-Signature')}
         assert self.cd.instream(BytesIO(clamd.EICAR)) == expected
@@ -77,6 +110,109 @@ class TestUnixSocket(object):
     def test_insteam_success(self):
         assert self.cd.instream(BytesIO(b"foo")) == {'stream': ('OK', None)}
 
+    def test_instream_bytes_like(self):
+        expected = {'stream': ('FOUND', 'Eicar-Test-Signature')}
+        assert self.cd.instream(clamd.EICAR) == expected
+        assert self.cd.instream(bytearray(clamd.EICAR)) == expected
+        assert self.cd.instream(memoryview(clamd.EICAR)) == expected
+
+    def test_instream_mmap(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(clamd.EICAR)
+            f.flush()
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                expected = {'stream': ('FOUND', 'Eicar-Test-Signature')}
+                assert self.cd.instream(m, chunk_size=16) == expected
+            finally:
+                m.close()
+
+    def test_instream_path(self):
+        with tempfile.NamedTemporaryFile('wb', prefix="python-clamd") as f:
+            f.write(clamd.EICAR)
+            f.flush()
+            expected = {'stream': ('FOUND', 'Eicar-Test-Signature')}
+
+            assert self.cd.instream_path(f.name) == expected
+
+    def test_instream_path_empty(self):
+        with tempfile.NamedTemporaryFile('wb', prefix="python-clamd") as f:
+            assert self.cd.instream_path(f.name) == {'stream': ('OK', None)}
+
+    def test_fildes(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(clamd.EICAR)
+            f.flush()
+            result = self.cd.fildes(f)
+            assert list(result.values()) == [('FOUND', 'Eicar-Test-Signature')]
+
+    def test_session(self):
+        with self.cd.session() as session:
+            assert session.ping() == 'PONG'
+            assert session.version().startswith("ClamAV")
+            assert session.instream(BytesIO(b"foo")) == {'stream': ('OK', None)}
+        assert session.closed
+
+    def test_session_fildes(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(clamd.EICAR)
+            f.flush()
+            with self.cd.session() as session:
+                result = session.fildes(f.fileno())
+            assert list(result.values()) == [('FOUND', 'Eicar-Test-Signature')]
+
+    def test_session_pipeline(self):
+        with self.cd.session(max_pending=2) as session:
+            ids = [
+                session.submit_instream(BytesIO(clamd.EICAR)),
+                session.submit_ping(),
+                session.submit_instream(BytesIO(b"foo")),
+            ]
+            assert session.result(ids[2]) == {'stream': ('OK', None)}
+            assert session.results() == [
+                (ids[0], {'stream': ('FOUND', 'Eicar-Test-Signature')}),
+                (ids[1], 'PONG'),
+            ]
+
+    def test_scan_many(self):
+        results = self.cd.scan_many([b"foo", BytesIO(clamd.EICAR), bytearray(b"foo"), clamd.EICAR])
+        assert results == [
+            {'stream': ('OK', None)},
+            {'stream': ('FOUND', 'Eicar-Test-Signature')},
+            {'stream': ('OK', None)},
+            {'stream': ('FOUND', 'Eicar-Test-Signature')},
+        ]
+        assert results[0] is not results[2]
+
+    def test_instream_writer(self):
+        tee = BytesIO()
+        with self.cd.instream_writer(tee=tee, chunk_size=16) as sink:
+            for i in range(0, len(clamd.EICAR), 5):
+                sink.write(clamd.EICAR[i:i + 5])
+        assert sink.result == {'stream': ('FOUND', 'Eicar-Test-Signature')}
+        assert tee.getvalue() == clamd.EICAR
+        assert sink.closed
+
+    def test_instream_writer_large_writes(self):
+        sink = self.cd.instream_writer(chunk_size=4)
+        sink.write(b"foo")
+        sink.write(b"bar" * 10)
+        assert sink.close() == {'stream': ('OK', None)}
+        assert sink.bytes_written == 33
+
+    def test_tracer(self):
+        traces = []
+        self.cd.tracer = traces.append
+        self.cd.ping()
+        self.cd.instream(b"foo", chunk_size=2)
+        assert [trace.command for trace in traces] == ['PING', 'INSTREAM']
+        trace = traces[1]
+        assert trace.endpoint == 'unix:' + self.cd.unix_socket
+        assert trace.bytes_sent == len(b'nINSTREAM\n') + 4 + 2 + 4 + 1 + 4
+        assert trace.bytes_received == len(b'stream: OK\n')
+        assert trace.duration >= trace.connect + trace.send + trace.wait + trace.parse
+        assert trace.error is None
+
 
 class TestUnixSocketTimeout(TestUnixSocket):
     kwargs = {"timeout": 20}
@@ -85,3 +221,367 @@ class TestUnixSocketTimeout(TestUnixSocket):
 def test_cannot_connect():
     with pytest.raises(clamd.ConnectionError):
         clamd.ClamdUnixSocket(path="/tmp/404").ping()
+
+
+def test_tracer_error():
+    traces = []
+    cd = clamd.ClamdUnixSocket(path="/tmp/404")
+    cd.tracer = traces.append
+    with pytest.raises(clamd.ConnectionError):
+        cd.ping()
+    assert isinstance(traces[0].error, clamd.ConnectionError)
+    assert traces[0].connect > 0
+
+
+def test_scan_many_deduplicates():
+    with FakeClamd() as server:
+        results = server.client().scan_many([b"foo"] * 10 + [clamd.EICAR] * 10)
+        assert results == [{'stream': ('OK', None)}] * 10 + [{'stream': ('FOUND', 'Eicar-Test-Signature')}] * 10
+        assert server.commands['INSTREAM'] == 2
+
+
+class FailingReader(object):
+    """
+    file like object whose read() fails after the first chunk
+    """
+    def __init__(self):
+        self.reads = 0
+
+    def read(self, size):
+        self.reads += 1
+        if self.reads > 1:
+            raise IOError("disk error")
+        return b"x" * size
+
+
+def test_instream_source_error():
+    with FakeClamd() as server:
+        # clamd sends nothing while it waits for the rest of the stream:
+        # the error is raised as is, without waiting for a reply
+        cd = clamd.ClamdNetworkSocket(server.host, server.port, timeout=None)
+        with pytest.raises(IOError) as excinfo:
+            cd.instream(FailingReader())
+        assert not isinstance(excinfo.value, clamd.ClamdError)
+        with cd.session() as session:
+            with pytest.raises(IOError):
+                session.instream(FailingReader())
+            assert session.closed
+
+
+def test_instream_path_truncated(monkeypatch):
+    with mkdtemp() as d, FakeClamd() as server:
+        path = os.path.join(d, 'shrinking')
+        with open(path, 'wb') as f:
+            f.write(b"x" * 8192)
+        fstat = os.fstat
+
+        def truncating_fstat(fd):
+            # the file shrinks once its size was read
+            st = fstat(fd)
+            os.truncate(path, 10)
+            return st
+
+        monkeypatch.setattr(os, 'fstat', truncating_fstat)
+        cd = clamd.ClamdNetworkSocket(server.host, server.port, timeout=None)
+        with pytest.raises(IOError):
+            cd.instream_path(path, chunk_size=1024)
+        with open(path, 'wb') as f:
+            f.write(b"x" * 8192)
+        with cd.session() as session:
+            with pytest.raises(IOError):
+                session.instream_path(path)
+            assert session.closed
+
+
+class Py2View(object):
+    """
+    stand-in for a python 2 memoryview, which has no release()
+    """
+    def __init__(self, data):
+        self.data = bytes(memoryview(data))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Py2View(self.data[index])
+        return self.data[index]
+
+
+def py2_byte_view(data):
+    return data.data if isinstance(data, Py2View) else Py2View(data)
+
+
+@pytest.fixture
+def py2_views(monkeypatch):
+    monkeypatch.setattr(clamd, '_byte_view', py2_byte_view)
+    monkeypatch.setattr(clamd, '_send_buffers', lambda sock, buffers: sock.sendall(b''.join(map(bytes, buffers))))
+
+
+def test_instream_without_memoryview_release(py2_views):
+    with FakeClamd() as server:
+        cd = server.client()
+        assert cd.instream(clamd.EICAR) == {'stream': ('FOUND', 'Eicar-Test-Signature')}
+        assert cd.instream(bytearray(b"foo")) == {'stream': ('OK', None)}
+
+
+def test_scan_many_without_memoryview_release(py2_views):
+    with FakeClamd() as server:
+        results = server.client().scan_many([b"foo", bytearray(clamd.EICAR), BytesIO(b"foo")])
+        assert results == [{'stream': ('OK', None)}, {'stream': ('FOUND', 'Eicar-Test-Signature')},
+                           {'stream': ('OK', None)}]
+        assert server.commands['INSTREAM'] == 2
+
+
+def test_fildes_unsupported(monkeypatch):
+    monkeypatch.setattr(clamd, '_FILDES_SUPPORTED', False)
+    with mkdtemp() as d, FakeClamd(os.path.join(d, 'clamd.ctl')) as server:
+        cd = server.client()
+        with tempfile.TemporaryFile() as f:
+            with pytest.raises(clamd.ClamdError):
+                cd.fildes(f)
+            with cd.session() as session:
+                with pytest.raises(clamd.ClamdError):
+                    session.fildes(f)
+                assert session.ping() == 'PONG'
+        assert server.commands['FILDES'] == 0
+
+
+def test_instream_writer_too_long():
+    with FakeClamd(stream_max_length=1024) as server:
+        sink = server.client().instream_writer(chunk_size=512)
+        with pytest.raises(clamd.BufferTooLongError):
+            for _ in range(10000):
+                sink.write(b"x" * 512)
+            sink.close()
+        assert sink.closed
+
+
+def test_deadline():
+    with FakeClamd(latency=1) as server:
+        cd = clamd.ClamdNetworkSocket(server.host, server.port, deadline=0.2)
+        start = time.time()
+        with pytest.raises(clamd.ConnectionError):
+            cd.instream(BytesIO(b"foo"))
+        assert time.time() - start < 0.9
+        assert cd.ping() == 'PONG'
+
+        for scan in (cd.scan, cd.multiscan, lambda path: list(cd.iter_contscan(path))):
+            start = time.time()
+            with pytest.raises(clamd.ConnectionError):
+                scan(os.path.abspath(__file__))
+            assert time.time() - start < 0.9
+
+
+def test_connect_timeout():
+    cd = clamd.ClamdNetworkSocket('10.255.255.1', 3310, timeout=20, connect_timeout=0.2)
+    start = time.time()
+    with pytest.raises(clamd.ConnectionError):
+        cd.ping()
+    assert time.time() - start < 1
+
+
+def test_resolution_cached(monkeypatch):
+    calls = []
+    getaddrinfo = socket.getaddrinfo
+
+    def counting_getaddrinfo(*args):
+        calls.append(args)
+        return getaddrinfo(*args)
+
+    monkeypatch.setattr(socket, 'getaddrinfo', counting_getaddrinfo)
+    with FakeClamd() as server:
+        cd = clamd.ClamdNetworkSocket('localhost', server.port)
+        cd.ping()
+        cd.ping()
+        assert len(calls) == 1
+        cd.resolve_ttl = 0
+        cd.ping()
+        assert len(calls) == 2
+
+
+def test_address_failover():
+    with FakeClamd() as server:
+        dead = socket.socket()
+        dead.bind(('127.0.0.1', 0))
+        cd = clamd.ClamdNetworkSocket('127.0.0.1', server.port)
+        good = cd._resolve()[0]
+        bad = good[:4] + (dead.getsockname(),)
+        cd._addresses = [bad, good]
+        assert cd.ping() == 'PONG'
+        assert cd._addresses == [good, bad]
+        dead.close()
+
+
+@pytest.mark.skipif(not socket.has_ipv6, reason="no IPv6")
+def test_ipv6():
+    try:
+        server = FakeClamd(host='::1')
+    except socket.error:
+        pytest.skip("no IPv6 loopback")
+    with server:
+        assert clamd.ClamdNetworkSocket('::1', server.port).ping() == 'PONG'
+
+
+def test_response_reader():
+    a, b = socket.socketpair()
+    with contextlib.closing(a), contextlib.closing(b):
+        reader = clamd._ResponseReader(a, size=8)
+        b.sendall(b"1: PONG\0" + b"2: stream: OK\0" + b"3: " + b"x" * 100 + b"\n4: END")
+        b.shutdown(socket.SHUT_WR)
+        assert reader.readline() == b"1: PONG"
+        assert reader.readline() == b"2: stream: OK"
+        assert reader.readline() == b"3: " + b"x" * 100
+        assert reader.readline() == b"4: END"
+        assert reader.readline() is None
+
+
+def test_response_reader_max_line():
+    a, b = socket.socketpair()
+    with contextlib.closing(a), contextlib.closing(b):
+        reader = clamd._ResponseReader(a, size=8, max_line=64)
+        b.sendall(b"x" * 100)
+        with pytest.raises(clamd.ResponseError):
+            reader.readline()
+
+
+def test_z_mode_file_names():
+    with mkdtemp() as d, FakeClamd(os.path.join(d, 'clamd.ctl')) as server:
+        top = os.path.join(d, 'files')
+        os.mkdir(top)
+        names = [os.path.join(top, 'new\nline'), os.path.join(top, os.fsdecode(b'latin-1 \xe9'))]
+        for name in names:
+            with open(name, 'wb') as f:
+                f.write(clamd.EICAR)
+        cd = server.client()
+        expected = dict((name, ('FOUND', 'Eicar-Test-Signature')) for name in names)
+        assert cd.contscan(top) == expected
+        assert cd.contscan(os.fsencode(top)) == dict((os.fsencode(name), v) for name, v in expected.items())
+        with cd.session() as session:
+            assert session.scan(os.fsencode(names[0])) == {os.fsencode(names[0]): expected[names[0]]}
+        assert cd.stats().rstrip().endswith('END')
+
+        cd.command_mode = 'n'
+        assert cd.scan(names[1]) == {names[1]: expected[names[1]]}
+        with pytest.raises(ValueError):
+            cd.scan(names[0])
+
+
+def test_allmatchscan():
+    verdicts = {b'AAA': 'Sig.A', b'BBB': 'Sig.B'}
+    with mkdtemp() as d, FakeClamd(os.path.join(d, 'clamd.ctl'), verdicts=verdicts) as server:
+        top = os.path.join(d, 'files')
+        os.mkdir(top)
+        for name, content in (('both', b'AAA BBB'), ('clean', b'foo'), ('one', b'BBB')):
+            with open(os.path.join(top, name), 'wb') as f:
+                f.write(content)
+        cd = server.client()
+        both, one = os.path.join(top, 'both'), os.path.join(top, 'one')
+        assert list(cd.iter_allmatchscan(top)) == [
+            (both, (('FOUND', 'Sig.A'), ('FOUND', 'Sig.B'))),
+            (one, (('FOUND', 'Sig.B'),)),
+        ]
+        assert cd.allmatchscan(both) == {both: (('FOUND', 'Sig.A'), ('FOUND', 'Sig.B'))}
+        assert cd.contscan(top) == {both: ('FOUND', 'Sig.A'), one: ('FOUND', 'Sig.B')}
+
+        results = clamd.ScanResults(cd.iter_allmatchscan(top))
+        assert results.counts['FOUND'] == 3
+        assert [r.reason for r in results.found] == ['Sig.A', 'Sig.B', 'Sig.B']
+
+
+def test_stream_max_length_learned():
+    with FakeClamd(stream_max_length=1024) as server:
+        cd = server.client()
+        with pytest.raises(clamd.BufferTooLongError):
+            cd.instream(b"x" * 4096)
+        assert cd.stream_max_length == 4095
+        with pytest.raises(clamd.BufferTooLongError):
+            cd.instream(BytesIO(b"x" * 5000))
+        assert server.commands['INSTREAM'] == 1
+        assert cd.instream(b"x" * 1000) == {'stream': ('OK', None)}
+        metrics = cd.metrics()
+        assert metrics['stream_instream_total'] == 2
+        assert metrics['stream_too_long_total'] == 1
+        assert metrics['stream_rejected_total'] == 1
+
+
+def test_stream_max_length_learned_bound():
+    with mkdtemp() as d, FakeClamd(os.path.join(d, 'clamd.ctl'), stream_max_length=1024) as server:
+        path = os.path.join(d, 'medium')
+        with open(path, 'wb') as f:
+            f.write(b"x" * 2000)
+        cd = server.client()
+        with pytest.raises(clamd.BufferTooLongError):
+            cd.instream(b"x" * 4096)
+        # 2000 bytes may or may not fit below the learned 4095: not uploaded when FILDES applies
+        assert cd.instream_path(path) == {'stream': ('OK', None)}
+        assert (server.commands['INSTREAM'], server.commands['FILDES']) == (1, 1)
+        with pytest.raises(clamd.BufferTooLongError):
+            cd.instream(b"x" * 2000)
+        assert cd.stream_max_length == 1999
+        assert cd.instream(b"x" * 1000) == {'stream': ('OK', None)}
+        with open(path, 'wb') as f:
+            f.write(b"x" * 900)
+        # below what clamd accepted: INSTREAM
+        assert cd.instream_path(path) == {'stream': ('OK', None)}
+        assert (server.commands['INSTREAM'], server.commands['FILDES']) == (4, 1)
+
+        cd.stream_max_length = 4095
+        with open(path, 'wb') as f:
+            f.write(b"x" * 1010)
+        # a configured limit is trusted
+        assert cd.instream_path(path) == {'stream': ('OK', None)}
+        assert server.commands['FILDES'] == 1
+
+
+def test_stream_max_length_routing():
+    with mkdtemp() as d, FakeClamd(os.path.join(d, 'clamd.ctl'), stream_max_length=1024) as server:
+        path = os.path.join(d, 'big')
+        with open(path, 'wb') as f:
+            f.write(b"x" * 4096 + clamd.EICAR)
+        expected = {'stream': ('FOUND', 'Eicar-Test-Signature')}
+        cd = server.client()
+        cd.stream_max_length = 1024
+        assert cd.instream_path(path) == expected
+        with open(path, 'rb') as f:
+            assert cd.instream(f) == expected
+        with cd.session() as session:
+            assert session.instream_path(path) == expected
+            with pytest.raises(clamd.BufferTooLongError):
+                session.instream(b"x" * 4096)
+        assert server.commands['FILDES'] == 3
+        assert server.commands['INSTREAM'] == 0
+
+        cd.oversized_routes = ('scan',)
+        assert cd.instream_path(path) == expected
+        assert server.commands['SCAN'] == 1
+        cd.oversized_routes = ()
+        with pytest.raises(clamd.BufferTooLongError):
+            cd.instream_path(path)
+        assert cd.metrics()['stream_rejected_total'] == 2
+        assert server.commands['INSTREAM'] == 0
+
+        cd.oversized_routes = ('fildes', 'scan')
+        with open(path, 'rb') as f:
+            f.read(1)
+            # the file holds more than what is left to read from f
+            with pytest.raises(clamd.BufferTooLongError):
+                cd.instream(f)
+        assert server.commands['SCAN'] == 1
+
+
+def test_scan_many_oversized():
+    with mkdtemp() as d, FakeClamd(os.path.join(d, 'clamd.ctl'), stream_max_length=1024) as server:
+        path = os.path.join(d, 'big')
+        with open(path, 'wb') as f:
+            f.write(b"x" * 4096 + clamd.EICAR)
+        cd = server.client()
+        cd.stream_max_length = 1024
+        with open(path, 'rb') as f:
+            results = cd.scan_many([b"foo", b"x" * 4096, f])
+        assert results[0] == {'stream': ('OK', None)}
+        assert isinstance(results[1], clamd.BufferTooLongError)
+        assert results[2] == {'stream': ('FOUND', 'Eicar-Test-Signature')}
+        assert server.commands['INSTREAM'] == 1
+        assert server.commands['FILDES'] == 1
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import clamd
+from clamd.cache import CachingClamd, ScanCache
+from clamd.testing import FakeClamd
+from io import BytesIO
+import os
+import shutil
+import tempfile
+
+
+class CountingClient(object):
+    """
+    stands in for clamd, flags EICAR and counts the scans
+    """
+    def __init__(self):
+        self.signatures = '26700'
+        self.scans = 0
+
+    def version(self):
+        return 'ClamAV 0.103.8/{0}/Mon Oct 12 09:00:00 2026'.format(self.signatures)
+
+    def instream(self, buff):
+        self.scans += 1
+        data = buff if isinstance(buff, bytes) else buff.read()
+        if data == clamd.EICAR:
+            return {'stream': ('FOUND', 'Eicar-Test-Signature')}
+        return {'stream': ('OK', None)}
+
+    def scan(self, file):
+        with open(file, 'rb') as f:
+            return {file: self.instream(f)['stream']}
+
+
+def test_parse_version():
+    assert clamd.parse_version('ClamAV 0.103.8/26700/Mon Oct 12 09:00:00 2026') == (
+        '0.103.8', '26700', 'Mon Oct 12 09:00:00 2026')
+    assert clamd.parse_version('ClamAV 0.103.8') == ('0.103.8', None, None)
+
+
+def test_cache_lru():
+    cache = ScanCache(max_entries=2)
+    cache.set_version('1')
+    cache.set(b'a', ('OK', None))
+    cache.set(b'b', ('OK', None))
+    assert cache.get(b'a') == ('OK', None)
+    cache.set(b'c', ('OK', None))
+    assert cache.get(b'b') is None
+    assert cache.get(b'a') == ('OK', None)
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_cache_max_bytes():
+    cache = ScanCache(max_bytes=1000)
+    for i in range(100):
+        cache.set(str(i).encode('ascii'), ('FOUND', 'Eicar-Test-Signature'))
+    assert 0 < len(cache) < 100
+    assert cache.size <= 1000
+
+
+def test_cache_ignores_stale_version():
+    cache = ScanCache()
+    cache.set_version('1')
+    cache.set(b'a', ('OK', None), version='0')
+    assert cache.get(b'a') is None
+
+
+def test_caching_instream():
+    client = CountingClient()
+    cd = CachingClamd(client)
+    expected = {'stream': ('FOUND', 'Eicar-Test-Signature')}
+
+    assert cd.instream(clamd.EICAR) == expected
+    assert cd.instream(BytesIO(clamd.EICAR)) == expected
+    assert cd.instream(b"foo") == {'stream': ('OK', None)}
+    assert client.scans == 2
+
+
+class ChangingFile(BytesIO):
+    """
+    file whose content is replaced by EICAR the first time it is rewound
+    """
+    changed = False
+
+    def seek(self, *args):
+        position = BytesIO.seek(self, *args)
+        if not self.changed:
+            self.changed = True
+            self.write(clamd.EICAR)
+            position = BytesIO.seek(self, *args)
+        return position
+
+
+def test_caching_instream_changed_file():
+    client = CountingClient()
+    cd = CachingClamd(client)
+    # hashed as b"foo", scanned as EICAR: the verdict belongs to EICAR
+    assert cd.instream(ChangingFile(b"foo")) == {'stream': ('FOUND', 'Eicar-Test-Signature')}
+    assert cd.instream(b"foo") == {'stream': ('OK', None)}
+    assert cd.instream(clamd.EICAR) == {'stream': ('FOUND', 'Eicar-Test-Signature')}
+    assert client.scans == 2
+
+
+def test_caching_scan_remote():
+    client = CountingClient()
+    cd = CachingClamd(client)
+    with tempfile.NamedTemporaryFile('wb', prefix="python-clamd") as f:
+        f.write(clamd.EICAR)
+        f.flush()
+        expected = {f.name: ('FOUND', 'Eicar-Test-Signature')}
+
+        # a remote clamd may see another file under that name: not cached
+        assert cd.scan(f.name) == expected
+        assert cd.scan(f.name) == expected
+        assert client.scans == 2
+
+
+def test_signature_update_invalidates():
+    client = CountingClient()
+    cd = CachingClamd(client, version_check_interval=0)
+    cd.instream(b"foo")
+    cd.instream(b"foo")
+    assert client.scans == 1
+
+    client.signatures = '26701'
+    cd.instream(b"foo")
+    assert client.scans == 2
+
+
+def test_caching_scan_unreadable_file():
+    client = CountingClient()
+    client.scan = lambda file: {file: ('ERROR', 'No such file or directory')}
+    cd = CachingClamd(client)
+    assert cd.scan('/tmp/404') == {'/tmp/404': ('ERROR', 'No such file or directory')}
+    assert client.scans == 0
+
+
+def test_caching_scan_fildes():
+    directory = tempfile.mkdtemp()
+    try:
+        with FakeClamd(os.path.join(directory, 'clamd.ctl')) as server:
+            path = os.path.join(directory, 'eicar')
+            with open(path, 'wb') as f:
+                f.write(clamd.EICAR)
+            cd = CachingClamd(server.client())
+            expected = {path: ('FOUND', 'Eicar-Test-Signature')}
+            assert cd.scan(path) == expected
+            assert cd.scan(path) == expected
+            assert cd.instream_path(path) == {'stream': ('FOUND', 'Eicar-Test-Signature')}
+            assert server.commands['FILDES'] == 1
+            assert server.commands['SCAN'] == 0
+            assert server.commands['INSTREAM'] == 0
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_caching_scan_without_fildes(monkeypatch):
+    monkeypatch.setattr(clamd, '_FILDES_SUPPORTED', False)
+    directory = tempfile.mkdtemp()
+    try:
+        with FakeClamd(os.path.join(directory, 'clamd.ctl')) as server:
+            path = os.path.join(directory, 'eicar')
+            with open(path, 'wb') as f:
+                f.write(clamd.EICAR)
+            cd = CachingClamd(server.client())
+            expected = {path: ('FOUND', 'Eicar-Test-Signature')}
+            assert cd.scan(path) == expected
+            assert cd.scan(path) == expected
+            assert server.commands['INSTREAM'] == 1
+            assert server.commands['FILDES'] == 0
+    finally:
+        shutil.rmtree(directory)
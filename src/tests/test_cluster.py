@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from io import BytesIO
+import time
+
+import clamd
+from clamd.cluster import ClamdCluster, endpoint_client
+
+import pytest
+
+
+class TestCluster(object):
+    def setup_method(self):
+        self.cluster = ClamdCluster([clamd.ClamdUnixSocket(), clamd.ClamdUnixSocket(path="/tmp/404")],
+                                    down_interval=60)
+
+    def teardown_method(self):
+        self.cluster.close()
+
+    def test_failover(self):
+        for _ in range(4):
+            assert self.cluster.ping() == 'PONG'
+        dead = self.cluster.nodes[1]
+        assert not dead.up
+        assert dead.requests == 1
+        assert self.cluster.metrics()['cluster_failovers_total'] == 1
+
+    def test_instream_retry(self):
+        self.cluster.nodes[0].outstanding = 1
+        expected = {'stream': ('FOUND', 'Eicar-Test-Signature')}
+        assert self.cluster.instream(BytesIO(clamd.EICAR)) == expected
+        assert self.cluster.nodes[1].failures == 1
+        self.cluster.nodes[0].outstanding = 0
+
+    def test_all_down(self):
+        cluster = ClamdCluster(["/tmp/404"])
+        with pytest.raises(clamd.ConnectionError):
+            cluster.ping()
+        # a node is still tried when every node is down
+        with pytest.raises(clamd.ConnectionError):
+            cluster.ping()
+        assert cluster.nodes[0].failures == 2
+
+    def test_check(self):
+        assert self.cluster.check() == 1
+        self.cluster.nodes[1].client = self.cluster.nodes[0].client
+        self.cluster.nodes[1].pool.client = self.cluster.nodes[0].client
+        assert self.cluster.check() == 2
+
+    def test_least_outstanding(self):
+        self.cluster.check()
+        self.cluster.nodes[1].up = True
+        self.cluster.nodes[1].outstanding = 5
+        assert self.cluster._pick(self.cluster.nodes, []) is self.cluster.nodes[0]
+
+    def test_probe_off_caller_thread(self):
+        self.cluster.check()
+        dead = self.cluster.nodes[1]
+        dead.client = dead.pool.client = self.cluster.nodes[0].client
+        dead.retry_at = 0
+        # the caller gets a node that is up, the probe runs on its own
+        assert self.cluster._pick(self.cluster.nodes, []) is self.cluster.nodes[0]
+        for _ in range(100):
+            if dead.up:
+                break
+            time.sleep(0.01)
+        assert dead.up
+
+    def test_reload(self):
+        cluster = ClamdCluster([clamd.ClamdUnixSocket(), clamd.ClamdUnixSocket()])
+        picked = []
+
+        def wait_ready(node, timeout, interval):
+            # the reloading node is kept out until it answers
+            assert node.reloading
+            picked.append(cluster._pick(cluster.nodes, []))
+            ClamdCluster._wait_ready(cluster, node, timeout, interval)
+
+        cluster._wait_ready = wait_ready
+        cluster.reload()
+        assert picked == [cluster.nodes[1], cluster.nodes[0]]
+        assert not any(node.reloading for node in cluster.nodes)
+        cluster.close()
+
+    def test_reload_unreachable(self):
+        self.cluster.nodes[1].up = True
+        self.cluster.reload(timeout=0)
+        assert not self.cluster.nodes[1].up
+
+    def test_fildes(self):
+        with open('/etc/hostname', 'rb') as f:
+            assert list(self.cluster.fildes(f).values())[0][0] == 'OK'
+
+
+def test_endpoint_client():
+    client = endpoint_client('unix:/run/clamd.ctl')
+    assert client.unix_socket == '/run/clamd.ctl'
+    client = endpoint_client('clamd.example.com:3311')
+    assert (client.host, client.port) == ('clamd.example.com', 3311)
+    client = endpoint_client('[::1]:3311')
+    assert (client.host, client.port) == ('::1', 3311)
+    assert endpoint_client('::1').port == 3310
+    with pytest.raises(ValueError):
+        endpoint_client('host:port')
+
+
+def test_fildes_needs_unix_node():
+    with pytest.raises(clamd.ClamdError):
+        ClamdCluster(['127.0.0.1:3310']).fildes(0)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import clamd
+from clamd.index import ScanIndex
+import os
+import shutil
+import stat
+import tempfile
+
+import pytest
+
+mine = (stat.S_IREAD | stat.S_IWRITE)
+other = stat.S_IROTH
+execute = (stat.S_IEXEC | stat.S_IXOTH)
+
+
+@pytest.fixture
+def tree():
+    top = tempfile.mkdtemp(prefix="python-clamd")
+    for i in range(5):
+        with open(os.path.join(top, "file" + str(i)), 'wb') as f:
+            f.write(clamd.EICAR if i == 0 else b"foo")
+            os.fchmod(f.fileno(), (mine | other))
+    os.chmod(top, (mine | other | execute))
+    try:
+        yield top
+    finally:
+        shutil.rmtree(top)
+
+
+@pytest.fixture
+def index(tree):
+    with ScanIndex(os.path.join(tree, "index.sqlite")) as index:
+        yield index
+
+
+def test_lookup(tree, index):
+    path = os.path.join(tree, "file1")
+    st = os.stat(path)
+    index.record(path, st, ('OK', None), '26700')
+
+    assert index.lookup(path, st, '26700') == ('OK', None)
+    assert index.lookup(path, st, '26701') is None
+
+    with open(path, 'ab') as f:
+        f.write(b"bar")
+    assert index.lookup(path, os.stat(path), '26700') is None
+
+
+def test_errors_are_not_trusted(tree, index):
+    path = os.path.join(tree, "file1")
+    st = os.stat(path)
+    index.record(path, st, ('ERROR', 'Access denied'), '26700')
+    assert index.lookup(path, st, '26700') is None
+
+
+def test_prune(tree, index):
+    path = os.path.join(tree, "file1")
+    index.record(path, os.stat(path), ('OK', None), '26700')
+    os.unlink(path)
+    assert index.prune(tree) == 1
+    assert len(index) == 0
+
+
+def test_incremental_scan(tree, index):
+    cd = clamd.ClamdUnixSocket()
+    files = dict((os.path.join(tree, "file" + str(i)), ('OK', None)) for i in range(5))
+    files[os.path.join(tree, "file0")] = ('FOUND', 'Eicar-Test-Signature')
+
+    assert dict(index.scan(cd, tree, exclude=["index.sqlite*"])) == files
+    assert (index.scanned, index.cached) == (5, 0)
+
+    with open(os.path.join(tree, "file1"), 'wb') as f:
+        f.write(clamd.EICAR)
+    files[os.path.join(tree, "file1")] = ('FOUND', 'Eicar-Test-Signature')
+
+    assert dict(index.scan(cd, tree, exclude=["index.sqlite*"])) == files
+    assert (index.scanned, index.cached) == (1, 4)
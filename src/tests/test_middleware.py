@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+from io import BytesIO
+
+import clamd
+from clamd.aio import AsyncClamdNetworkSocket, AsyncClamdUnixSocket
+from clamd.middleware import ClamdASGIMiddleware, ClamdWSGIMiddleware
+from clamd.testing import FakeClamd
+
+
+def wsgi_app(environ, start_response):
+    body = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
+    start_response('200 OK', [('Content-Type', 'application/octet-stream')])
+    return [body]
+
+
+def wsgi_call(app, body, chunked=False):
+    environ = {'REQUEST_METHOD': 'POST', 'wsgi.input': BytesIO(body)}
+    if chunked:
+        environ.update({'HTTP_TRANSFER_ENCODING': 'chunked', 'wsgi.input_terminated': True})
+    else:
+        environ['CONTENT_LENGTH'] = str(len(body))
+    statuses = []
+    response = app(environ, lambda status, headers: statuses.append(status))
+    try:
+        return statuses[0], b''.join(response)
+    finally:
+        if hasattr(response, 'close'):
+            response.close()
+
+
+class TestWSGIMiddleware(object):
+    def setup_method(self):
+        self.app = ClamdWSGIMiddleware(wsgi_app, clamd.ClamdUnixSocket(), max_memory=16)
+
+    def test_clean(self):
+        assert wsgi_call(self.app, b"foo" * 100) == ('200 OK', b"foo" * 100)
+
+    def test_chunked(self):
+        assert wsgi_call(self.app, b"foo" * 100, chunked=True) == ('200 OK', b"foo" * 100)
+
+    def test_infected(self):
+        status, body = wsgi_call(self.app, clamd.EICAR)
+        assert status == '403 Forbidden'
+        assert b'Eicar-Test-Signature' in body
+
+    def test_no_body(self):
+        environ = {'REQUEST_METHOD': 'GET', 'wsgi.input': BytesIO()}
+        assert ClamdWSGIMiddleware(lambda environ, start_response: [b"ok"], None)(environ, None) == [b"ok"]
+
+    def test_unavailable(self):
+        app = ClamdWSGIMiddleware(wsgi_app, clamd.ClamdUnixSocket(path="/tmp/404"))
+        assert wsgi_call(app, b"foo")[0] == '503 Service Unavailable'
+        app = ClamdWSGIMiddleware(wsgi_app, clamd.ClamdUnixSocket(path="/tmp/404"), fail_open=True)
+        assert wsgi_call(app, b"foo") == ('200 OK', b"foo")
+
+
+def test_wsgi_too_long():
+    with FakeClamd(stream_max_length=1024) as server:
+        app = ClamdWSGIMiddleware(wsgi_app, server.client())
+        assert wsgi_call(app, b"x" * 1024 * 1024)[0] == '413 Payload Too Large'
+        assert wsgi_call(app, b"foo") == ('200 OK', b"foo")
+
+
+def asgi_call(app, chunks, headers=None):
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': True} for chunk in chunks]
+    messages.append({'type': 'http.request', 'body': b'', 'more_body': False})
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    if headers is None:
+        headers = [(b'content-length', str(sum(len(chunk) for chunk in chunks)).encode())]
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(app({'type': 'http', 'method': 'POST', 'headers': headers}, receive, send))
+    finally:
+        loop.close()
+    return sent[0]['status'], b''.join(message.get('body', b'') for message in sent[1:])
+
+
+async def asgi_app(scope, receive, send):
+    body = b''
+    while True:
+        message = await receive()
+        body += message['body']
+        if not message['more_body']:
+            break
+    await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class TestASGIMiddleware(object):
+    def setup_method(self):
+        self.app = ClamdASGIMiddleware(asgi_app, AsyncClamdUnixSocket(), max_memory=16, chunk_size=7)
+
+    def test_clean(self):
+        assert asgi_call(self.app, [b"foo"] * 10) == (200, b"foo" * 10)
+
+    def test_infected(self):
+        status, body = asgi_call(self.app, [clamd.EICAR[:20], clamd.EICAR[20:]])
+        assert status == 403
+
+    def test_chunked(self):
+        assert asgi_call(self.app, [b"foo"] * 10, [(b'transfer-encoding', b'chunked')]) == (200, b"foo" * 10)
+
+    def test_unavailable(self):
+        app = ClamdASGIMiddleware(asgi_app, AsyncClamdUnixSocket(path="/tmp/404"))
+        assert asgi_call(app, [b"foo"])[0] == 503
+
+    def test_no_body(self):
+        app = ClamdASGIMiddleware(asgi_app, AsyncClamdUnixSocket(path="/tmp/404"))
+        assert asgi_call(app, [], []) == (200, b"")
+
+
+def test_asgi_too_long():
+    with FakeClamd(stream_max_length=1024) as server:
+        app = ClamdASGIMiddleware(asgi_app, AsyncClamdNetworkSocket(server.host, server.port))
+        assert asgi_call(app, [b"x" * 64 * 1024] * 16)[0] == 413
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import clamd
+from clamd.pool import ClamdPool, PoolTimeoutError
+from io import BytesIO
+import threading
+
+import pytest
+
+
+class TestPool(object):
+
+    def setup_method(self):
+        self.pool = ClamdPool(clamd.ClamdUnixSocket(), maxsize=2, checkout_timeout=1)
+
+    def teardown_method(self):
+        self.pool.close()
+
+    def test_ping(self):
+        assert self.pool.ping() == 'PONG'
+
+    def test_reuses_connections(self):
+        assert self.pool.ping() == 'PONG'
+        with self.pool.connection() as first:
+            pass
+        with self.pool.connection() as second:
+            assert second is first
+
+    def test_exhausted(self):
+        with self.pool.connection():
+            with self.pool.connection():
+                with pytest.raises(PoolTimeoutError):
+                    self.pool.checkout()
+
+    def test_threads(self):
+        results = []
+
+        def worker():
+            for i in range(10):
+                results.append(self.pool.instream(BytesIO(clamd.EICAR)))
+
+        threads = [threading.Thread(target=worker) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert results == [{'stream': ('FOUND', 'Eicar-Test-Signature')}] * 80
+        assert len(self.pool._idle) <= 2
+
+    def test_fatal_session_error(self):
+        with pytest.raises(clamd.ResponseError):
+            with self.pool.connection() as session:
+                session.result(session._submit('basic', 'RELOAD'))
+        assert session.closed
+        assert not self.pool._idle
+        assert self.pool.ping() == 'PONG'
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import clamd
+
+import pytest
+
+
+@pytest.mark.parametrize("line", [
+    "stream: OK",
+    "stream: Eicar-Test-Signature FOUND",
+    "/tmp/a: b: OK",
+    "/tmp/a: b: Eicar-Test-Signature FOUND",
+    "/tmp/a: lstat() failed: No such file or directory. ERROR",
+    "/tmp/a: FOUND",
+    "x:  OK",
+    "INSTREAM size limit exceeded. ERROR",
+    "PONG",
+])
+def test_parse_scan_line_matches_regex(line):
+    match = clamd.scan_response.match(line)
+    expected = match.group("path", "virus", "status") if match else None
+    assert clamd.parse_scan_line(line) == expected
+
+
+def test_scan_results_counts():
+    results = clamd.ScanResults({
+        '/a': ('OK', None),
+        '/b': ('FOUND', 'Eicar-Test-Signature'),
+        '/c': ('ERROR', 'Access denied'),
+    })
+    results.update([clamd.ScanResult('/d', 'OK')])
+
+    assert results.counts == {'OK': 2, 'FOUND': 1, 'ERROR': 1}
+    assert results.total == 4
+    assert len(results) == 2
+    assert results.found == [clamd.ScanResult('/b', 'FOUND', 'Eicar-Test-Signature')]
+    assert results.errors[0].reason == 'Access denied'
+    assert results.to_dict() == {
+        '/b': ('FOUND', 'Eicar-Test-Signature'),
+        '/c': ('ERROR', 'Access denied'),
+    }
+
+
+def test_scan_results_keep_ok():
+    results = clamd.ScanResults([('/a', ('OK', None))], keep_ok=True)
+    assert list(results) == [clamd.ScanResult('/a', 'OK')]
+    assert not list(results)[0].infected
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+import clamd
+from clamd.scheduler import AdaptiveScheduler, Lane, PriorityDispatcher, RejectedError
+from clamd.stats import parse_stats
+from clamd.testing import FakeClamd
+
+import pytest
+
+STATS = """POOLS: 1
+
+STATE: VALID PRIMARY
+THREADS: live 4  idle 0 max 4 idle-timeout 30
+QUEUE: {0} items
+
+END
+"""
+
+
+def test_scan():
+    scheduler = AdaptiveScheduler(clamd.ClamdUnixSocket(), stats_interval=None)
+    assert scheduler.instream(BytesIO(clamd.EICAR)) == {'stream': ('FOUND', 'Eicar-Test-Signature')}
+    assert scheduler.metrics()['scheduler_completed_total'] == 1
+
+
+def test_additive_increase():
+    scheduler = AdaptiveScheduler(None, initial_limit=2, stats_interval=None)
+    for _ in range(2):
+        scheduler.acquire()
+        scheduler.acquire()
+        scheduler.release(0.01)
+        scheduler.release(0.01)
+    assert 2 < scheduler.limit < 3
+
+
+def test_multiplicative_decrease():
+    scheduler = AdaptiveScheduler(None, initial_limit=10, backoff=0.5, latency_limit=1, stats_interval=None)
+    scheduler.acquire()
+    scheduler.release(2)
+    assert scheduler.limit == 5
+    scheduler.acquire()
+    scheduler.release(0.01, overloaded=True)
+    # only one decrease per round trip
+    assert scheduler.limit == 5
+
+
+def test_connection_error_decreases():
+    scheduler = AdaptiveScheduler(clamd.ClamdUnixSocket(path="/tmp/404"), initial_limit=10, backoff=0.5,
+                                  stats_interval=None)
+    with pytest.raises(clamd.ConnectionError):
+        scheduler.ping()
+    assert scheduler.limit == 5
+    assert scheduler.in_flight == 0
+
+
+def test_stats():
+    scheduler = AdaptiveScheduler(None, initial_limit=10, backoff=0.5, stats_interval=None)
+    scheduler.update_from_stats(parse_stats(STATS.format(0)))
+    assert scheduler.limit == 4
+    scheduler.update_from_stats(parse_stats(STATS.format(3)))
+    assert scheduler.limit == 2
+
+
+def test_stats_polling_starts_explicitly():
+    with FakeClamd() as server:
+        scheduler = AdaptiveScheduler(server.client(), initial_limit=10, stats_interval=0.01)
+        time.sleep(0.05)
+        assert server.commands['STATS'] == 0
+        with scheduler.start():
+            for _ in range(100):
+                if scheduler.poller.stats is not None:
+                    break
+                time.sleep(0.01)
+            assert server.commands['STATS'] >= 1
+        assert scheduler.poller._thread is None
+
+
+def test_reject():
+    scheduler = AdaptiveScheduler(None, initial_limit=1, max_queue=0, stats_interval=None)
+    scheduler.acquire()
+    with pytest.raises(RejectedError):
+        scheduler.acquire()
+    assert scheduler.metrics()['scheduler_rejected_total'] == 1
+
+
+def test_queue_timeout():
+    scheduler = AdaptiveScheduler(None, initial_limit=1, queue_timeout=0.01, stats_interval=None)
+    scheduler.acquire()
+    with pytest.raises(RejectedError):
+        scheduler.acquire()
+    assert scheduler.waiting == 0
+
+
+def test_wait_for_slot():
+    scheduler = AdaptiveScheduler(None, initial_limit=1, stats_interval=None)
+    scheduler.acquire()
+    waiter = threading.Thread(target=scheduler.acquire)
+    waiter.start()
+    scheduler.release(0.01)
+    waiter.join(1)
+    assert not waiter.is_alive()
+    assert scheduler.in_flight == 1
+
+
+def wait_until(condition, timeout=1):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.001)
+
+
+def test_lane_reservation():
+    dispatcher = PriorityDispatcher(None, [Lane('interactive', 4, reserved=2), Lane('bulk', 4, queue_timeout=0.01)])
+    dispatcher.acquire('bulk')
+    dispatcher.acquire('bulk')
+    with pytest.raises(RejectedError):
+        dispatcher.acquire('bulk')
+    dispatcher.acquire('interactive')
+    dispatcher.acquire('interactive')
+    metrics = dispatcher.metrics()
+    assert metrics['dispatcher_in_flight'] == 4
+    assert metrics['dispatcher_bulk_rejected_total'] == 1
+    with pytest.raises(ValueError):
+        dispatcher.acquire('urgent')
+
+
+def test_lane_preemption():
+    dispatcher = PriorityDispatcher(None, [Lane('interactive', 1), Lane('bulk', 1)], capacity=1)
+    order = []
+
+    def scan(priority):
+        dispatcher.acquire(priority)
+        order.append(priority)
+
+    dispatcher.acquire('bulk')
+    bulk = threading.Thread(target=scan, args=('bulk',))
+    bulk.start()
+    wait_until(lambda: dispatcher.lane('bulk').waiting == 1)
+    interactive = threading.Thread(target=scan, args=('interactive',))
+    interactive.start()
+    wait_until(lambda: dispatcher.lane('interactive').waiting == 1)
+
+    dispatcher.release('bulk')
+    interactive.join(1)
+    assert order == ['interactive']
+    dispatcher.release('interactive')
+    bulk.join(1)
+    assert order == ['interactive', 'bulk']
+
+
+def test_sweep():
+    directory = tempfile.mkdtemp()
+    try:
+        with FakeClamd(os.path.join(directory, 'clamd.ctl')) as server:
+            top = os.path.join(directory, 'files')
+            os.mkdir(top)
+            for name, content in (('clean', b'foo'), ('eicar', clamd.EICAR)):
+                with open(os.path.join(top, name), 'wb') as f:
+                    f.write(content)
+            dispatcher = PriorityDispatcher(server.client())
+            eicar = os.path.join(top, 'eicar')
+            # clamd runs tree scans unless asked to sweep them
+            assert dispatcher.multiscan(top, priority='bulk') == {eicar: ('FOUND', 'Eicar-Test-Signature')}
+            assert server.commands['MULTISCAN'] == 1
+            assert sorted(dispatcher.iter_sweep(top)) == [
+                (os.path.join(top, 'clean'), ('OK', None)),
+                (eicar, ('FOUND', 'Eicar-Test-Signature')),
+            ]
+            assert server.commands['FILDES'] == 2
+
+            dispatcher.sweep_trees = True
+            assert dispatcher.multiscan(top, priority='bulk') == {eicar: ('FOUND', 'Eicar-Test-Signature')}
+            assert server.commands['MULTISCAN'] == 1
+            assert dispatcher.multiscan(top) == {eicar: ('FOUND', 'Eicar-Test-Signature')}
+            assert server.commands['MULTISCAN'] == 2
+            assert dispatcher.metrics()['dispatcher_bulk_completed_total'] == 5
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_sweep_uses_lane_limit():
+    directory = tempfile.mkdtemp()
+    try:
+        with FakeClamd(os.path.join(directory, 'clamd.ctl'), latency=0.2) as server:
+            top = os.path.join(directory, 'files')
+            os.mkdir(top)
+            for i in range(4):
+                with open(os.path.join(top, str(i)), 'wb') as f:
+                    f.write(b'foo')
+            dispatcher = PriorityDispatcher(server.client(), [Lane('interactive', 4), Lane('bulk', 4)])
+            start = time.time()
+            assert len(list(dispatcher.iter_sweep(top))) == 4
+            assert time.time() - start < 0.6
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import clamd
+from clamd.stats import StatsPoller, format_metrics, parse_stats
+import time
+
+import pytest
+
+STATS = """POOLS: 1
+
+STATE: VALID PRIMARY
+THREADS: live 3  idle 1 max 12 idle-timeout 30
+QUEUE: 2 items
+\tSCAN 0.000211 /tmp/file
+\tINSTREAM 1.500000\x20
+
+MEMSTATS: heap 9.082M mmap 0.000M used 6.902M free 2.184M releasable 0.129M pools 1 pools_used 565.979M \
+pools_total 565.999M
+END
+"""
+
+
+def test_parse_stats():
+    stats = parse_stats(STATS)
+    assert len(stats.pools) == 1
+    assert stats.pools[0].state == 'VALID PRIMARY'
+    assert (stats.threads_live, stats.threads_idle, stats.threads_max) == (3, 1, 12)
+    assert stats.threads_busy == 2
+    assert stats.pools[0].idle_timeout == 30
+    assert stats.queue_items == 2
+    assert stats.pools[0].queue == [('SCAN', 0.000211), ('INSTREAM', 1.5)]
+    assert stats.mmap == 0
+    assert stats.pools_used == int(565.979 * 1024 * 1024)
+
+
+def test_parse_stats_not_available():
+    stats = parse_stats(STATS.replace('heap 9.082M', 'heap N/A'))
+    assert stats.heap is None
+    assert 'memory_heap_bytes' not in stats.metrics()
+
+
+def test_parse_stats_invalid():
+    with pytest.raises(clamd.ResponseError):
+        parse_stats("THREADS: live many")
+
+
+def test_format_metrics():
+    assert format_metrics({'up': 1, 'queue_items': 2}) == 'clamd_queue_items 2\nclamd_up 1\n'
+
+
+def test_poller():
+    stats = []
+    poller = StatsPoller(clamd.ClamdUnixSocket(), callback=stats.append)
+    assert poller.poll() is stats[0]
+    metrics = poller.metrics()
+    assert metrics['up'] == 1
+    assert metrics['threads_max'] > 0
+
+
+def test_poller_down():
+    poller = StatsPoller(clamd.ClamdUnixSocket(path="/tmp/404"))
+    assert poller.poll() is None
+    assert poller.metrics()['up'] == 0
+    assert poller.metrics()['stats_poll_errors_total'] == 1
+
+
+def test_poller_callback_error():
+    calls = []
+
+    def callback(stats):
+        calls.append(stats)
+        raise ValueError("broken callback")
+
+    poller = StatsPoller(clamd.ClamdUnixSocket(), interval=0.01, callback=callback).start()
+    try:
+        for _ in range(100):
+            if len(calls) >= 2:
+                break
+            time.sleep(0.01)
+        # the thread survived the first error
+        assert len(calls) >= 2
+    finally:
+        poller.stop()
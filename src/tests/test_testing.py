@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import socket
+import time
+from io import BytesIO
+
+import clamd
+from clamd.stats import parse_stats
+from clamd.testing import FakeClamd
+
+import pytest
+
+
+class TestFakeClamd(object):
+    def setup_method(self):
+        self.server = FakeClamd(verdicts={b'bad': 'Bad-Signature'})
+        self.cd = self.server.client()
+
+    def teardown_method(self):
+        self.server.close()
+
+    def test_tcp(self):
+        assert self.cd.ping() == 'PONG'
+        assert self.cd.version() == self.server.version
+        assert self.server.commands['PING'] == 1
+
+    def test_verdicts(self):
+        assert self.cd.instream(BytesIO(b'bad content')) == {'stream': ('FOUND', 'Bad-Signature')}
+        assert self.cd.instream(BytesIO(clamd.EICAR)) == {'stream': ('OK', None)}
+
+    def test_size_limit(self):
+        self.server.stream_max_length = 10
+        with pytest.raises(clamd.BufferTooLongError):
+            self.cd.instream(BytesIO(b'x' * 11))
+
+    def test_session(self):
+        with self.cd.session() as session:
+            first = session.submit_ping()
+            second = session.submit_stats()
+            assert session.result(first) == 'PONG'
+            assert parse_stats(session.result(second)).threads_max == self.server.max_threads
+
+    def test_z_commands(self):
+        conn = socket.create_connection((self.server.host, self.server.port))
+        conn.sendall(b'zIDSESSION\0zPING\0zVERSION\0zEND\0')
+        replies = b''
+        while True:
+            data = conn.recv(4096)
+            if not data:
+                break
+            replies += data
+        conn.close()
+        assert replies.split(b'\0')[:2] == [b'1: PONG', b'2: ' + self.server.version.encode()]
+
+    def test_latency(self):
+        self.server.latency = 0.05
+        start = time.time()
+        self.cd.instream(BytesIO(b'foo'))
+        assert time.time() - start >= 0.05
+
+
+def test_unix_fildes(tmpdir):
+    path = str(tmpdir.join('clamd.ctl'))
+    with FakeClamd(path) as server:
+        with open(__file__, 'rb') as f:
+            assert list(server.client().fildes(f).values()) == [('OK', None)]
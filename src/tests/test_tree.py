@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import clamd
+from clamd.tree import scan_tree, walk_files
+import os
+import shutil
+import stat
+import tempfile
+
+import pytest
+
+mine = (stat.S_IREAD | stat.S_IWRITE)
+other = stat.S_IROTH
+execute = (stat.S_IEXEC | stat.S_IXOTH)
+
+
+@pytest.fixture
+def tree():
+    top = tempfile.mkdtemp(prefix="python-clamd")
+    os.mkdir(os.path.join(top, "sub"))
+    os.mkdir(os.path.join(top, "skipped"))
+    for name in ("a.txt", "sub/b.txt", "sub/c.log", "skipped/d.txt"):
+        with open(os.path.join(top, name), 'wb') as f:
+            f.write(clamd.EICAR)
+            os.fchmod(f.fileno(), (mine | other))
+    with open(os.path.join(top, "big.txt"), 'wb') as f:
+        f.write(b"x" * 1000)
+    os.mkfifo(os.path.join(top, "fifo"))
+    for d in (top, os.path.join(top, "sub"), os.path.join(top, "skipped")):
+        os.chmod(d, (mine | other | execute))
+    try:
+        yield top
+    finally:
+        shutil.rmtree(top)
+
+
+def test_walk_files_filters(tree):
+    found = sorted(os.path.relpath(path, tree) for path, st in walk_files(
+        tree, max_size=len(clamd.EICAR), include=["*.txt"], exclude=["skipped"]))
+    assert found == ["a.txt", os.path.join("sub", "b.txt")]
+
+
+def test_walk_files_symlink_cycle(tree):
+    os.symlink(tree, os.path.join(tree, "sub", "loop"))
+    os.symlink(os.path.join(tree, "sub"), os.path.join(tree, "sub2"))
+    found = sorted(os.path.basename(path) for path, st in walk_files(
+        tree, include=["*.txt"], exclude=["skipped"], follow_symlinks=True))
+    # sub is entered once, through sub or sub2, and loop is not followed
+    assert found == ["a.txt", "b.txt", "big.txt"]
+
+
+@pytest.mark.parametrize("method", [None, "scan", "instream"])
+def test_scan_tree(tree, method):
+    progress = []
+    results = dict(scan_tree(clamd.ClamdUnixSocket(), tree, max_workers=2, method=method, exclude=["skipped"],
+                             progress=lambda *args: progress.append(args)))
+    assert results == {
+        os.path.join(tree, "a.txt"): ('FOUND', 'Eicar-Test-Signature'),
+        os.path.join(tree, "sub", "b.txt"): ('FOUND', 'Eicar-Test-Signature'),
+        os.path.join(tree, "sub", "c.log"): ('FOUND', 'Eicar-Test-Signature'),
+        os.path.join(tree, "big.txt"): ('OK', None),
+    }
+    assert [args[2] for args in progress] == [1, 2, 3, 4]
+    assert progress[-1][3] == 3 * len(clamd.EICAR) + 1000